@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+import copy
+import getopt
+import random
+import sys
+
+from lxml import etree
+
+from util import gp7
+
+"""
+Synthetic Guitar Pro-style MusicXML, for benchmarks: guitar parts written as
+tab (string and fret for every note), a bass and a drum kit of unpitched
+notes, with the markup Guitar Pro exports for chords, bends, tremolo
+picking, palm mutes, let ring and vibrato (as GP7 processing instructions),
+ties, dynamics and tempo changes.
+
+The same shape and seed always generate the same document.
+
+    $ python -m benchmark.generate [--tier small|medium|large] [--parts N]
+          [--measures N] [--seed N] output.xml
+"""
+
+# Rates are per note (chords, bends, ...) or per measure (repeats)
+Shape = namedtuple("Shape", ["parts", "measures", "chords", "bends", "tremolo", "palmMutes",
+                             "letRing", "gp7", "tempoChanges", "drums", "rests", "ties",
+                             "repeats"])
+DEFAULT_SHAPE = Shape(parts=3, measures=32, chords=0.25, bends=0.1, tremolo=0.05,
+                      palmMutes=0.15, letRing=0.1, gp7=0.1, tempoChanges=4, drums=True,
+                      rests=0.08, ties=0.05, repeats=0.5)
+
+TIERS = {
+    "small": DEFAULT_SHAPE._replace(parts=2, measures=16),
+    "medium": DEFAULT_SHAPE._replace(parts=4, measures=64),
+    "large": DEFAULT_SHAPE._replace(parts=6, measures=256),
+}
+
+DIVISIONS = 4
+MEASURE_DIVISIONS = 4 * DIVISIONS
+NOTE_TYPES = {1: "16th", 2: "eighth", 4: "quarter", 8: "half", 16: "whole"}
+DOTTED_TYPES = {3: "eighth", 6: "quarter", 12: "half"}
+
+# Open strings, from the first (highest) string down, as MIDI note numbers
+GUITAR_TUNING = [64, 59, 55, 50, 45, 40]
+BASS_TUNING = [43, 38, 33, 28]
+STEPS = [("C", 0), ("C", 1), ("D", 0), ("D", 1), ("E", 0), ("F", 0), ("F", 1), ("G", 0),
+         ("G", 1), ("A", 0), ("A", 1), ("B", 0)]
+# Display positions Guitar Pro gives kick, snare, hi-hat and crash
+DRUM_NOTES = [("F", 4), ("C", 5), ("G", 5), ("A", 5)]
+DYNAMICS = ["pp", "p", "mp", "mf", "f", "ff"]
+BEND_SHAPES = [
+    [("2", None)],
+    [("2", None), ("0", "release")],
+    [("1", None), ("2", None), ("0", None)],
+    [("1", "pre-bend"), ("0", None)],
+]
+TEMPOS = [72, 90, 100, 120, 132, 140, 160]
+
+def _sub(parent, tag, text=None, **attributes):
+    element = etree.SubElement(parent, tag, attributes)
+    if text is not None:
+        element.text = str(text)
+    return element
+
+def _rhythm(rng, rests):
+    """
+    Durations (in divisions) and whether each is a rest, filling a measure.
+    """
+    rhythm = []
+    remaining = MEASURE_DIVISIONS
+    while remaining:
+        duration = rng.choice([length for length in (1, 2, 2, 4, 4, 6, 8)
+                               if length <= remaining])
+        rhythm.append((duration, rng.random() < rests))
+        remaining -= duration
+    return rhythm
+
+def _pitch(note, midiNumber):
+    step, alter = STEPS[midiNumber % 12]
+    pitch = _sub(note, "pitch")
+    _sub(pitch, "step", step)
+    if alter:
+        _sub(pitch, "alter", alter)
+    _sub(pitch, "octave", midiNumber // 12 - 1)
+
+def _duration(note, duration):
+    _sub(note, "duration", duration)
+    _sub(note, "voice", 1)
+    if duration in DOTTED_TYPES:
+        _sub(note, "type", DOTTED_TYPES[duration])
+        _sub(note, "dot")
+    else:
+        _sub(note, "type", NOTE_TYPES[duration])
+
+def _attributes(measure, clef, clefLine=None):
+    attributes = _sub(measure, "attributes")
+    _sub(attributes, "divisions", DIVISIONS)
+    key = _sub(attributes, "key")
+    _sub(key, "fifths", 0)
+    time = _sub(attributes, "time")
+    _sub(time, "beats", 4)
+    _sub(time, "beat-type", 4)
+    clefElement = _sub(attributes, "clef")
+    _sub(clefElement, "sign", clef)
+    if clefLine:
+        _sub(clefElement, "line", clefLine)
+
+def _tempo(measure, bpm):
+    direction = _sub(measure, "direction", placement="above")
+    directionType = _sub(direction, "direction-type")
+    metronome = _sub(directionType, "metronome")
+    _sub(metronome, "beat-unit", "quarter")
+    _sub(metronome, "per-minute", bpm)
+    _sub(direction, "sound", tempo=str(bpm))
+
+def _rest(measure, duration):
+    note = _sub(measure, "note")
+    _sub(note, "rest")
+    _duration(note, duration)
+
+def _fretted(measure, rng, shape, tuning, duration, tie=None, positions=None):
+    """
+    A note or chord on fretted strings, with its effects. Returns its
+    (string, fret) positions; a tie stop is given those of its tie start.
+    """
+    if positions is None:
+        strings = [rng.randrange(len(tuning))]
+        if rng.random() < shape.chords:
+            strings = sorted(rng.sample(range(len(tuning)), rng.choice([2, 3])))
+        positions = [(string, rng.randrange(13)) for string in strings]
+
+    effects = []
+    if rng.random() < shape.letRing:
+        effects.append("letring")
+    if rng.random() < shape.gp7:
+        effects.append("vibrato")
+    palmMute = rng.random() < shape.palmMutes
+    bend = rng.choice(BEND_SHAPES) if rng.random() < shape.bends else None
+    tremolo = rng.choice(["1", "2", "3"]) if rng.random() < shape.tremolo else None
+    dynamics = rng.choice(DYNAMICS) if rng.random() < 0.05 else None
+
+    for index, (string, fret) in enumerate(positions):
+        note = _sub(measure, "note")
+        if index:
+            _sub(note, "chord")
+        _pitch(note, tuning[string] + fret)
+        _duration(note, duration)
+        if tie:
+            _sub(note, "tie", type=tie)
+        if palmMute:
+            play = _sub(note, "play")
+            _sub(play, "mute", "palm")
+
+        notations = _sub(note, "notations")
+        if tie:
+            _sub(notations, "tied", type=tie)
+        if dynamics and not index:
+            _sub(_sub(notations, "dynamics"), dynamics)
+        technical = _sub(notations, "technical")
+        _sub(technical, "string", string + 1)
+        _sub(technical, "fret", fret)
+        if bend and not index:
+            for alter, kind in bend:
+                bendElement = _sub(technical, "bend")
+                _sub(bendElement, "bend-alter", alter)
+                if kind:
+                    _sub(bendElement, kind)
+        if tremolo:
+            ornaments = _sub(notations, "ornaments")
+            _sub(ornaments, "tremolo", tremolo, type="single")
+
+        if effects:
+            note.append(etree.ProcessingInstruction(
+                gp7.TARGET, "<root>{}</root>".format("".join("<{}/>".format(effect)
+                                                             for effect in effects))))
+    return positions
+
+def _drums(measure, rng, duration):
+    for index, (step, octave) in enumerate(rng.sample(DRUM_NOTES, rng.choice([1, 1, 2]))):
+        note = _sub(measure, "note")
+        if index:
+            _sub(note, "chord")
+        unpitched = _sub(note, "unpitched")
+        _sub(unpitched, "display-step", step)
+        _sub(unpitched, "display-octave", octave)
+        _duration(note, duration)
+
+def _partKinds(shape):
+    kinds = ["guitar"] * shape.parts
+    if shape.drums and shape.parts > 1:
+        kinds[-1] = "drums"
+    if shape.parts > 2:
+        kinds[-2 if shape.drums else -1] = "bass"
+    return kinds
+
+def _measure(part, rng, shape, kind, number, tempo):
+    measure = _sub(part, "measure", number=str(number))
+    if number == 1:
+        if kind == "drums":
+            _attributes(measure, "percussion")
+        elif kind == "bass":
+            _attributes(measure, "F", 4)
+        else:
+            _attributes(measure, "G", 2)
+    if tempo:
+        _tempo(measure, tempo)
+
+    tuning = BASS_TUNING if kind == "bass" else GUITAR_TUNING
+    tied = None
+    rhythm = _rhythm(rng, shape.rests)
+    for index, (duration, isRest) in enumerate(rhythm):
+        if tied:
+            # Guitar Pro ties a note to a copy of itself
+            _fretted(measure, rng, shape, tuning, duration, tie="stop", positions=tied)
+            tied = None
+        elif isRest:
+            _rest(measure, duration)
+        elif kind == "drums":
+            _drums(measure, rng, duration)
+        elif index + 1 < len(rhythm) and rng.random() < shape.ties:
+            tied = _fretted(measure, rng, shape, tuning, duration, tie="start")
+        else:
+            _fretted(measure, rng, shape, tuning, duration)
+    return measure
+
+def generate(shape=DEFAULT_SHAPE, seed=0):
+    """
+    A MusicXML document of the given Shape, as bytes.
+    """
+    rng = random.Random(seed)
+    root = etree.Element("score-partwise", version="3.0")
+    work = _sub(root, "work")
+    _sub(work, "work-title", "Synthetic ({} parts, {} measures)".format(shape.parts,
+                                                                        shape.measures))
+
+    kinds = _partKinds(shape)
+    names = {"guitar": "Guitar", "bass": "Bass", "drums": "Drums"}
+    partList = _sub(root, "part-list")
+    for index, kind in enumerate(kinds):
+        scorePart = _sub(partList, "score-part", id="P{}".format(index + 1))
+        name = names[kind]
+        if kind == "guitar":
+            name = "{} {}".format(name, index + 1)
+        _sub(scorePart, "part-name", name)
+
+    # Tempo changes go with the first part, evenly spread
+    tempos = {}
+    if shape.tempoChanges:
+        step = max(1, shape.measures // shape.tempoChanges)
+        for number in range(1, shape.measures + 1, step)[:shape.tempoChanges]:
+            tempos[number] = rng.choice(TEMPOS)
+
+    for index, kind in enumerate(kinds):
+        part = _sub(root, "part", id="P{}".format(index + 1))
+        written = []
+        for number in range(1, shape.measures + 1):
+            tempo = tempos.get(number) if index == 0 else None
+            if written and number > 1 and rng.random() < shape.repeats:
+                # Riffs repeat: copy an earlier measure's notes
+                source = rng.choice(written)
+                measure = _sub(part, "measure", number=str(number))
+                if tempo:
+                    _tempo(measure, tempo)
+                for note in source.findall("note"):
+                    measure.append(copy.deepcopy(note))
+            else:
+                measure = _measure(part, rng, shape, kind, number, tempo)
+            written.append(measure)
+
+    return etree.tostring(root, xml_declaration=True, encoding="UTF-8", pretty_print=True,
+                          doctype='<!DOCTYPE score-partwise PUBLIC "-//Recordare//DTD '
+                                  'MusicXML 3.0 Partwise//EN" '
+                                  '"http://www.musicxml.org/dtds/partwise.dtd">')
+
+def usage():
+    print("Usage: python -m benchmark.generate [--tier small|medium|large] [--parts N] "
+          "[--measures N] [--seed N] output.xml", file=sys.stderr)
+    sys.exit(-1)
+
+def main(args):
+    try:
+        opts, args = getopt.getopt(args, "h", ["help", "tier=", "parts=", "measures=", "seed="])
+    except getopt.GetoptError as err:
+        print(err)
+        usage()
+
+    tier = None
+    overrides = {}
+    seed = 0
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+        elif o == "--tier":
+            assert a in TIERS, "the tier is one of {}".format(", ".join(TIERS))
+            tier = a
+        elif o == "--parts":
+            overrides["parts"] = int(a)
+        elif o == "--measures":
+            overrides["measures"] = int(a)
+        elif o == "--seed":
+            seed = int(a)
+
+    if len(args) != 1:
+        usage()
+
+    shape = TIERS[tier] if tier else DEFAULT_SHAPE
+    with open(args[0], "wb") as output:
+        output.write(generate(shape._replace(**overrides), seed))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
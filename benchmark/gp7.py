@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+from lxml import etree
+import re
+import sys
+import time
+
+from util import gp7
+
+"""
+Compare GP7 processing-instruction extraction as note count grows:
+the original approach (serialize each BeautifulSoup note, regex for the
+instruction, build a fresh BeautifulSoup per match, as benchmark/legacy.py
+does) against util.gp7. Needs BeautifulSoup for the baseline.
+
+    $ python -m benchmark.gp7 [note-count ...]
+"""
+
+NOTE_COUNTS = [1000, 5000, 20000, 50000]
+
+PAYLOADS = [
+    "<root><vibrato/></root>",
+    "<root><letring/></root>",
+    "<root><vibrato/><letring/></root>",
+    "<root><harmonic type=\"Artificial\"/></root>",
+]
+
+def buildPart(noteCount):
+    part = etree.Element("part", id="P1")
+    measure = None
+    for index in range(noteCount):
+        if index % 8 == 0:
+            measure = etree.SubElement(part, "measure", number=str(index // 8 + 1))
+        note = etree.SubElement(measure, "note")
+        pitch = etree.SubElement(note, "pitch")
+        etree.SubElement(pitch, "step").text = "E"
+        etree.SubElement(pitch, "octave").text = "4"
+        etree.SubElement(note, "duration").text = "2"
+        notations = etree.SubElement(note, "notations")
+        technical = etree.SubElement(notations, "technical")
+        etree.SubElement(technical, "string").text = "1"
+        etree.SubElement(technical, "fret").text = "0"
+        if index % 3 == 0:
+            note.append(etree.ProcessingInstruction(
+                gp7.TARGET, PAYLOADS[index % len(PAYLOADS)]))
+    return part
+
+def soupNotes(part):
+    """
+    The notes of `part`, parsed by BeautifulSoup as the converter used to.
+    """
+    from bs4 import BeautifulSoup
+
+    return BeautifulSoup(etree.tostring(part), "xml")("note")
+
+def legacy(notes):
+    from bs4 import BeautifulSoup
+
+    found = 0
+    for note in notes:
+        noteText = str(note)
+        if "GP7" in noteText:
+            m = re.search(r"<\?GP7([^\?]+)\?>", noteText, re.M)
+            if m:
+                payload = BeautifulSoup(m.group(1), "xml")
+                if payload.find("vibrato"):
+                    found += 1
+                if payload.find("letring"):
+                    found += 1
+    return found
+
+def cached(notes):
+    gp7.decode.cache_clear()
+    found = 0
+    for note in notes:
+        effects = gp7.noteEffects(note)
+        if "vibrato" in effects:
+            found += 1
+        if "letring" in effects:
+            found += 1
+    return found
+
+def timed(function, notes):
+    start = time.perf_counter()
+    found = function(notes)
+    return time.perf_counter() - start, found
+
+def main(args):
+    counts = [int(arg) for arg in args] or NOTE_COUNTS
+    print("{:>8} {:>12} {:>12} {:>8}".format("notes", "before (s)", "after (s)", "speedup"))
+    for count in counts:
+        part = buildPart(count)
+        before, expected = timed(legacy, soupNotes(part))
+        after, found = timed(cached, list(part.iter("note")))
+        assert found == expected, "GP7 extraction results differ"
+        print("{:>8} {:>12.4f} {:>12.4f} {:>7.1f}x".format(count, before, after,
+                                                         before / after))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
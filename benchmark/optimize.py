@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import tempfile
+
+from postprocess import postprocessorChain
+from postprocess import schedule
+from postprocess.optimize import OptimizePostprocessor, verify
+from util import convert
+from util import transform
+
+"""
+Compare every part of MusicXML files rendered with and without the event
+optimizer (-O): the size of its track, and whether a player does the same
+with both (see postprocess.optimize.verify, which reads the encoded tracks
+back). Postprocessors are those of a
+postprocessor option, e.g. realeight.
+
+    $ python -m benchmark.optimize [-p postprocessor] XML-filename ...
+"""
+
+def compare(part, postprocs):
+    rows = list(transform.createRows(part, 1))
+    optimized = tuple(processor for processor in postprocs
+                      if processor is not OptimizePostprocessor)
+    optimized = optimized + (OptimizePostprocessor,)
+
+    before = schedule.render(postprocs, rows)
+    after = schedule.render(optimized, rows)
+    return len(before), len(after), verify(before, after)
+
+def main(args):
+    postproc = None
+    if args[:1] == ["-p"]:
+        postproc, args = args[1], args[2:]
+    postprocs = postprocessorChain(postproc)
+
+    conversionCache = convert.createCache(tempfile.mkdtemp())
+    failures = 0
+    print("{:<32} {:>10} {:>10} {:>7}".format("part", "before", "after", "saved"))
+    for filename in args:
+        compact = convert.loadScore(filename, conversionCache)
+        for part in convert.distinctParts(compact):
+            before, after, difference = compare(part, postprocs)
+            print("{:<32} {:>10} {:>10} {:>6.1%}".format(part.name[:32], before, after,
+                                                         1 - after / before))
+            if difference:
+                failures += 1
+                print("  ✘ {}".format(difference))
+
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+from functools import partial
+import getopt
+import hashlib
+import io
+import json
+import os.path
+import platform
+import sys
+import tempfile
+import time
+
+from benchmark import generate
+from postprocess.normalize import NormalizePostprocessor
+from postprocess.optimize import OptimizePostprocessor
+from postprocess.realeight import RealEightPostprocessor
+from postprocess import postprocessorChain, schedule
+from util import convert
+from util import events
+from util import extract
+from util import midi
+from util import score
+from util import transform
+
+"""
+Time every stage of the conversion pipeline on synthetic scores (see
+benchmark.generate) of each size tier: XML normalization, music21 parsing,
+extraction into a compact score, event generation (transform.createRows,
+which createMIDIEvents wraps), each postprocessor on its own, and writing
+the MIDI files. Stages are named as in `converter --profile`.
+
+Each stage is run `repeat` times and its best time kept. Digests of the
+MIDI files written without postprocessors, with each of them and with
+`-p realeight -O -n` are kept too, so that a change in output shows up
+next to a change in speed.
+
+    $ python -m benchmark.suite [--tiers small,medium,large] [--repeat N]
+          [--save baseline.json] [--compare baseline.json] [--threshold 0.1]
+
+--save stores the results as a baseline; --compare runs the tiers of a
+baseline again and fails (exit status 1) when a stage got slower by more
+than the threshold (a fraction), or when the output changed. Baselines are
+only comparable on the same machine.
+"""
+
+POSTPROCESSORS = (RealEightPostprocessor, OptimizePostprocessor, NormalizePostprocessor)
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 0.1
+# Slowdowns smaller than this (in seconds) are noise, whatever their ratio
+NOISE_FLOOR = 0.005
+# The postprocessor chains whose output is digested, by name
+DIGESTED_CHAINS = dict([("none", ())] +
+                       [(processor.__name__, (processor,)) for processor in POSTPROCESSORS] +
+                       [("-p realeight -O -n", postprocessorChain("realeight", normalize=True,
+                                                                  optimize=True))])
+
+def best(function, repeat, setup=None):
+    """
+    The best time of `repeat` calls to `function`, and its result. With
+    `setup`, each call is given a fresh (and untimed) `setup()`.
+    """
+    times = []
+    for run in range(repeat):
+        arguments = (setup(),) if setup else ()
+        start = time.perf_counter()
+        result = function(*arguments)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+def _parse(markup):
+    import music21
+
+    return music21.converter.parseData(markup, format="musicxml")
+
+def _writeFiles(directory, partRows, tempoBytes):
+    for index, rows in enumerate(partRows):
+        midi.writeFile(os.path.join(directory, "{}.mid".format(index)),
+                       [partial(events.writeChunk, rows), tempoBytes])
+
+def run(shape, repeat=DEFAULT_REPEAT):
+    """
+    Time each stage on a score of the given Shape. Returns the results as
+    stored in baselines.
+    """
+    seconds = {}
+    data = generate.generate(shape)
+
+    seconds["normalize XML"], markup = best(
+        lambda: extract.standardizeExpressions(io.BytesIO(data), io.BytesIO()), repeat)
+    seconds["parse"] = best(partial(_parse, markup.getvalue()), repeat)[0]
+    # music21 caches what it works out about a stream, so extraction gets a
+    # fresh one every time
+    seconds["extract"], compact = best(score.compactScore, repeat,
+                                       setup=partial(_parse, markup.getvalue()))
+
+    parts = convert.distinctParts(compact)
+    seconds["events"], partRows = best(
+        lambda: [list(transform.createRows(part, 1)) for part in parts], repeat)
+
+    for processor in POSTPROCESSORS:
+        seconds[processor.__name__], processed = best(
+            lambda: [list(schedule.run((processor,), rows)) for rows in partRows], repeat)
+
+    tempoBytes = compact.tempoMap(convert.TICKS_PER_QUARTER_NOTE).encode()
+    with tempfile.TemporaryDirectory() as directory:
+        seconds["write"], written = best(partial(_writeFiles, directory, partRows, tempoBytes),
+                                         repeat)
+
+    digests = {}
+    for name, postprocs in DIGESTED_CHAINS.items():
+        digest = hashlib.sha1()
+        for rows in partRows:
+            digest.update(midi.fileBytes([schedule.render(postprocs, rows), tempoBytes]))
+        digests[name] = digest.hexdigest()
+
+    return {
+        "shape": shape._asdict(),
+        "events": sum(len(rows) for rows in partRows),
+        "seconds": seconds,
+        "digests": digests,
+    }
+
+def environment():
+    import music21
+
+    return {"python": platform.python_version(), "music21": music21.__version__,
+            "machine": platform.machine()}
+
+def compare(baseline, results, threshold=DEFAULT_THRESHOLD):
+    """
+    Print each tier's stages against a baseline's. Returns the number of
+    regressions: stages slower by more than `threshold` (and the noise
+    floor), and tiers whose output changed.
+    """
+    regressions = 0
+    for tier, result in results.items():
+        before = baseline["tiers"][tier]
+        print("{} ({} events)".format(tier, result["events"]))
+        print("  {:<24} {:>10} {:>10} {:>8}".format("stage", "baseline", "now", "change"))
+        for stage, seconds in result["seconds"].items():
+            previous = before["seconds"].get(stage)
+            if previous is None:
+                print("  {:<24} {:>10} {:>10.4f}".format(stage, "-", seconds))
+                continue
+
+            change = seconds / previous - 1 if previous else 0.0
+            slower = change > threshold and seconds - previous > NOISE_FLOOR
+            regressions += slower
+            print("  {:<24} {:>10.4f} {:>10.4f} {:>+7.1%}{}".format(
+                stage, previous, seconds, change, "  ✘" if slower else ""))
+
+        previousDigests = before.get("digests", {})
+        for name, digest in result["digests"].items():
+            if digest != previousDigests.get(name):
+                regressions += 1
+                print("  ✘ the MIDI output changed ({})".format(name))
+    return regressions
+
+def report(results):
+    for tier, result in results.items():
+        print("{} ({} events)".format(tier, result["events"]))
+        for stage, seconds in result["seconds"].items():
+            print("  {:<24} {:>10.4f}".format(stage, seconds))
+
+def usage():
+    print("Usage: python -m benchmark.suite [--tiers tier,...] [--repeat N] "
+          "[--save baseline-file] [--compare baseline-file] [--threshold fraction]",
+          file=sys.stderr)
+    sys.exit(-1)
+
+def main(args):
+    try:
+        opts, args = getopt.getopt(args, "h", ["help", "tiers=", "repeat=", "save=", "compare=",
+                                               "threshold="])
+    except getopt.GetoptError as err:
+        print(err)
+        usage()
+
+    tiers = list(generate.TIERS)
+    repeat = DEFAULT_REPEAT
+    savePath = None
+    comparePath = None
+    threshold = DEFAULT_THRESHOLD
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+        elif o == "--tiers":
+            tiers = [tier.strip() for tier in a.split(",") if tier.strip()]
+            for tier in tiers:
+                assert tier in generate.TIERS, "'{}' is not a tier".format(tier)
+        elif o == "--repeat":
+            repeat = int(a)
+        elif o == "--save":
+            savePath = a
+        elif o == "--compare":
+            comparePath = a
+        elif o == "--threshold":
+            threshold = float(a)
+
+    baseline = None
+    if comparePath:
+        with open(comparePath, "r") as baselineFile:
+            baseline = json.load(baselineFile)
+        tiers = [tier for tier in tiers if tier in baseline["tiers"]]
+
+    # Not a stage of its own, and only paid once
+    import music21
+
+    results = {tier: run(generate.TIERS[tier], repeat) for tier in tiers}
+
+    if baseline:
+        regressions = compare(baseline, results, threshold)
+    else:
+        report(results)
+
+    if savePath:
+        with open(savePath, "w") as baselineFile:
+            json.dump({"environment": environment(), "repeat": repeat, "tiers": results},
+                      baselineFile, indent=2)
+
+    if baseline and regressions:
+        print("{} regression(s) beyond {:.0%}".format(regressions, threshold))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,5 +1,9 @@
 from postprocess.base import BasePostprocessor
+from postprocess.normalize import NormalizePostprocessor
+from postprocess.optimize import OptimizePostprocessor
 from postprocess.realeight import RealEightPostprocessor
+from postprocess import schedule
+from util.events import EventBuffer
 
 POSTPROCESSORS = {
     "realeight": (RealEightPostprocessor,)
@@ -11,5 +15,24 @@ def checkForPreprocessor(a):
 def selectPreprocessors(option):
     return POSTPROCESSORS[option] if option in POSTPROCESSORS else [BasePostprocessor]
 
+def postprocessorChain(option=None, normalize=False, optimize=False):
+    """
+    The postprocessor classes for a postprocessor option (e.g. "realeight"),
+    followed by the event optimizer and normalization if asked for.
+    """
+    postprocs = tuple(selectPreprocessors(option))
+    if optimize:
+        postprocs = postprocs + (OptimizePostprocessor,)
+    if normalize:
+        postprocs = postprocs + (NormalizePostprocessor,)
+    return postprocs
+
 def reduceEventsAndMeta(eventsAndMeta):
     return [event for event, meta in eventsAndMeta]
+
+def runPostprocessors(postprocs, buffer):
+    """
+    Run an EventBuffer through each postprocessor class in turn (fusing
+    their passes where possible, see postprocess.schedule).
+    """
+    return EventBuffer.fromRows(schedule.run(postprocs, buffer.rows()))
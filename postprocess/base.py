@@ -1,4 +1,25 @@
+from postprocess import schedule
+from util.events import EventBuffer
+
 class BasePostprocessor:
+    def process(self, buffer):
+        """
+        Postprocessors can work on a columnar util.events.EventBuffer,
+        modifying it in place or returning a new one.
+
+        By default, this runs the postprocessor's `map` or `reduce` (see
+        postprocess.schedule) over the buffer, or hands the events to `run`
+        as (event, meta) tuples.
+        """
+        if schedule._declares(self, "map") or schedule._declares(self, "reduce"):
+            rows = buffer.rows()
+            for stage in schedule.plan([self]):
+                rows = stage.materialize(rows)
+            return EventBuffer.fromRows(rows)
+        if schedule._declares(self, "run"):
+            return EventBuffer.fromEventsAndMeta(self.run(buffer.toEventsAndMeta()))
+        return buffer
+
     def run(self, eventsAndMeta):
         """
         All postprocessors should expect as input a list of tuples,
@@ -6,5 +27,11 @@ class BasePostprocessor:
         and the second being a dictionary of metadata to influence processing.
 
         Return a list of events+meta tuples
+
+        Postprocessors that implement `process`, `map` or `reduce` instead
+        get this for free.
         """
-        return eventsAndMeta
+        if type(self).process is BasePostprocessor.process and not (
+                schedule._declares(self, "map") or schedule._declares(self, "reduce")):
+            return eventsAndMeta
+        return self.process(EventBuffer.fromEventsAndMeta(eventsAndMeta)).toEventsAndMeta()
@@ -1,14 +1,38 @@
-import music21
+from postprocess.base import BasePostprocessor
+from util import events
 
-class NormalizePostprocessor:
-    def run(self, eventsAndMeta):
-        newEventsAndMeta = []
-        maxVelocity = max(event.velocity for event, meta in eventsAndMeta if event.velocity)
-        factor = 127 / maxVelocity
+class NormalizePostprocessor(BasePostprocessor):
+    FINALIZED_TYPES = (events.NOTE_ON,)
 
-        for event, meta in eventsAndMeta:
-            if event.type == "NOTE_ON":
-                event.velocity = round(event.velocity * factor)
-            newEventsAndMeta.append((event, meta))
+    def __init__(self):
+        self.maxVelocity = 0
 
-        return newEventsAndMeta
+    def reduce(self, row):
+        # Every message's second data byte counts, not just note velocities
+        code, velocity = row[events.TYPE], row[events.DATA2]
+        if code not in (events.DELTA_TIME, events.META_EVENT) and velocity:
+            self.maxVelocity = max(self.maxVelocity, velocity)
+
+    def finalize(self, row):
+        factor = 127 / self.maxVelocity
+        return row[events.DATA1], round(row[events.DATA2] * factor)
+
+    def process(self, buffer):
+        # The same, over a whole buffer's columns (the scheduler fuses
+        # reduce and finalize into its pass instead; tests/test_postprocess.py
+        # checks both write the same bytes)
+        types = buffer.columns["type"]
+        velocities = buffer.columns["data2"]
+
+        self.maxVelocity = max((velocity for code, velocity in zip(types, velocities)
+                                if code not in (events.DELTA_TIME, events.META_EVENT)
+                                and velocity != events.NONE and velocity), default=0)
+        if not self.maxVelocity:
+            return buffer
+        factor = 127 / self.maxVelocity
+
+        for row, code in enumerate(types):
+            if code == events.NOTE_ON:
+                velocities[row] = round(velocities[row] * factor)
+
+        return buffer
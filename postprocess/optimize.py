@@ -0,0 +1,152 @@
+from postprocess.base import BasePostprocessor
+from util import events
+from util import midi
+
+"""
+Shrinks a part's events without changing what a player does with them:
+
+- NOTE_OFFs that end no sounding note are dropped: rests' placeholders
+  (pitch 1, velocity 1) and the null-pitch NOTE_OFFs of tied notes, mostly;
+- controller and pitch bend events that repeat the value already in effect
+  on their channel (let ring and vibrato toggles, flat bend steps) are
+  dropped, as is anything the MIDI writer would skip anyway;
+- every event kept is written with exactly one delta time, which puts it
+  on the tick the MIDI writer would have given it without the optimizer
+  (see midi.encodeTrack for how it adds up and carries delta times).
+
+If the track ended on dropped events, an end-of-track event keeps it as
+long as it was. `timeline` and `verify` check an optimized track against
+the original, from their encoded bytes.
+"""
+
+class OptimizePostprocessor(BasePostprocessor):
+    def __init__(self):
+        # The sum of all delta times so far, the tick the MIDI writer
+        # would put the last encodable event on, and the tick of the last
+        # event kept
+        self.total = 0
+        self.tick = 0
+        self.kept = 0
+        # (channel, pitch) -> how many of its NOTE_ONs are sounding
+        self.sounding = {}
+        # Channel -> (LSB, MSB), and (channel, controller) -> value
+        self.bends = {}
+        self.controllers = {}
+
+    def _redundant(self, row):
+        code, delta, channel, data1, data2, meta = row
+        if code == events.NOTE_ON and data2:
+            note = (channel, data1)
+            self.sounding[note] = self.sounding.get(note, 0) + 1
+        elif code in (events.NOTE_ON, events.NOTE_OFF):
+            note = (channel, data1)
+            if not self.sounding.get(note):
+                return True
+            self.sounding[note] -= 1
+        elif code == events.PITCH_BEND:
+            if self.bends.get(channel) == (data1, data2):
+                return True
+            self.bends[channel] = (data1, data2)
+        elif code == events.CONTROLLER_CHANGE:
+            if self.controllers.get((channel, data1)) == data2:
+                return True
+            self.controllers[(channel, data1)] = data2
+        return False
+
+    def map(self, row):
+        if row[events.TYPE] == events.DELTA_TIME:
+            self.total += row[events.DELTA]
+            return ()
+
+        if not events.encodable(row):
+            return ()
+        # Where the writer puts an event: delta times add up, and a
+        # negative sum doesn't move it back
+        self.tick = max(self.tick, self.total)
+        if self._redundant(row):
+            return ()
+
+        delta = (events.DELTA_TIME, self.tick - self.kept, None, None, None, row[events.META])
+        self.kept = self.tick
+        return (delta, row)
+
+    def flush(self):
+        # The writer ends a track with delta times left over, if any
+        end = max(self.tick, self.total)
+        if end == self.kept:
+            return ()
+        delta = end - self.kept
+        self.kept = end
+        return ((events.DELTA_TIME, delta, None, None, None, {}),
+                (events.META_EVENT, 0, None, midi.META_EVENTS["END_OF_TRACK"], b"", {}))
+
+def timeline(chunk):
+    """
+    What a player does with an encoded track (an MTrk chunk, read with
+    midi.decodeTrack): the notes it plays, as (tick on, tick off, channel,
+    pitch, velocity), where notes that never end have a tick off of None;
+    every change to a controller or pitch bend value, and any other channel
+    message, in order, as (tick, type, channel, data1, data2); and the tick
+    the track ends on.
+
+    A NOTE_OFF (or a NOTE_ON with velocity 0) ends the earliest sounding
+    note of its pitch on its channel, and does nothing if there is none.
+    """
+    notes = []
+    changes = []
+    sounding = {}
+    values = {}
+    end = 0
+
+    for tick, code, channel, data1, data2 in midi.decodeTrack(chunk):
+        end = tick
+        if code == events.META_EVENT:
+            continue
+
+        if code == events.NOTE_ON and data2:
+            sounding.setdefault((channel, data1), []).append((tick, data2))
+        elif code in (events.NOTE_ON, events.NOTE_OFF):
+            started = sounding.get((channel, data1))
+            if started:
+                on, velocity = started.pop(0)
+                notes.append((on, tick, channel, data1, velocity))
+        else:
+            if code == events.CONTROLLER_CHANGE:
+                key, value = (code, channel, data1), data2
+            elif code == events.PITCH_BEND:
+                key, value = (code, channel), (data1, data2)
+            else:
+                key = value = None
+            if key is not None:
+                if values.get(key) == value:
+                    continue
+                values[key] = value
+            changes.append((tick, code, channel, data1, data2))
+
+    for (channel, pitch), started in sounding.items():
+        notes.extend((on, None, channel, pitch, velocity) for on, velocity in started)
+    notes.sort(key=lambda note: note[:1] + (-1 if note[1] is None else note[1],) + note[2:])
+    return notes, changes, end
+
+def verify(original, optimized):
+    """
+    None if two encoded tracks play the same (see `timeline`), and a
+    description of where they first differ otherwise.
+    """
+    timelines = []
+    for name, chunk in (("original", original), ("optimized", optimized)):
+        try:
+            timelines.append(timeline(chunk))
+        except midi.MidiException as err:
+            return "the {} track can't be read: {}".format(name, err)
+    before, after = timelines
+
+    for kind, expected, actual in zip(("note", "change"), before, after):
+        for index, (wanted, got) in enumerate(zip(expected, actual)):
+            if wanted != got:
+                return "{} {}: expected {}, got {}".format(kind, index, wanted, got)
+        if len(expected) != len(actual):
+            return "expected {} {}s, got {}".format(len(expected), kind, len(actual))
+    if before[2] != after[2]:
+        return "the track ends on tick {} instead of {}".format(after[2], before[2])
+    return None
@@ -1,64 +1,99 @@
-import music21
-
-class RealEightPostprocessor:
-    def run(self, eventsAndMeta):
-        newEventsAndMeta = []
-
-        priorVibrato = False
-        for event, meta in eventsAndMeta:
-            partName = meta.get("partName", "")
-
-            # Pitch bends are awfully sensitive.
-            if event.type == "PITCH_BEND":
-                # Pitch bends are MIDI encoded as two vals: LSB & MSB
-                origValue = event._parameter2 * 128 + event._parameter1
-                # Value range is 0, 16383 (center is 8192)
-                delta = origValue - 8192
-                newValue = 8192 + round(delta / 5.5)
-                event._parameter2, event._parameter1 = divmod(newValue, 128)
-
-            # Palm mutes are on a separate channel
-            if meta.get("palmMute"):
-                event.channel = 3
-
-            # Harmonics are on a separate channel, and an octave too high
-            if meta.get("harmonic"):
-                event.channel = 13
-                if event.type in ["NOTE_ON", "NOTE_OFF"]:
-                    event.pitch -= 12
-
-            # Vibrato requires mod wheel events before and after this one
-            if event.type == "NOTE_ON":
-                if meta.get("vibrato"):
-                    vibratoOn = music21.midi.MidiEvent(event.track)
-                    vibratoOn.type = "CONTROLLER_CHANGE"
-                    vibratoOn.time = 0
-                    vibratoOn.pitch = 1      # CC 1 = Mod Wheel MSB
-                    vibratoOn.velocity = 64
-                    vibratoOn.channel = 1
-                    newEventsAndMeta.append((vibratoOn, meta))
-
-                    delta = music21.midi.DeltaTime(event.track)
-                    delta.time = 0
-                    newEventsAndMeta.append((delta, meta))
-
-                    priorVibrato = True
-
-                elif priorVibrato:
-                    vibratoOff = music21.midi.MidiEvent(event.track)
-                    vibratoOff.type = "CONTROLLER_CHANGE"
-                    vibratoOff.time = 0
-                    vibratoOff.pitch = 1     # CC 1 = Mod Wheel MSB
-                    vibratoOff.velocity = 0
-                    vibratoOff.channel = 1
-                    newEventsAndMeta.append((vibratoOff, meta))
-
-                    delta = music21.midi.DeltaTime(event.track)
-                    delta.time = 0
-                    newEventsAndMeta.append((delta, meta))
-
-                    priorVibrato = False
-
-            newEventsAndMeta.append((event, meta))
-
-        return newEventsAndMeta
+from postprocess.base import BasePostprocessor
+from util import events
+
+MOD_WHEEL = 1   # CC 1 = Mod Wheel MSB
+
+class RealEightPostprocessor(BasePostprocessor):
+    def __init__(self):
+        self.priorVibrato = False
+
+    def map(self, row):
+        code, delta, channel, pitch, velocity, meta = row
+
+        # Pitch bends are awfully sensitive.
+        if code == events.PITCH_BEND:
+            # Pitch bends are MIDI encoded as two vals: LSB & MSB
+            origValue = velocity * 128 + pitch
+            # Value range is 0, 16383 (center is 8192)
+            shift = origValue - 8192
+            newValue = 8192 + round(shift / 5.5)
+            velocity, pitch = divmod(newValue, 128)
+
+        # Palm mutes are on a separate channel
+        if meta.get("palmMute"):
+            channel = 3
+
+        # Harmonics are on a separate channel, and an octave too high
+        if meta.get("harmonic"):
+            channel = 13
+            if code in (events.NOTE_ON, events.NOTE_OFF):
+                pitch -= 12
+
+        row = (code, delta, channel, pitch, velocity, meta)
+
+        # Vibrato requires mod wheel events before and after this one
+        if code == events.NOTE_ON:
+            if meta.get("vibrato"):
+                modulation = 64
+                self.priorVibrato = True
+            elif self.priorVibrato:
+                modulation = 0
+                self.priorVibrato = False
+            else:
+                return (row,)
+
+            return ((events.CONTROLLER_CHANGE, 0, 1, MOD_WHEEL, modulation, meta),
+                    (events.DELTA_TIME, 0, None, None, None, meta),
+                    row)
+
+        return (row,)
+
+    def process(self, buffer):
+        # The same, over a whole buffer's columns (the scheduler fuses map
+        # into its pass instead; tests/test_postprocess.py checks both write
+        # the same bytes)
+        c = buffer.columns
+        types, channels = c["type"], c["channel"]
+        pitches, velocities = c["data1"], c["data2"]
+
+        for row, code in enumerate(types):
+            if code == events.PITCH_BEND:
+                origValue = velocities[row] * 128 + pitches[row]
+                shift = origValue - 8192
+                newValue = 8192 + round(shift / 5.5)
+                velocities[row], pitches[row] = divmod(newValue, 128)
+
+        for row, palmMute in enumerate(buffer.rowMeta("palmMute")):
+            if palmMute:
+                channels[row] = 3
+
+        for row, harmonic in enumerate(buffer.rowMeta("harmonic")):
+            if harmonic:
+                channels[row] = 13
+                if types[row] in (events.NOTE_ON, events.NOTE_OFF):
+                    pitches[row] -= 12
+
+        vibrato = buffer.metaTable.flags("vibrato")
+        metas = c["meta"]
+        insertions = {}
+        for row, code in enumerate(types):
+            if code == events.NOTE_ON:
+                if vibrato[metas[row]]:
+                    modulation = 64
+                    self.priorVibrato = True
+                elif self.priorVibrato:
+                    modulation = 0
+                    self.priorVibrato = False
+                else:
+                    continue
+
+                meta = buffer.metaTable[metas[row]]
+                insertions[row] = [
+                    (events.CONTROLLER_CHANGE, 0, 1, MOD_WHEEL, modulation, meta),
+                    (events.DELTA_TIME, 0, None, None, None, meta),
+                ]
+
+        if insertions:
+            buffer = buffer.insertRows(insertions)
+
+        return buffer
@@ -0,0 +1,161 @@
+import io
+
+from util import events
+from util.events import EventBuffer
+
+"""
+Runs a chain of postprocessors over a part's events in as few passes as
+possible.
+
+Postprocessors can declare their work as:
+
+- a streaming `map(row)`, returning the rows that replace the given one
+  (any number of them), in order, and optionally `flush()`, returning the
+  rows to append once every row has been mapped;
+- a reduction: `reduce(row)` is called for every row, and once all have
+  been seen, `finalize(row)` returns new data bytes for each row whose type
+  is in the postprocessor's FINALIZED_TYPES (e.g. Normalize's velocities);
+- or anything else, through `process(buffer)` or `run(eventsAndMeta)`.
+
+Consecutive maps, and a reduction following them, are fused into a single
+traversal. When that traversal is the last one, rows are encoded and
+written out as they come out of it, and finalized data bytes are patched
+into the written track afterwards. From the part's notes to the file, rows
+then stream through a measure at a time, though the rows of the measures
+compiled most recently are kept as templates for their repeats (a bounded
+number of them, see transform.MeasureTemplates). Anything that can't be
+fused is a barrier, run over a materialized EventBuffer.
+"""
+
+class Fused:
+    def __init__(self):
+        self.maps = []
+        self.reducer = None
+
+    def stream(self, rows):
+        maps = [processor.map for processor in self.maps]
+        reduce = self.reducer.reduce if self.reducer else None
+
+        for row in rows:
+            pending = (row,)
+            for mapRow in maps:
+                pending = [mapped for row in pending for mapped in mapRow(row)]
+            for row in pending:
+                if reduce:
+                    reduce(row)
+                yield row
+
+        # Whatever a map held back goes through the maps after it
+        for index, processor in enumerate(self.maps):
+            if not hasattr(processor, "flush"):
+                continue
+            pending = processor.flush()
+            for mapRow in maps[index + 1:]:
+                pending = [mapped for row in pending for mapped in mapRow(row)]
+            for row in pending:
+                if reduce:
+                    reduce(row)
+                yield row
+
+    def materialize(self, rows):
+        rows = list(self.stream(rows))
+        if self.reducer:
+            rows = [_finalize(self.reducer, row) for row in rows]
+        return rows
+
+    def write(self, rows, output, runningStatus=False):
+        if self.reducer:
+            events.writeChunk(self.stream(rows), output, runningStatus=runningStatus,
+                              patchTypes=self.reducer.FINALIZED_TYPES,
+                              finalize=self.reducer.finalize)
+        else:
+            events.writeChunk(self.stream(rows), output, runningStatus=runningStatus)
+
+class Barrier:
+    def __init__(self, processor):
+        self.processor = processor
+
+    def materialize(self, rows):
+        buffer = EventBuffer.fromRows(rows)
+        if hasattr(self.processor, "process"):
+            buffer = self.processor.process(buffer)
+        else:
+            buffer = EventBuffer.fromEventsAndMeta(self.processor.run(buffer.toEventsAndMeta()))
+        return buffer.rows()
+
+    def write(self, rows, output, runningStatus=False):
+        events.writeChunk(self.materialize(rows), output, runningStatus=runningStatus)
+
+def _finalize(reducer, row):
+    if row[events.TYPE] not in reducer.FINALIZED_TYPES:
+        return row
+    data1, data2 = reducer.finalize(row)
+    return row[:events.DATA1] + (data1, data2) + row[events.META:]
+
+def _declares(processor, name):
+    # Methods BasePostprocessor provides as fallbacks don't count
+    from postprocess.base import BasePostprocessor
+
+    method = getattr(type(processor), name, None)
+    return method is not None and method is not getattr(BasePostprocessor, name, None)
+
+def plan(processors):
+    """
+    Group postprocessor instances into Fused and Barrier stages.
+    """
+    stages = []
+    current = None
+
+    for processor in processors:
+        if _declares(processor, "map"):
+            if current is None or current.reducer:
+                current = Fused()
+                stages.append(current)
+            current.maps.append(processor)
+        elif _declares(processor, "reduce"):
+            if current is None or current.reducer:
+                current = Fused()
+                stages.append(current)
+            current.reducer = processor
+        elif _declares(processor, "process") or _declares(processor, "run"):
+            current = None
+            stages.append(Barrier(processor))
+
+    return stages
+
+def run(postprocs, rows):
+    """
+    Rows, after every postprocessor class in `postprocs`.
+    """
+    for stage in plan([processor() for processor in postprocs]):
+        rows = stage.materialize(rows)
+    return rows
+
+def write(postprocs, rows, output, runningStatus=False, profiler=None):
+    """
+    Write the MTrk chunk for rows, after every postprocessor class in
+    `postprocs`, to the seekable binary file `output`; the last stage
+    streams straight into it.
+
+    With a `profiler` (see util.stages), each postprocessor's work is timed
+    as a stage of its own.
+    """
+    processors = [processor() for processor in postprocs]
+    if profiler is not None:
+        processors = [profiler.instrument(processor) for processor in processors]
+    stages = plan(processors)
+    if not stages:
+        events.writeChunk(rows, output, runningStatus=runningStatus)
+        return
+
+    for stage in stages[:-1]:
+        rows = stage.materialize(rows)
+    stages[-1].write(rows, output, runningStatus=runningStatus)
+
+def render(postprocs, rows, runningStatus=False):
+    """
+    The MTrk chunk for rows, after every postprocessor class in `postprocs`.
+    """
+    output = io.BytesIO()
+    write(postprocs, rows, output, runningStatus=runningStatus)
+    return output.getvalue()
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+import io
+
+import pytest
+
+from benchmark import generate
+
+"""
+Shared fixtures: the synthetic score of each benchmark tier (see
+benchmark.generate), converted as far as event rows. Tiers are cut down to
+32 measures, which keeps every kind of markup they generate.
+"""
+
+MEASURES = 32
+
+@pytest.fixture(scope="session", params=sorted(generate.TIERS))
+def tier(request):
+    """
+    The tier's compact score and its distinct parts' event rows.
+    """
+    music21 = pytest.importorskip("music21")
+    from util import convert
+    from util import extract
+    from util import gp7
+    from util import score
+    from util import transform
+
+    shape = generate.TIERS[request.param]
+    data = generate.generate(shape._replace(measures=min(shape.measures, MEASURES)))
+    gp7Index = gp7.GP7Index()
+    markup = extract.standardizeExpressions(io.BytesIO(data), io.BytesIO(), gp7Index=gp7Index)
+    compact = score.compactScore(music21.converter.parseData(markup.getvalue(), format="musicxml"),
+                                 gp7Index=gp7Index)
+    partRows = [list(transform.createRows(part, track))
+                for track, part in enumerate(convert.distinctParts(compact), 1)]
+    return compact, partRows
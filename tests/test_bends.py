@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from util import bends
+from util import events
+from util import midi
+from util import transform
+
+"""
+A bend lasts exactly as long as its note, so the events after it keep their
+ticks, whatever the bend resolution and thinning.
+"""
+
+# Four segments of 256 ticks fall 3 ticks short of the note
+POINTS = ("0", "1", "2", "1", "0")
+DURATION = 1027
+
+@pytest.mark.parametrize("resolution", [bends.DEFAULT_RESOLUTION, 32])
+@pytest.mark.parametrize("thin", [False, True])
+def test_bend_lasts_its_duration(resolution, thin):
+    steps = bends.render(POINTS, DURATION, resolution, thin)
+    assert sum(delta for delta, lsb, msb in steps) == DURATION
+    assert all(delta >= 0 for delta, lsb, msb in steps)
+    assert steps[-1][1:] == bends.pitchBend(0)
+
+@pytest.mark.parametrize("resolution", [bends.DEFAULT_RESOLUTION, 32])
+@pytest.mark.parametrize("thin", [False, True])
+def test_next_event_keeps_its_tick(resolution, thin):
+    following = midi.MidiEvent(type="NOTE_ON", channel=1)
+    following.pitch = 64
+    following.velocity = 90
+    track = transform._createBend(POINTS, DURATION, 1, resolution, thin) + [
+        midi.DeltaTime(time=0), following]
+    rows = [events.rowFromEvent(event, {}) for event in track]
+
+    for chunk in (midi.encodeTrack(track), events.EventBuffer.fromRows(rows).encode()):
+        decoded = midi.decodeTrack(chunk)
+        assert decoded[-1] == (DURATION, events.NOTE_ON, 1, 64, 90)
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from benchmark import generate
+from util import cache
+
+"""
+The conversion cache stays within its size limit without listing itself on
+every write, and a conversion hashes its input file only once.
+"""
+
+def writeBytes(size):
+    def write(path):
+        with open(path, "wb") as entry:
+            entry.write(b"x" * size)
+    return write
+
+def test_writes_are_evicted_down_to_the_limit(tmp_path, monkeypatch):
+    conversionCache = cache.ConversionCache(directory=str(tmp_path), maxBytes=250)
+    listings = []
+    entries = conversionCache.entries
+    monkeypatch.setattr(conversionCache, "entries", lambda: listings.append(1) or entries())
+
+    for index in range(5):
+        conversionCache.put("entry{}".format(index), writeBytes(100))
+        os.utime(conversionCache.path("entry{}".format(index)), (index, index))
+    # Rewriting an entry doesn't count it twice
+    conversionCache.put("entry4", writeBytes(100))
+
+    # Once for the running total, and once per eviction
+    assert len(listings) == 4
+    assert sorted(os.listdir(str(tmp_path))) == ["entry3.cache", "entry4.cache"]
+    assert conversionCache.total == conversionCache.size() == 200
+
+def test_a_conversion_hashes_its_input_once(tmp_path, monkeypatch):
+    pytest.importorskip("music21")
+    from util import convert
+
+    filename = str(tmp_path / "small.xml")
+    with open(filename, "wb") as xml:
+        xml.write(generate.generate(generate.TIERS["small"]._replace(measures=8)))
+    conversionCache = convert.createCache(str(tmp_path / "cache"))
+
+    hashed = []
+    hashFile = cache.hashFile
+    monkeypatch.setattr(cache, "hashFile", lambda name: hashed.append(name) or hashFile(name))
+
+    convert.convertFile(filename, (), conversionCache=conversionCache)
+    assert hashed.count(filename) == 1
+    del hashed[:]
+    assert convert.convertFile(filename, (), conversionCache=conversionCache)
+    assert hashed.count(filename) == 1
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+import io
+
+import pytest
+
+from benchmark import generate
+from util import extract
+
+"""
+util.extract.standardizeExpressions must hand music21 exactly the markup
+the BeautifulSoup implementation it replaced did (benchmark/legacy.py), on
+Guitar Pro-style exports and on the corners of XML serialization, and
+never resolve external entities.
+
+    $ python -m pytest tests
+"""
+
+# The baseline is kept as it was, deprecated BeautifulSoup calls included
+pytestmark = pytest.mark.filterwarnings("ignore::DeprecationWarning")
+
+@pytest.fixture
+def legacy():
+    return pytest.importorskip("benchmark.legacy", reason="the baseline needs BeautifulSoup")
+
+PART_LIST = ('<part-list><score-part id="P1"><part-name>Lead</part-name></score-part>'
+             '</part-list>')
+
+NOTE = ('<note><pitch><step>E</step><octave>4</octave></pitch><duration>2</duration>'
+        '<type>quarter</type></note>')
+
+def document(measure, prolog="", root='<score-partwise version="3.0">', epilog=""):
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n{}{}\n  {}\n  <part id="P1">\n'
+            '    <measure number="1">{}</measure>\n  </part>\n</score-partwise>{}\n').format(
+                prolog, root, PART_LIST, measure, epilog).encode("utf-8")
+
+FIXTURES = {
+    "prolog comments": document(NOTE, prolog="<!-- Guitar Pro 7 -->\n<!-- second -->\n",
+                                epilog="\n<!-- epilog -->"),
+    "doctype": document(NOTE, prolog='<!DOCTYPE score-partwise PUBLIC "-//Recordare//DTD '
+                                     'MusicXML 3.0 Partwise//EN" '
+                                     '"http://www.musicxml.org/dtds/partwise.dtd">\n'),
+    "CDATA": document("<![CDATA[a < b && c]]>" + NOTE + "<words><![CDATA[<riff>]]></words>"),
+    "attribute quoting": document(
+        '<direction placement=\'above\' text="say &quot;hi&quot;" other="it\'s" '
+        'both="&quot;it\'s&quot;" amp="a &amp; b &lt; c"><direction-type><words>'
+        'x &gt; y</words></direction-type></direction>'),
+    "empty elements": document('<attributes></attributes><barline location="left"/>'
+                               '<print new-system="yes"></print>' + NOTE),
+    "whitespace": document("\n      \t  " + NOTE + "   \n\n   <backup> <duration>2</duration>"
+                           "</backup>  "),
+    "namespaces": document(NOTE, root='<score-partwise version="3.0" '
+                                      'xmlns:xlink="http://www.w3.org/1999/xlink">').replace(
+        b"<measure", b'<credit xlink:href="http://example.com"/><measure', 1),
+    "comments and processing instructions": document(
+        NOTE.replace("</duration>", "</duration><!-- tied --><?other data?><?bare?>")),
+    "repeats": document('<barline location="left"><repeat direction="forward" times="2"/>'
+                        '</barline>' + NOTE + '<barline location="right">'
+                        '<repeat direction="backward" times="2"/></barline>'),
+    "dynamics": document(NOTE.replace("</note>", "<notations><dynamics><ff/></dynamics>"
+                                                 "</notations></note>") +
+                         NOTE.replace("</note>", "<notations><dynamics/></notations></note>")),
+    "palm mutes": document(NOTE.replace("</note>", "<play><mute>palm</mute></play></note>") +
+                           NOTE.replace("</note>", "<notations><technical><string>6</string>"
+                                                   "</technical></notations><play/></note>")),
+    "unpitched": document('<note><unpitched><display-step>C</display-step>'
+                          '<display-octave>5</display-octave></unpitched>'
+                          '<duration>2</duration><instrument id="P1-I39"/></note>'),
+    "GP7 effects": document(
+        NOTE.replace("</note>", "<?GP7 <root><vibrato/></root>?></note>") +
+        NOTE.replace("</note>", "<notations><technical><fret>3</fret></technical></notations>"
+                                "<?GP7 <root><letring/><vibrato/></root>?></note>") +
+        NOTE.replace("</note>", "<?GP7 <root><harmonic/></root>?></note>")),
+    "bends": document(
+        NOTE.replace("</note>", "<notations><technical><bend><bend-alter>2</bend-alter></bend>"
+                                "<bend><bend-alter>0</bend-alter></bend></technical>"
+                                "</notations></note>") +
+        NOTE.replace("</note>", "<notations><technical><bend><bend-alter>1</bend-alter>"
+                                "<pre-bend/></bend><bend><bend-alter>0</bend-alter></bend>"
+                                "</technical></notations></note>")),
+}
+
+def standardized(data):
+    return extract.standardizeExpressions(io.BytesIO(data), io.BytesIO()).getvalue().decode("utf-8")
+
+@pytest.mark.parametrize("name", sorted(FIXTURES))
+def test_matches_beautifulsoup(legacy, name):
+    data = FIXTURES[name]
+    assert standardized(data) == legacy.normalize(data)
+
+@pytest.mark.parametrize("tier", sorted(generate.TIERS))
+def test_matches_beautifulsoup_on_generated_scores(legacy, tier):
+    data = generate.generate(generate.TIERS[tier]._replace(measures=16), seed=7)
+    assert standardized(data) == legacy.normalize(data)
+
+def test_external_entities_are_not_resolved(tmp_path):
+    secret = tmp_path / "secret.txt"
+    secret.write_text("do not read")
+    data = document("<direction><direction-type><words>&x;</words></direction-type></direction>",
+                    prolog='<!DOCTYPE score-partwise [<!ENTITY x SYSTEM "{}">]>\n'.format(
+                        secret.as_uri())).replace(b"Lead", b"Lead &x;")
+    assert "do not read" not in standardized(data)
+    assert [name for partId, name, digest in extract.hashParts(io.BytesIO(data))] == ["Lead "]
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import io
+import re
+
+import pytest
+
+from util import extract
+from util import gp7
+from util import score
+
+"""
+GP7 effects are indexed by note position while the MusicXML is normalized,
+and read back onto the right notes of the compact score.
+"""
+
+music21 = pytest.importorskip("music21")
+
+VIBRATO = "<?GP7 <root><vibrato/></root>?>"
+LET_RING = "<?GP7 <root><letring/></root>?>"
+
+def note(step, duration=2, extra="", effect="", voice=1):
+    return ("<note>{}<pitch><step>{}</step><octave>4</octave></pitch><duration>{}</duration>"
+            "<voice>{}</voice><type>{}</type>{}</note>").format(
+                extra, step, duration, voice, "quarter" if duration == 2 else "half", effect)
+
+# Measure 2 has a chord, a grace note and a second voice after a backup,
+# and none of its notes has a <technical> to carry an indication
+MEASURES = [
+    note("C") + note("D", effect=VIBRATO) + note("E", duration=4),
+    (note("C", effect=LET_RING) + note("E", extra="<chord/>") +
+     "<note><grace/><pitch><step>F</step><octave>4</octave></pitch><type>eighth</type></note>" +
+     note("G", effect=VIBRATO) + note("A", duration=4) +
+     "<backup><duration>8</duration></backup>" +
+     note("C", duration=4, voice=2) + note("B", duration=4, effect=VIBRATO, voice=2)),
+]
+
+DOCUMENT = ('<?xml version="1.0" encoding="UTF-8"?>\n<score-partwise version="3.0">'
+            '<part-list><score-part id="P1"><part-name>Lead</part-name></score-part></part-list>'
+            '<part id="P1">{}</part></score-partwise>').format("".join(
+                '<measure number="{}">{}{}</measure>'.format(
+                    number, "<attributes><divisions>2</divisions></attributes>"
+                    if number == 1 else "", content)
+                for number, content in enumerate(MEASURES, 1))).encode("utf-8")
+
+@pytest.mark.parametrize("voices", [True, False])
+def test_effects_reach_their_notes(voices):
+    document = DOCUMENT if voices else re.sub(b"<voice>.</voice>", b"", DOCUMENT)
+    index = gp7.GP7Index()
+    markup = extract.standardizeExpressions(io.BytesIO(document), io.BytesIO(), gp7Index=index)
+    # Notes are numbered by start: the second voice's first note comes
+    # second, and the grace note before the note it leads to
+    assert sorted(index.withEffect("vibrato")) == [("P1", "1", 1), ("P1", "2", 3), ("P1", "2", 5)]
+    assert index.withEffect("letring") == [("P1", "2", 0)]
+
+    parsed = music21.converter.parseData(markup.getvalue(), format="musicxml")
+    compact = score.compactScore(parsed, gp7Index=index)
+    effects = sorted((note.measure, note.pitches, annotation[1:])
+                     for note in compact.parts[0].notes()
+                     for annotation in note.annotations if annotation[:1] == score.GP7)
+    assert effects == [(0.0, (62,), "vibrato"), (4.0, (60, 64), "letring"),
+                       (4.0, (67,), "vibrato"), (4.0, (71,), "vibrato")]
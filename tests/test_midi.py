@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from util import events
+from util import midi
+
+"""
+midi.encodeTrack writes the bytes music21's MidiTrack.getBytes did, on
+tracks music21 could write. (It doesn't on tracks where music21 skipped
+an event that can't be encoded, see encodeTrack: bend rendering is what
+used to produce those.)
+"""
+
+def music21Track(midiEvents, index):
+    music21 = pytest.importorskip("music21")
+
+    track = music21.midi.MidiTrack(index)
+    for event in midiEvents:
+        if event.type == "DeltaTime":
+            track.events.append(music21.midi.DeltaTime(track, time=event.time))
+            continue
+
+        copy = music21.midi.MidiEvent(track, type=event.type, channel=event.channel)
+        # music21's data is its first parameter
+        if event.data is not None:
+            copy.data = event.data
+        else:
+            copy._parameter1 = event._parameter1
+            copy._parameter2 = event._parameter2
+        track.events.append(copy)
+    return track
+
+def test_tracks_without_bends_are_written_as_music21_wrote_them(tier):
+    compact, partRows = tier
+    compared = 0
+    for index, rows in enumerate(partRows, 1):
+        if any(row[0] == events.PITCH_BEND for row in rows):
+            continue
+        midiEvents = [events.eventFromRow(row) for row in rows]
+        assert midi.encodeTrack(midiEvents) == music21Track(midiEvents, index).getBytes()
+        compared += 1
+    assert compared
+
+@pytest.mark.parametrize("data", [None, -1, 0x100])
+def test_both_encoders_skip_the_same_events(data):
+    rows = [
+        (events.DELTA_TIME, 10, None, None, None, 0),
+        (events.NOTE_ON, 0, 1, 60, data, 0),
+        (events.DELTA_TIME, 20, None, None, None, 0),
+        (midi.CHANNEL_VOICE_MESSAGES["PROGRAM_CHANGE"], 0, 1, data, None, 0),
+        (events.DELTA_TIME, 30, None, None, None, 0),
+        (events.NOTE_ON, 0, 1, 60, 90, 0),
+    ]
+    assert not any(events.encodable(row) for row in rows[1:4:2])
+    body, patches = events.encodeRows(rows)
+    assert events.chunk(body) == midi.encodeTrack(events.eventFromRow(row) for row in rows)
+    assert list(midi.decodeTrack(events.chunk(body))) == [(60, events.NOTE_ON, 1, 60, 90)]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from benchmark.optimize import compare
+from postprocess import postprocessorChain
+
+"""
+The event optimizer (-O) must not change what a player does with a track:
+benchmark.optimize's check, on every part of each benchmark tier.
+"""
+
+@pytest.mark.parametrize("postproc", [None, "realeight", "normalize"])
+def test_optimized_tracks_play_the_same(tier, postproc):
+    from util import convert
+
+    compact, partRows = tier
+    for part in convert.distinctParts(compact):
+        before, after, difference = compare(part, postprocessorChain(postproc))
+        assert difference is None, part.name
+        assert after <= before
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from postprocess import schedule
+from postprocess.normalize import NormalizePostprocessor
+from postprocess.realeight import RealEightPostprocessor
+from util.events import EventBuffer
+
+"""
+The built-in postprocessors implement the same transformation twice: as
+map/reduce, which the converter fuses into a single pass, and column by
+column in process(buffer), which the tuple API goes through too. All three
+paths must write the same bytes.
+"""
+
+CHAINS = {
+    "realeight": (RealEightPostprocessor,),
+    "normalize": (NormalizePostprocessor,),
+    "realeight and normalize": (RealEightPostprocessor, NormalizePostprocessor),
+}
+
+def processed(chain, rows):
+    buffer = EventBuffer.fromRows(rows)
+    for postprocessor in chain:
+        buffer = postprocessor().process(buffer)
+    return buffer.encode()
+
+def ran(chain, rows):
+    eventsAndMeta = EventBuffer.fromRows(rows).toEventsAndMeta()
+    for postprocessor in chain:
+        eventsAndMeta = postprocessor().run(eventsAndMeta)
+    return EventBuffer.fromEventsAndMeta(eventsAndMeta).encode()
+
+@pytest.mark.parametrize("chain", sorted(CHAINS))
+def test_every_path_writes_the_same_bytes(tier, chain):
+    compact, partRows = tier
+    for rows in partRows:
+        fused = schedule.render(CHAINS[chain], rows)
+        assert processed(CHAINS[chain], rows) == fused
+        assert ran(CHAINS[chain], rows) == fused
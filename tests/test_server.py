@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+import http.client
+import json
+import threading
+
+import pytest
+
+from util import server
+
+"""
+Requests the conversion server turns away before converting anything, so
+no ConversionPool is needed.
+"""
+
+@pytest.fixture
+def port():
+    httpServer = server.createServer(None, port=0)
+    thread = threading.Thread(target=httpServer.serve_forever)
+    thread.start()
+    yield httpServer.server_address[1]
+    httpServer.shutdown()
+    thread.join()
+    httpServer.server_close()
+
+def post(port, contentLength):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    try:
+        connection.putrequest("POST", "/convert")
+        if contentLength is not None:
+            connection.putheader("Content-Length", contentLength)
+        connection.endheaders()
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+@pytest.mark.parametrize("contentLength, status", [
+    (None, 411),
+    ("lots", 400),
+    ("-1", 400),
+])
+def test_bad_content_lengths_are_turned_away(port, contentLength, status):
+    answer, body = post(port, contentLength)
+    assert answer == status
+    assert "Content-Length" in body["error"]
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import glob
+import os
+import os.path
+import time
+import traceback
+
+"""
+Batch conversion: many MusicXML files at once, spread over a pool of
+worker processes that each import music21 at most once.
+"""
+
+XML_PATTERNS = ("*.xml", "*.musicxml")
+
+Result = namedtuple("Result", ["filename", "parts", "seconds", "error"])
+
+def isBatch(targets, manifest=None):
+    """
+    Anything other than a single file name is a batch.
+    """
+    if manifest or len(targets) != 1:
+        return True
+    return os.path.isdir(targets[0]) or glob.has_magic(targets[0])
+
+def readManifest(manifest):
+    """
+    A manifest lists one file, directory or glob per line; blank lines and
+    #-comments are ignored, and relative paths are relative to the manifest.
+    """
+    base = os.path.dirname(os.path.abspath(manifest))
+    entries = []
+    with open(manifest, "r") as manifestFile:
+        for line in manifestFile:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                entries.append(os.path.join(base, os.path.expanduser(line)))
+    return entries
+
+def collectFiles(targets, manifest=None):
+    """
+    Expand directories, globs and manifest entries into a sorted,
+    de-duplicated list of XML file names. Targets that match nothing are
+    returned as-is, so that they are reported as failures.
+    """
+    entries = list(targets)
+    if manifest:
+        entries.extend(readManifest(manifest))
+
+    filenames = []
+    for entry in entries:
+        if os.path.isdir(entry):
+            matches = []
+            for pattern in XML_PATTERNS:
+                matches.extend(glob.glob(os.path.join(entry, pattern)))
+        elif glob.has_magic(entry):
+            matches = [match for match in glob.glob(entry, recursive=True)
+                       if os.path.isfile(match)]
+        else:
+            matches = [entry]
+        filenames.extend(sorted(matches))
+
+    seen = set()
+    unique = []
+    for filename in filenames:
+        key = os.path.abspath(filename)
+        if key not in seen:
+            seen.add(key)
+            unique.append(filename)
+    return unique
+
+def _initWorker():
+    # music21 itself is imported on a worker's first real conversion (and
+    # then kept), so files that are already up to date never pay for it.
+    import util.convert
+
+def _convertOne(filename, postprocs, force, jobs, conversionCache, renderOptions, parts):
+    from util import convert
+
+    start = time.perf_counter()
+    try:
+        if not os.path.isfile(filename):
+            raise FileNotFoundError("{} is not a valid file location".format(filename))
+        parts = convert.convertFile(filename, postprocs, force=force, jobs=jobs,
+                                    conversionCache=conversionCache,
+                                    renderOptions=renderOptions, parts=parts)
+        return Result(filename, parts, time.perf_counter() - start, None)
+    except Exception:
+        return Result(filename, [], time.perf_counter() - start,
+                      traceback.format_exc())
+
+def convertBatch(filenames, postprocs, force=False, jobs=1, workers=None,
+                 conversionCache=None, report=None, renderOptions=None, parts=None):
+    """
+    Convert every file in `filenames` in a process pool (one worker per core
+    by default), each of which renders parts with `jobs` processes of its
+    own. A failing file never aborts the run; `report` is called with
+    each Result as it completes. Returns the Results in input order.
+    """
+    workers = workers or os.cpu_count() or 1
+    results = {}
+
+    with ProcessPoolExecutor(max_workers=min(workers, max(len(filenames), 1)),
+                             initializer=_initWorker) as executor:
+        futures = {executor.submit(_convertOne, filename, postprocs, force, jobs,
+                                   conversionCache, renderOptions, parts): filename
+                   for filename in filenames}
+        for future in as_completed(futures):
+            filename = futures[future]
+            try:
+                result = future.result()
+            except Exception:
+                # e.g. a worker that died outright
+                result = Result(filename, [], 0.0, traceback.format_exc())
+            results[filename] = result
+            if report:
+                report(result)
+
+    return [results[filename] for filename in filenames]
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+from functools import lru_cache
+import math
+
+from util import midi
+
+"""
+Bend rendering: turning Guitar Pro bend points into timed pitch bend values.
+
+All bends are rendered with the same algorithm: for each equal-length
+segment of the desired duration, the first half of that segment is curved
+via a cosine function, in steps of `resolution` ticks, and the second half
+holds the target bend value.
+
+Tabs reuse the same few bend shapes at a handful of durations, so both the
+cosine easing curves and whole rendered bends are memoized.
+"""
+
+DEFAULT_RESOLUTION = 64
+EASING_CACHE_SIZE = 256
+PITCH_BEND_CACHE_SIZE = 4096
+BEND_CACHE_SIZE = 1024
+
+@lru_cache(maxsize=EASING_CACHE_SIZE)
+def easing(increment):
+    """
+    The cosine easing factors for a curve of `increment` steps, for rising
+    and for falling bends.
+    """
+    rising = []
+    falling = []
+    for step in range(increment):
+        factor = step / increment
+        rising.append(1 - math.cos(1.5708 * factor))
+        falling.append(math.cos(1.5708 * factor))
+    return tuple(rising), tuple(falling)
+
+@lru_cache(maxsize=PITCH_BEND_CACHE_SIZE)
+def pitchBend(cents):
+    """
+    The two data bytes of a pitch bend of `cents` (see midi.MidiEvent.setPitchBend).
+    """
+    event = midi.MidiEvent()
+    event.setPitchBend(cents)
+    return event._parameter1, event._parameter2
+
+def _thin(steps):
+    """
+    Drop steps whose pitch bend value doesn't change, folding their delta
+    times into the next step that is kept. The last step is always kept.
+    """
+    thinned = []
+    pending = 0
+    last = None
+    for index, (delta, value) in enumerate(steps):
+        pending += delta
+        if value != last or index == len(steps) - 1:
+            thinned.append((pending, value))
+            pending = 0
+            last = value
+    return thinned
+
+@lru_cache(maxsize=BEND_CACHE_SIZE)
+def render(points, duration, resolution=DEFAULT_RESOLUTION, thin=False):
+    """
+    A bend as a tuple of (delta time, LSB, MSB) pitch bend steps, given its
+    points (in semitones, as strings) and its duration in ticks. The bend
+    is reset to zero at the end, `duration` ticks after it started.
+
+    With `thin`, steps that wouldn't change the pitch bend value are
+    dropped.
+    """
+    steps = []
+
+    valueCount = len(points) - 1
+    segmentDuration = int(duration / valueCount)
+    timeTally = 0
+    index = 0
+
+    while index < valueCount:
+        start = float(points[index])
+        end = float(points[index + 1])
+        bendRange = end - start
+        halfSegmentDuration = round(segmentDuration / 2)
+        increment = int(halfSegmentDuration / resolution)
+        rising, falling = easing(increment)
+        factors = falling if bendRange < 0 else rising
+        subTimeTally = 0
+        actual = 0
+        for factor in factors:
+            bendValue = factor * bendRange
+            actual = round(100 * (start + bendValue))
+            steps.append((resolution, pitchBend(actual)))
+
+            subTimeTally += resolution
+            timeTally += resolution
+
+        remainder = segmentDuration - subTimeTally
+        steps.append((remainder, pitchBend(actual)))
+        timeTally += remainder
+
+        index += 1
+
+    if thin:
+        steps = _thin(steps)
+
+    # The bend holds its last value to the end of the note, then resets
+    steps.append((max(duration - timeTally, 0), pitchBend(0)))
+
+    return tuple((delta, lsb, msb) for delta, (lsb, msb) in steps)
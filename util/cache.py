@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import os.path
+import re
+import tempfile
+
+"""
+A bounded, on-disk cache for the expensive parts of a conversion, shared
+by every converter process on the machine.
+
+Entries are keyed by the hash of the input file and a version string, so
+that changing the extraction logic invalidates them. Writes are atomic, and
+the least recently used entries are evicted once the cache grows past its
+size limit. Each process keeps a running total of the cache's size, from
+its own writes, and only lists the whole cache again when that total says
+it is over the limit.
+"""
+
+DEFAULT_DIRECTORY = os.path.join(tempfile.gettempdir(), "gpXmlMidi")
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+HASH_CHUNK_BYTES = 1024 * 1024
+ENTRY_SUFFIX = ".cache"
+
+def hashFile(filename):
+    """
+    SHA-1 of a file's contents, read in chunks rather than all at once.
+    """
+    h = hashlib.sha1()
+    with open(filename, "rb") as source:
+        for chunk in iter(lambda: source.read(HASH_CHUNK_BYTES), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def writeAtomically(filename, write):
+    """
+    Call `write` with a temporary path next to `filename`, then move the
+    result into place, so that concurrent readers never see a partial file.
+    """
+    directory, base = os.path.split(filename)
+    handle, temporary = tempfile.mkstemp(prefix=".{}.".format(base),
+                                         suffix=".tmp", dir=directory or None)
+    os.close(handle)
+    try:
+        write(temporary)
+        os.replace(temporary, filename)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+class ConversionCache:
+    def __init__(self, directory=None, maxBytes=None, version=""):
+        self.directory = directory or DEFAULT_DIRECTORY
+        self.maxBytes = DEFAULT_MAX_BYTES if maxBytes is None else maxBytes
+        self.version = version
+        self.stats = {"hits": 0, "misses": 0, "errors": 0, "writes": 0,
+                      "evictions": 0}
+        # The size of the cache, as of the last listing plus the writes
+        # since (None until the first write)
+        self.total = None
+
+    def key(self, filename, variant=""):
+        """
+        The cache key for an input file: its name (for the benefit of
+        humans), the hash of its contents, and the cache version.
+        """
+        prefix = os.path.splitext(os.path.basename(filename))[0]
+        key = "__".join([prefix, hashFile(filename), "v{}".format(self.version)])
+        return self.subkey(key, variant) if variant else key
+
+    def subkey(self, key, variant):
+        """
+        The key for a variant of an entry (e.g. one of its parts), without
+        hashing the input file again.
+        """
+        return "__".join([key, re.sub(r"[^\w.-]", "_", variant)])
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    def get(self, key, read):
+        """
+        Return `read(path)` for a cached entry, or None on a miss. Entries
+        that can't be read are counted as errors, and removed.
+        """
+        path = self.path(key)
+        try:
+            value = read(path)
+        except FileNotFoundError:
+            self.stats["misses"] += 1
+            return None
+        except Exception:
+            self.stats["errors"] += 1
+            self.stats["misses"] += 1
+            self.discard(key)
+            return None
+
+        self.stats["hits"] += 1
+        try:
+            # Modification time doubles as the LRU clock
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, write):
+        """
+        Store an entry via `write(path)`, then trim the cache to size if it
+        has grown past it.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        if self.total is None:
+            self.total = self.size()
+
+        path = self.path(key)
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        writeAtomically(path, write)
+        self.stats["writes"] += 1
+
+        self.total += os.path.getsize(path) - replaced
+        if self.total > self.maxBytes:
+            self.evict()
+
+    def discard(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def entries(self):
+        """
+        All entries as (path, size, last use) tuples, least recent first.
+        """
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return entries
+
+        for name in names:
+            if not name.endswith(ENTRY_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                info = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, info.st_size, info.st_mtime))
+
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def size(self):
+        return sum(size for path, size, used in self.entries())
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for path, size, used in entries)
+        for path, size, used in entries:
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+                self.stats["evictions"] += 1
+            except OSError:
+                pass
+            total -= size
+        self.total = total
+
+    def summary(self):
+        entries = self.entries()
+        total = sum(size for path, size, used in entries)
+        return ("Cache {}: {hits} hits, {misses} misses, {errors} errors, "
+                "{evictions} evictions; {count} entries, {used:.1f} of {limit:.1f} MB"
+                .format(self.directory, count=len(entries),
+                        used=total / 1048576, limit=self.maxBytes / 1048576,
+                        **self.stats))
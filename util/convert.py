@@ -0,0 +1,532 @@
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+import io
+import json
+import os.path
+
+from postprocess import schedule
+from util import bends
+from util import cache
+from util import extract
+from util import midi
+from util import outputs
+from util import score
+from util import stages
+from util import transform
+
+"""
+The conversion pipeline proper: Guitar Pro MusicXML in, one MIDI file per
+track out. This is shared by the `converter` command line, in both its
+single-file and batch modes.
+
+music21 and halo are only imported once there is work to do, so that a
+rerun whose outputs are already up to date finishes in milliseconds.
+"""
+
+TICKS_PER_QUARTER_NOTE = midi.TICKS_PER_QUARTER_NOTE
+
+# Bump whenever the format of cached scores changes
+CACHE_FORMAT_VERSION = 7
+
+# Options that change the MIDI output itself. The defaults reproduce the
+# files music21 used to write, byte for byte, one per part; singleFile
+# writes a single file with a track per part instead.
+RenderOptions = namedtuple("RenderOptions", ["runningStatus", "bendResolution", "thinBends",
+                                             "singleFile"])
+DEFAULT_RENDER_OPTIONS = RenderOptions(runningStatus=False,
+                                       bendResolution=bends.DEFAULT_RESOLUTION,
+                                       thinBends=False,
+                                       singleFile=False)
+
+def renderOptionNames(renderOptions):
+    """
+    Non-default render options, as recorded in output manifests.
+    """
+    names = []
+    if renderOptions.runningStatus:
+        names.append("running-status")
+    if renderOptions.bendResolution != DEFAULT_RENDER_OPTIONS.bendResolution:
+        names.append("bend-resolution={}".format(renderOptions.bendResolution))
+    if renderOptions.thinBends:
+        names.append("thin-bends")
+    if renderOptions.singleFile:
+        names.append("single-file")
+    return names
+
+def outputOptions(renderOptions, parts=None):
+    """
+    Everything besides postprocessors that decides what a conversion
+    writes, as recorded in output manifests.
+    """
+    options = renderOptionNames(renderOptions)
+    if parts:
+        options.append("parts={}".format(",".join(parts)))
+    return options
+
+def spin(text):
+    from halo import Halo
+
+    frames = ["𝄞", "𝄢", "♪", "♫"]
+    spinner = Halo(text=text, animation="marquee",
+                   spinner={"interval": 500, "frames": frames})
+    spinner.start()
+    return spinner
+
+def info(text):
+    from halo import Halo
+
+    Halo(text=text).info()
+
+def createCache(directory=None, maxBytes=None):
+    """
+    The conversion cache, versioned by both its own format and the
+    MusicXML rewrites that precede parsing.
+    """
+    version = "{}.{}".format(CACHE_FORMAT_VERSION, extract.VERSION)
+    return cache.ConversionCache(directory=directory, maxBytes=maxBytes,
+                                 version=version)
+
+PART_LIST_VARIANT = "parts"
+TEMPOS_VARIANT = "tempos"
+
+def _partVariant(partId):
+    return "part-{}".format(partId)
+
+def _readPairs(path):
+    with open(path, "r") as pairsFile:
+        return [tuple(entry) for entry in json.load(pairsFile)]
+
+def _writePairs(pairs):
+    def write(path):
+        with open(path, "w") as pairsFile:
+            json.dump(pairs, pairsFile)
+    return write
+
+def _extract(filename, selection, conversionCache, key, spinner, profiler):
+    """
+    Parse what `selection` leaves of a file (see loadParts), caching each
+    of its parts and, if the selection kept tempo skeletons, the file's
+    tempo boundaries. Returns the (part ID, CompactScore) pairs and the
+    tempo boundaries.
+    """
+    # First things first: we need to annotate the MusicXML file
+    # in ways that Music21 will recognize. This is a single
+    # streaming pass, straight into an in-memory buffer, which also
+    # drops the parts we don't need (or already have).
+    from util import gp7
+
+    gp7Index = gp7.GP7Index()
+    with profiler.stage("normalize XML"):
+        markup = extract.standardizeExpressions(filename, io.BytesIO(), gp7Index=gp7Index,
+                                                selection=selection)
+
+    if spinner:
+        spinner.succeed()
+
+    extracted = []
+    tempos = None
+    if selection.selected() and (selection.tempos or
+                                 any(selection.keeps(partId) for partId, name in selection.partList)):
+        with profiler.stage("import music21"):
+            import music21
+
+        # Now we can proceed with M21 extraction
+        if spinner:
+            spinner = spin("Preparing music data for extraction and transformation")
+
+        with profiler.stage("parse"):
+            parsed = music21.converter.parseData(markup.getvalue(), format="musicxml")
+
+        with profiler.stage("extract"):
+            extracted, tempos = score.compactScores(parsed, profiler=profiler, gp7Index=gp7Index)
+
+        # This is a good place to commit the cachefiles
+        with profiler.stage("cache store"):
+            for partId, compact in extracted:
+                conversionCache.put(conversionCache.subkey(key, _partVariant(partId)),
+                                    compact.save)
+            if selection.tempos:
+                conversionCache.put(conversionCache.subkey(key, TEMPOS_VARIANT),
+                                    _writePairs(tempos))
+
+        if spinner:
+            spinner.succeed()
+
+    with profiler.stage("cache store"):
+        conversionCache.put(conversionCache.subkey(key, PART_LIST_VARIANT),
+                            _writePairs(selection.partList))
+
+    return extracted, tempos
+
+def loadParts(filename, conversionCache, force=False, verbose=False, parts=None,
+              profiler=None, key=None):
+    """
+    Parse a Guitar Pro MusicXML file into compact scores (see util.score),
+    one per MusicXML part, going through the conversion cache whenever
+    possible. Returns them as (part ID, CompactScore) pairs in score order,
+    along with the tempo boundaries of the whole score.
+
+    Only the parts named by `parts` (see extract.selectParts) are loaded;
+    the others are dropped before music21 ever sees them, all but their
+    metronome marks. Each part is cached on its own, along with the file's
+    part list and tempos, so that a later selection only parses the parts
+    that no earlier one did.
+
+    With a `profiler` (see util.stages), each step is timed as a stage.
+    A caller that already has the file's cache `key` can pass it, rather
+    than have the file hashed again.
+    """
+    spinner = None
+    profiler = profiler or stages.NULL_PROFILER
+
+    # To speed up consecutive calls, we try to cache the most
+    # time-intensive work: parsing from XML and into music21
+    if key is None:
+        with profiler.stage("cache lookup"):
+            key = conversionCache.key(filename)
+
+    if verbose:
+        spinner = spin("Fetching {} from cache".format(filename))
+
+    compacts = {}
+    selected = None
+    tempos = None
+    if not force:
+        with profiler.stage("cache lookup"):
+            tempos = conversionCache.get(conversionCache.subkey(key, TEMPOS_VARIANT), _readPairs)
+            partList = conversionCache.get(conversionCache.subkey(key, PART_LIST_VARIANT),
+                                           _readPairs)
+            if partList is not None:
+                selected = extract.selectParts(partList, parts)
+                for partId in selected:
+                    compact = conversionCache.get(
+                        conversionCache.subkey(key, _partVariant(partId)), score.load)
+                    if compact is not None:
+                        compacts[partId] = compact
+
+    if selected is not None and len(compacts) == len(selected) and tempos is not None:
+        if verbose:
+            spinner.succeed()
+    else:
+        if verbose:
+            spinner.text = "Importing and annotating {}".format(filename)
+
+        selection = extract.PartSelection(parts, exclude=compacts, tempos=tempos is None)
+        extracted, extractedTempos = _extract(filename, selection, conversionCache, key,
+                                              spinner, profiler)
+        compacts.update(extracted)
+        if tempos is None:
+            tempos = extractedTempos
+        selected = selection.selected()
+
+    if not selected:
+        raise extract.selectionError(filename, parts)
+
+    return [(partId, compacts[partId]) for partId in selected], tempos
+
+def loadTempos(filename, conversionCache, partIds, key=None):
+    """
+    The tempo boundaries of a whole Guitar Pro MusicXML file, whose parts
+    are `partIds`, going through the conversion cache (under the file's
+    `key`, if already known). Only the parts' tempo skeletons are parsed.
+    """
+    key = key or conversionCache.key(filename)
+    tempos = conversionCache.get(conversionCache.subkey(key, TEMPOS_VARIANT), _readPairs)
+    if tempos is None:
+        selection = extract.PartSelection(exclude=partIds)
+        extracted, tempos = _extract(filename, selection, conversionCache, key, None,
+                                     stages.NULL_PROFILER)
+    return tempos
+
+def loadScore(filename, conversionCache, force=False, verbose=False, parts=None,
+              profiler=None, key=None):
+    """
+    Parse a Guitar Pro MusicXML file into a single compact score (see
+    loadParts).
+    """
+    loaded, tempos = loadParts(filename, conversionCache, force=force, verbose=verbose,
+                               parts=parts, profiler=profiler, key=key)
+    return score.merge((compact for partId, compact in loaded), tempos)
+
+def _partRows(part, verbose, renderOptions, templates):
+    # Part events belong to the file's first track (the tempo track is second)
+    return transform.createRows(part,
+                                1,
+                                verbose=verbose,
+                                bendResolution=renderOptions.bendResolution,
+                                thinBends=renderOptions.thinBends,
+                                templates=templates)
+
+def renderPart(part, postprocs, verbose=False, renderOptions=DEFAULT_RENDER_OPTIONS,
+               templates=None):
+    """
+    Turn a single compact part into MIDI events, run them through the
+    postprocessors and return the serialized MTrk chunk. This is all of the
+    per-part work, so it can run in a separate process.
+
+    `templates` (a transform.MeasureTemplates) collects the part's compiled
+    measures, and how often they were reused.
+    """
+    # Postprocessing is fused into as few passes as possible, the last of
+    # which streams straight into the MIDI encoder
+    return schedule.render(postprocs, _partRows(part, verbose, renderOptions, templates),
+                           runningStatus=renderOptions.runningStatus)
+
+def writePart(part, postprocs, output, verbose=False, renderOptions=DEFAULT_RENDER_OPTIONS,
+              templates=None, profiler=None):
+    """
+    Like renderPart, but streams the MTrk chunk into the seekable binary file
+    `output` as it is encoded, so a long part is never held in memory whole.
+
+    With a `profiler` (see util.stages), event generation and each
+    postprocessor are timed as stages, and events are counted by type.
+    """
+    rows = _partRows(part, verbose, renderOptions, templates)
+    if profiler is None:
+        schedule.write(postprocs, rows, output, runningStatus=renderOptions.runningStatus)
+        return
+
+    start = output.tell()
+    rows = profiler.counted(part.name, profiler.timed("events", rows))
+    schedule.write(postprocs, rows, output, runningStatus=renderOptions.runningStatus,
+                   profiler=profiler)
+    profiler.recordBytes(part.name, output.tell() - start)
+
+def distinctParts(compact):
+    """
+    The parts of a compact score that get a file of their own: the first
+    of any parts that share a name.
+    """
+    names = set()
+    parts = []
+    for part in compact.parts:
+        if part.name not in names:
+            names.add(part.name)
+            parts.append(part)
+    return parts
+
+def writeParts(directory, parts, tempoBytes, postprocs, verbose=False, jobs=1,
+               renderOptions=DEFAULT_RENDER_OPTIONS, profiler=None):
+    """
+    Write {partName}.mid into `directory` for each of the compact `parts`,
+    alongside the already-encoded tempo track. With jobs > 1, parts are
+    rendered in that many worker processes. Returns the part names.
+
+    With a `profiler` (see util.stages), parts are rendered one at a time,
+    each as a stage of its own.
+    """
+    spinner = None
+    partNames = [part.name for part in parts]
+
+    def write(partName, track):
+        midi.writeFile(os.path.join(directory, "{}.mid".format(partName)),
+                       [track, tempoBytes])
+
+    if jobs > 1 and len(parts) > 1 and profiler is None:
+        # Parts are independent of each other (they only share the tempo
+        # track, which is already serialized), so they can be rendered
+        # in separate processes and written as they come back.
+        if verbose:
+            spinner = spin("Extracting {} parts with {} workers".format(len(parts), jobs))
+
+        with ProcessPoolExecutor(max_workers=min(jobs, len(parts))) as executor:
+            futures = {executor.submit(renderPart, part, postprocs,
+                                       renderOptions=renderOptions): partName
+                       for partName, part in zip(partNames, parts)}
+            for future in as_completed(futures):
+                write(futures[future], future.result())
+
+        if verbose:
+            spinner.succeed()
+
+    else:
+        for partName, part in zip(partNames, parts):
+            if verbose:
+                spinner = spin("Extracting the '{}' part".format(partName))
+
+            # Each part streams straight into its file
+            templates = transform.MeasureTemplates()
+            with (profiler or stages.NULL_PROFILER).stage("part:{}".format(partName)):
+                write(partName, partial(writePart, part, postprocs, verbose=verbose,
+                                        renderOptions=renderOptions, templates=templates,
+                                        profiler=profiler))
+
+            if verbose:
+                spinner.succeed("Extracted the '{}' part: {}".format(partName,
+                                                                    templates.summary()))
+
+    return partNames
+
+def renderParts(parts, postprocs, verbose=False, jobs=1, renderOptions=DEFAULT_RENDER_OPTIONS,
+                profiler=None):
+    """
+    Render each of the compact `parts` to an MTrk chunk, in memory. With
+    jobs > 1, parts are rendered in that many worker processes. Returns
+    {partName: chunk}.
+
+    With a `profiler` (see util.stages), parts are rendered one at a time,
+    each as a stage of its own.
+    """
+    spinner = None
+    tracks = {}
+
+    if jobs > 1 and len(parts) > 1 and profiler is None:
+        if verbose:
+            spinner = spin("Extracting {} parts with {} workers".format(len(parts), jobs))
+
+        with ProcessPoolExecutor(max_workers=min(jobs, len(parts))) as executor:
+            futures = {executor.submit(renderPart, part, postprocs,
+                                       renderOptions=renderOptions): part.name
+                       for part in parts}
+            for future in as_completed(futures):
+                tracks[futures[future]] = future.result()
+
+        if verbose:
+            spinner.succeed()
+
+    else:
+        for part in parts:
+            if verbose:
+                spinner = spin("Extracting the '{}' part".format(part.name))
+
+            templates = transform.MeasureTemplates()
+            output = io.BytesIO()
+            with (profiler or stages.NULL_PROFILER).stage("part:{}".format(part.name)):
+                writePart(part, postprocs, output, verbose=verbose, renderOptions=renderOptions,
+                          templates=templates, profiler=profiler)
+            tracks[part.name] = output.getvalue()
+
+            if verbose:
+                spinner.succeed("Extracted the '{}' part: {}".format(part.name,
+                                                                    templates.summary()))
+
+    return tracks
+
+def scoreFilename(filename):
+    """
+    The single MIDI file a MusicXML file is converted to with singleFile:
+    the same name, with a .mid extension.
+    """
+    return os.path.splitext(filename)[0] + ".mid"
+
+def writeScore(filename, tracks, tempoBytes):
+    """
+    Write a single format 1 MIDI file: the tempo track, serialized once,
+    then a track named after each part, for every (partName, chunk) of
+    `tracks`.
+    """
+    midi.writeFile(filename, [tempoBytes] + [midi.namedTrack(chunk, partName)
+                                             for partName, chunk in tracks])
+
+def convertBytes(data, postprocs=(), renderOptions=None, parts=None):
+    """
+    Convert a MusicXML document given as bytes, entirely in memory: returns
+    {partName: MIDI file bytes}. Nothing is read from or written to disk
+    (the conversion cache included). `parts` selects parts as in
+    convertFile.
+    """
+    import music21
+    from util import gp7
+
+    renderOptions = renderOptions or DEFAULT_RENDER_OPTIONS
+
+    selection = extract.PartSelection(parts)
+    gp7Index = gp7.GP7Index()
+    markup = extract.standardizeExpressions(io.BytesIO(data), io.BytesIO(), gp7Index=gp7Index,
+                                            selection=selection)
+    if not selection.selected():
+        raise extract.selectionError(None, parts)
+
+    parsed = music21.converter.parseData(markup.getvalue(), format="musicxml")
+    compact = score.compactScore(parsed, gp7Index=gp7Index)
+    tempoBytes = compact.tempoMap(TICKS_PER_QUARTER_NOTE).encode()
+
+    return {part.name: midi.fileBytes([renderPart(part, postprocs, renderOptions=renderOptions),
+                                       tempoBytes])
+            for part in distinctParts(compact)}
+
+def convertFile(filename, postprocs, force=False, verbose=False, jobs=1,
+                conversionCache=None, renderOptions=None, parts=None, profiler=None):
+    """
+    Convert a single MusicXML file, writing {partName}.mid next to it (or,
+    with the singleFile render option, a single file with a track per part:
+    see scoreFilename). With jobs > 1, parts are rendered in that many
+    worker processes.
+    Returns the list of part names written. With `parts`, only the parts
+    it names are converted (see extract.selectParts).
+
+    Non-default render options (running status, bend resolution and
+    thinning) make files smaller, but no longer byte-identical to the ones
+    music21 used to write.
+
+    Unless forced, nothing is done when the outputs of the last conversion
+    with the same postprocessors are still in place.
+
+    A `profiler` (see util.stages) records every stage of the conversion;
+    parts are then rendered one at a time.
+    """
+    spinner = None
+    directory = os.path.dirname(filename)
+    conversionCache = conversionCache or createCache()
+    stageProfiler = profiler or stages.NULL_PROFILER
+
+    renderOptions = renderOptions or DEFAULT_RENDER_OPTIONS
+    options = outputOptions(renderOptions, parts)
+
+    # The input is only hashed once, for both its manifest and its parts
+    with stageProfiler.stage("cache lookup"):
+        key = conversionCache.key(filename)
+
+    if not force:
+        with stageProfiler.stage("cache lookup"):
+            partNames = outputs.upToDate(filename, postprocs, conversionCache,
+                                         options=options, key=key)
+        if partNames is not None:
+            if verbose:
+                info("{} is up to date".format(filename))
+            return partNames
+
+    compact = loadScore(filename, conversionCache, force=force, verbose=verbose, parts=parts,
+                        profiler=profiler, key=key)
+
+    if verbose:
+        info(conversionCache.summary())
+
+    # Create a tempo track
+    if verbose:
+        spinner = spin("Detecting tempos")
+
+    # The tempo track is shared by every part's file, so it is only
+    # encoded once
+    with stageProfiler.stage("tempo track"):
+        tempoBytes = compact.tempoMap(TICKS_PER_QUARTER_NOTE).encode()
+
+    if verbose:
+        spinner.succeed()
+
+    # Now onto the actual notes
+    parts = distinctParts(compact)
+    if renderOptions.singleFile:
+        # Parts are rendered (concurrently, with jobs > 1) and only then
+        # concatenated, in score order
+        tracks = renderParts(parts, postprocs, verbose=verbose, jobs=jobs,
+                             renderOptions=renderOptions, profiler=profiler)
+        partNames = [part.name for part in parts]
+        with stageProfiler.stage("write"):
+            writeScore(scoreFilename(filename),
+                       [(partName, tracks[partName]) for partName in partNames], tempoBytes)
+        outputNames = [os.path.splitext(os.path.basename(filename))[0]]
+    else:
+        partNames = writeParts(directory, parts, tempoBytes, postprocs,
+                               verbose=verbose, jobs=jobs, renderOptions=renderOptions,
+                               profiler=profiler)
+        outputNames = None
+
+    with stageProfiler.stage("manifest"):
+        outputs.record(filename, postprocs, partNames, conversionCache, options=options,
+                       outputNames=outputNames, key=key)
+
+    return partNames
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+
+from array import array
+
+from util import midi
+
+"""
+A columnar buffer of MIDI events, as handed to postprocessors.
+
+Each event is a row across parallel arrays: its type, its delta time (for
+DeltaTime rows), channel, first and second data bytes, and an index into a
+table of interned meta records (the per-note flags createMIDIEvents
+attaches, such as palmMute, harmonic, vibrato or bend). Postprocessors can
+then work a column at a time instead of on one event object after another.
+
+The (event, meta) tuple lists of the original postprocessor API convert to
+and from a buffer with fromEventsAndMeta and toEventsAndMeta.
+
+Events also travel one at a time, as rows: (type, delta, channel, data1,
+data2, meta) tuples, where missing values are None, meta is the meta dict
+itself and, for meta events, data1 is the meta event type and data2 its
+payload. encodeRows serializes a stream of rows, which is how the fused
+postprocessor pipeline (see postprocess.schedule) writes tracks, straight
+into the output file with writeChunk.
+"""
+
+# Row types: MIDI status nibbles for channel voice messages, plus these
+DELTA_TIME = 0x00
+META_EVENT = 0xFF
+
+NOTE_OFF = midi.CHANNEL_VOICE_MESSAGES["NOTE_OFF"]
+NOTE_ON = midi.CHANNEL_VOICE_MESSAGES["NOTE_ON"]
+CONTROLLER_CHANGE = midi.CHANNEL_VOICE_MESSAGES["CONTROLLER_CHANGE"]
+PITCH_BEND = midi.CHANNEL_VOICE_MESSAGES["PITCH_BEND"]
+
+TYPE_CODES = dict(midi.CHANNEL_VOICE_MESSAGES, DeltaTime=DELTA_TIME)
+TYPE_CODES.update({name: META_EVENT for name in midi.META_EVENTS})
+TYPE_NAMES = {code: name for name, code in midi.CHANNEL_VOICE_MESSAGES.items()}
+TYPE_NAMES[DELTA_TIME] = "DeltaTime"
+META_NAMES = {code: name for name, code in midi.META_EVENTS.items()}
+
+# Stands in for a missing (None) channel or data value
+NONE = -0x80000000
+
+# Column name -> array typecode
+COLUMNS = [
+    ("type", "B"),
+    ("delta", "l"),
+    ("channel", "l"),
+    ("data1", "l"),
+    ("data2", "l"),
+    ("meta", "L"),
+]
+
+# Row fields
+TYPE, DELTA, CHANNEL, DATA1, DATA2, META = range(6)
+
+SINGLE_DATA_TYPES = {midi.CHANNEL_VOICE_MESSAGES[name] for name in midi.SINGLE_DATA_MESSAGES}
+
+def _decode(value):
+    return None if value == NONE else value
+
+def rowFromEvent(event, meta):
+    """
+    A midi.MidiEvent (or anything with the same attributes, such as a
+    music21 MidiEvent) and its meta record, as a row.
+    """
+    code = TYPE_CODES.get(event.type)
+    if code is None:
+        raise midi.MidiException("unknown MIDI event type: {}".format(event.type))
+
+    if code == DELTA_TIME:
+        return (code, event.time, None, None, None, meta)
+    if code == META_EVENT:
+        return (code, 0, event.channel, midi.META_EVENTS[event.type], event.data, meta)
+    if code in SINGLE_DATA_TYPES:
+        return (code, 0, event.channel, event.data, None, meta)
+    return (code, 0, event.channel, event._parameter1, event._parameter2, meta)
+
+def eventFromRow(row):
+    """
+    A row as a midi.MidiEvent.
+    """
+    code, delta, channel, data1, data2, meta = row
+    if code == DELTA_TIME:
+        return midi.DeltaTime(time=delta)
+    if code == META_EVENT:
+        event = midi.MidiEvent(type=META_NAMES[data1], channel=channel)
+        event.data = data2
+        return event
+
+    event = midi.MidiEvent(type=TYPE_NAMES[code], channel=channel)
+    if code in SINGLE_DATA_TYPES:
+        event.data = data1
+    else:
+        event._parameter1 = data1
+        event._parameter2 = data2
+    return event
+
+def encodable(row):
+    """
+    Whether encodeRows writes anything for a (non-delta) row: events
+    missing a channel or data byte, or with one that doesn't fit in a byte,
+    are skipped (and their delta time carried over to the next event).
+    """
+    code, delta, channel, first, second, meta = row
+    if code == META_EVENT:
+        return True
+    if channel is None or first is None or not 0 <= first <= 0xFF:
+        return False
+    return code in SINGLE_DATA_TYPES or not (second is None or not 0 <= second <= 0xFF)
+
+def rowsFromEventsAndMeta(eventsAndMeta):
+    for event, meta in eventsAndMeta:
+        yield rowFromEvent(event, meta)
+
+# Roughly how many encoded bytes encodeRows holds on to before flushing
+FLUSH_SIZE = 1 << 16
+
+def encodeRows(rows, runningStatus=False, patchTypes=(), flush=None, flushSize=FLUSH_SIZE):
+    """
+    Serialize rows into the body of an MTrk chunk, exactly as
+    midi.encodeTrack would the equivalent events (including which events
+    are skipped, and how delta times add up). Returns the body and, for
+    rows whose type is in
+    `patchTypes`, (offset of their data bytes in the body, row) pairs,
+    so that their data can be rewritten later.
+
+    With `flush`, the body is handed to it in pieces of about `flushSize`
+    bytes as it is encoded, and only the unflushed end of it is returned.
+    Patch offsets still count from the start of the body.
+    """
+    body = bytearray()
+    flushed = 0
+    patches = []
+    lastStatus = None
+    # The delta times since the last event written
+    pending = 0
+    putVariableLengthNumber = midi.putVariableLengthNumber
+
+    for row in rows:
+        code = row[0]
+        if code == DELTA_TIME:
+            pending += row[1]
+            continue
+
+        if code != META_EVENT:
+            code, delta, channel, first, second, meta = row
+            if channel is None or first is None or not 0 <= first <= 0xFF:
+                continue
+            if code in SINGLE_DATA_TYPES:
+                data = bytes([first])
+            elif second is None or not 0 <= second <= 0xFF:
+                continue
+            else:
+                data = bytes([first, second])
+
+        if pending < 0x80:
+            # A negative sum is carried over to the next event
+            body.append(pending if pending > 0 else 0)
+            pending = pending if pending < 0 else 0
+        else:
+            body += putVariableLengthNumber(pending)
+            pending = 0
+
+        if code == META_EVENT:
+            payload = row[4] or b""
+            body.append(0xFF)
+            body.append(row[3])
+            body += putVariableLengthNumber(len(payload))
+            body += payload
+            lastStatus = None
+        else:
+            status = code + channel - 1
+            if status != lastStatus:
+                body.append(status)
+            if code in patchTypes:
+                patches.append((flushed + len(body), row))
+            body += data
+            if runningStatus:
+                lastStatus = status
+
+        if flush is not None and len(body) >= flushSize:
+            flush(body)
+            flushed += len(body)
+            body = bytearray()
+
+    if pending > 0:
+        # Delta times with no event after them end the track
+        body += putVariableLengthNumber(pending) + b"\xFF\x2F\x00"
+
+    return body, patches
+
+def chunk(body):
+    """
+    An MTrk chunk around an encoded track body.
+    """
+    return b"MTrk" + midi.putNumber(len(body), 4) + bytes(body)
+
+def writeChunk(rows, output, runningStatus=False, patchTypes=(), finalize=None):
+    """
+    Write rows to the seekable binary file `output` as an MTrk chunk, as
+    they are encoded, so that only a small window of the track is ever in
+    memory. Once the rows run out, the chunk length is filled in, and rows
+    whose type is in `patchTypes` get the data bytes `finalize(row)`
+    returns.
+    """
+    start = output.tell()
+    output.write(b"MTrk\0\0\0\0")
+    body, patches = encodeRows(rows, runningStatus=runningStatus, patchTypes=patchTypes,
+                               flush=output.write)
+    output.write(body)
+    end = output.tell()
+
+    for offset, row in patches:
+        data1, data2 = finalize(row)
+        output.seek(start + 8 + offset)
+        if row[TYPE] in SINGLE_DATA_TYPES:
+            output.write(bytes([data1]))
+        else:
+            output.write(bytes([data1, data2]))
+
+    output.seek(start + 4)
+    output.write(midi.putNumber(end - start - 8, 4))
+    output.seek(end)
+
+class MetaTable:
+    """
+    Interned meta records: each distinct record is stored once, and rows
+    refer to it by index. Records are dicts, and must not be modified.
+    """
+    def __init__(self):
+        self.records = []
+        self.index = {}
+        # Events of a note share its meta dict, so most lookups hit this;
+        # it keeps the dicts alive, so their ids can't be reused
+        self.byIdentity = {}
+
+    def intern(self, meta):
+        known = self.byIdentity.get(id(meta))
+        if known is not None:
+            return known[1]
+
+        key = tuple(sorted(meta.items()))
+        if key not in self.index:
+            self.index[key] = len(self.records)
+            self.records.append(meta)
+        index = self.index[key]
+        self.byIdentity[id(meta)] = (meta, index)
+        return index
+
+    def flags(self, name):
+        """
+        Whether each record has a true value for `name`, by record index.
+        """
+        return [bool(record.get(name)) for record in self.records]
+
+    def __getitem__(self, index):
+        return self.records[index]
+
+    def __len__(self):
+        return len(self.records)
+
+class EventBuffer:
+    def __init__(self, columns=None, metaTable=None, payloads=None):
+        self.columns = columns or {name: array(typecode) for name, typecode in COLUMNS}
+        self.metaTable = metaTable if metaTable is not None else MetaTable()
+        # Meta event data (e.g. tempos), indexed by data2
+        self.payloads = payloads if payloads is not None else []
+
+    def __len__(self):
+        return len(self.columns["type"])
+
+    def append(self, type, delta=0, channel=None, data1=None, data2=None, meta=0):
+        c = self.columns
+        c["type"].append(type)
+        c["delta"].append(delta)
+        c["channel"].append(NONE if channel is None else channel)
+        c["data1"].append(NONE if data1 is None else data1)
+        c["data2"].append(NONE if data2 is None else data2)
+        c["meta"].append(meta)
+
+    def appendRow(self, row):
+        code, delta, channel, data1, data2, meta = row
+        if code == META_EVENT:
+            self.payloads.append(data2)
+            data2 = len(self.payloads) - 1
+        self.append(code, delta, channel, data1, data2, self.metaTable.intern(meta))
+
+    def appendEvent(self, event, meta):
+        """
+        Append a midi.MidiEvent (or anything with the same attributes, such
+        as a music21 MidiEvent), with its meta record.
+        """
+        self.appendRow(rowFromEvent(event, meta))
+
+    def row(self, index):
+        c = self.columns
+        code = c["type"][index]
+        data2 = c["data2"][index]
+        if code == META_EVENT:
+            data2 = self.payloads[data2]
+        return (code, c["delta"][index], _decode(c["channel"][index]),
+                _decode(c["data1"][index]), _decode(data2),
+                self.metaTable.records[c["meta"][index]])
+
+    def rows(self):
+        for index in range(len(self)):
+            yield self.row(index)
+
+    def event(self, index):
+        """
+        Row `index` as a midi.MidiEvent.
+        """
+        return eventFromRow(self.row(index))
+
+    def events(self):
+        return [self.event(index) for index in range(len(self))]
+
+    def encode(self, runningStatus=False):
+        """
+        The buffer as an MTrk chunk.
+        """
+        body, patches = encodeRows(self.rows(), runningStatus=runningStatus)
+        return chunk(body)
+
+    def insertRows(self, insertions):
+        """
+        A new buffer with extra rows: `insertions` maps a row index to a list
+        of rows to insert before it. The new buffer shares this buffer's meta
+        table and payloads.
+        """
+        buffer = EventBuffer(metaTable=self.metaTable, payloads=self.payloads)
+        source = [self.columns[name] for name, typecode in COLUMNS]
+        target = [buffer.columns[name] for name, typecode in COLUMNS]
+
+        start = 0
+        for index in sorted(insertions):
+            for column, values in zip(target, source):
+                column.extend(values[start:index])
+            for inserted in insertions[index]:
+                buffer.appendRow(inserted)
+            start = index
+        for column, values in zip(target, source):
+            column.extend(values[start:])
+
+        return buffer
+
+    @classmethod
+    def fromRows(cls, rows):
+        buffer = cls()
+        for row in rows:
+            buffer.appendRow(row)
+        return buffer
+
+    @classmethod
+    def fromEventsAndMeta(cls, eventsAndMeta):
+        return cls.fromRows(rowsFromEventsAndMeta(eventsAndMeta))
+
+    def toEventsAndMeta(self):
+        """
+        The buffer in the original postprocessor format: a list of
+        (midi.MidiEvent, meta) tuples.
+        """
+        return [(eventFromRow(row), row[META]) for row in self.rows()]
+
+    def rowMeta(self, name):
+        """
+        Whether each row's meta record has a true value for `name`.
+        """
+        flags = self.metaTable.flags(name)
+        return [flags[index] for index in self.columns["meta"]]
@@ -1,118 +1,634 @@
 # -*- coding: utf-8 -*-
 
-from bs4 import BeautifulSoup
-import music21
-import re
+from fractions import Fraction
 import sys
 
 """
 Extraction methods for retrieving and manipulating data from MusicXML
 markup and Music21 objects.
+
+lxml and music21 are imported by the functions that need them, so that
+importing this module (e.g. for VERSION) stays cheap.
 """
 
-def standardizeExpressions(markup):
+# Bump whenever standardizeExpressions changes the markup it produces;
+# cached parses are keyed on it.
+VERSION = 2
+
+# Serialized output mirrors what BeautifulSoup used to emit for these files,
+# so that music21 (and anyone diffing the intermediate XML) sees the same
+# document as before.
+XML_DECLARATION = '<?xml version="1.0" encoding="utf-8"?>\n'
+ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+
+# Elements that are written out incrementally (start tag first, children as
+# they complete, end tag last); anything deeper is written whole, once its
+# end tag has been parsed. This bounds memory to a single note/direction.
+STREAMED_DEPTH = 3
+
+# Written whole even at a streamed depth, as their part name decides whether
+# they are written at all
+WHOLE_ELEMENTS = ("score-part",)
+
+# The parts standardizeExpressions drops can leave tempo skeletons behind,
+# whose IDs are those of the parts with this prefix
+TEMPO_PART_PREFIX = "tempo-"
+# What the rest of a tempo skeleton's measure keeps of the note it is timed like
+TEMPO_NOTE_TIMING = ("duration", "type", "dot", "time-modification")
+# Quarter lengths of MusicXML note types
+NOTE_TYPES = {name: Fraction(2) ** (5 - index) for index, name in enumerate(
+    ["maxima", "long", "breve", "whole", "half", "quarter", "eighth", "16th", "32nd",
+     "64th", "128th", "256th", "512th", "1024th"])}
+# The divisions music21 reads parts that have none in
+MUSIC21_DIVISIONS = 10080
+
+# Entities are never resolved, nor anything fetched, whatever the lxml
+# version's defaults: the server parses documents from anyone, and an
+# external entity would read its files. Entity references are dropped.
+PARSER_OPTIONS = {"recover": True, "resolve_entities": False, "no_network": True}
+
+# lxml recovers from malformed markup as BeautifulSoup did, but only these
+# errors leave the document's structure alone; for any other (e.g. in a
+# truncated export) recovery is a guess, so they are reported instead
+TOLERATED_ERRORS = ("ERR_UNDECLARED_ENTITY", "ERR_ENTITYREF_SEMICOL_MISSING",
+                    "ERR_INVALID_CHAR", "ERR_DOCUMENT_END")
+
+
+class MusicXMLException(ValueError):
+    pass
+
+def _checkStructure(errorLog):
     """
-    There are a number of permutations and traversals that we need to perform
-    on Guitar Pro-generated MusicXML, before translating it into MIDI.
+    Raise a MusicXMLException for the first error in the error log of an
+    exhausted, recovering iterparse that isn't tolerated. (lxml's own
+    XMLSyntaxError can't be pickled, so it couldn't leave a worker process.)
     """
-    # Barlines can have repeats (codas); Guitar Pro likes putting the
-    # "times" attribute in coda starts, but MusicXML technically does not.
-    for repeat in markup("repeat"):
-        if repeat.get("direction") == "forward":
-            del repeat["times"]
+    for error in errorLog:
+        if error.type_name not in TOLERATED_ERRORS:
+            # Worded as lxml words the errors it doesn't recover from
+            raise MusicXMLException("{}, line {}, column {}".format(error.message, error.line,
+                                                                    error.column))
+
+def _escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def _collapse(text):
+    """
+    Whitespace-only strings collapse to a single newline (or space).
+    """
+    if not text:
+        return ""
+    if not text.strip(ASCII_SPACES):
+        return "\n" if "\n" in text else " "
+    return _escape(text)
+
+def _quoteAttribute(value):
+    value = _escape(value)
+    if '"' in value:
+        if "'" in value:
+            return '"{}"'.format(value.replace('"', "&quot;"))
+        return "'{}'".format(value)
+    return '"{}"'.format(value)
+
+def _qualify(name, nsmap):
+    if name.startswith("{"):
+        uri, local = name[1:].split("}", 1)
+        for prefix, candidate in nsmap.items():
+            if candidate == uri and prefix:
+                return "{}:{}".format(prefix, local)
+        return local
+    return name
+
+def _startTag(element, empty=False):
+    nsmap = element.nsmap
+    parent = element.getparent()
+    inherited = parent.nsmap if parent is not None else {}
+    attributes = [(_qualify(key, nsmap), value) for key, value in element.attrib.items()]
+    for prefix, uri in nsmap.items():
+        if inherited.get(prefix) != uri:
+            attributes.append(("xmlns:{}".format(prefix) if prefix else "xmlns", uri))
+    # BeautifulSoup always wrote attributes (namespace declarations
+    # included) sorted by name
+    if len(attributes) > 1:
+        attributes.sort()
+    return "<{}{}{}>".format(_qualify(element.tag, nsmap),
+                             "".join(" {}={}".format(key, _quoteAttribute(value))
+                                     for key, value in attributes),
+                             "/" if empty else "")
+
+def _endTag(element):
+    return "</{}>".format(_qualify(element.tag, element.nsmap))
+
+def _serialize(node, chunks):
+    """
+    Append the markup for a single node (without its tail) to `chunks`.
+    """
+    from lxml import etree
+
+    if isinstance(node, etree._Entity):
+        return
+    if isinstance(node, etree._Comment):
+        chunks.append("<!--{}-->".format(node.text or ""))
+    elif isinstance(node, etree._ProcessingInstruction):
+        chunks.append("<?{} {}?>".format(node.target, node.text or ""))
+    elif not node.text and not len(node):
+        chunks.append(_startTag(node, empty=True))
+    else:
+        chunks.append(_startTag(node))
+        chunks.append(_collapse(node.text))
+        for child in node:
+            _serialize(child, chunks)
+            chunks.append(_collapse(child.tail))
+        chunks.append(_endTag(node))
+
+def _doctype(docinfo):
+    publicId = docinfo.public_id
+    systemId = docinfo.system_url
+    if not docinfo.doctype:
+        return ""
+    value = docinfo.root_name or ""
+    if publicId is not None:
+        value += ' PUBLIC "{}"'.format(publicId)
+        if systemId is not None:
+            value += ' "{}"'.format(systemId)
+    elif systemId is not None:
+        value += ' SYSTEM "{}"'.format(systemId)
+    return "<!DOCTYPE {}>\n".format(value)
+
+def _technical(notations):
+    if notations is None:
+        return None
+    return notations.find(".//technical")
+
+def _addTechnical(technical, kind, text):
+    # Guitar Pro expressions are carried to music21 as "other-technical"
+    # indications; createMIDIEvents keys off the text.
+    from lxml import etree
+
+    if technical is not None:
+        expr = etree.SubElement(technical, "other-technical", {"class_": kind})
+        expr.text = text
+
+def _text(element):
+    # As itertext, but entity references (see PARSER_OPTIONS) add nothing
+    chunks = [element.text or ""]
+    for node in element.iterdescendants():
+        if isinstance(node.tag, str):
+            chunks.append(node.text or "")
+        chunks.append(node.tail or "")
+    return "".join(chunks)
+
+def _standardizeNote(note, effects):
+    """
+    Apply all of the Guitar Pro rewrites that live within a single <note>,
+    given its decoded GP7 effects.
+    """
+    from lxml import etree
 
     # Dynamics can technically live in multple places; Guitar Pro tends to
     # put them on the notes only, in a way that music21 seems to miss.
-    for dynamics in markup("dynamics"):
-        symbols = dynamics.findChildren()
-        symbol = symbols[0].name if symbols else "mf"
-        notations = dynamics.parent
-        technicals = notations.technical or markup.new_tag("technical")
-        expr = markup.new_tag("other-technical", class_="dynamics")
-        expr.append("dynamics__{}".format(symbol.lower()))
-        technicals.append(expr)
+    for dynamics in list(note.iter("dynamics")):
+        symbols = [child for child in dynamics.iter() if child is not dynamics
+                   and isinstance(child.tag, str)]
+        symbol = symbols[0].tag if symbols else "mf"
+        _addTechnical(_technical(dynamics.getparent()),
+                      "dynamics", "dynamics__{}".format(symbol.lower()))
 
     # Palm mutes (guitar only)
-    for mute in markup("play"):
-        note = mute.parent
-        notations = note.notations or markup.new_tag("notations")
-        technicals = notations.technical or markup.new_tag("technical")
-        if not technicals("other-technical.palmMute"):
-            expr = markup.new_tag("other-technical", class_="palmMute")
-            expr.append("palm-mute")
-            technicals.append(expr)
+    for mute in list(note.iter("play")):
+        if mute.getparent() is note:
+            _addTechnical(_technical(note.find(".//notations")),
+                          "palmMute", "palm-mute")
 
     # Unpitched note (drums only)
-    for unpitched in markup("unpitched"):
-        note = unpitched.parent
-        newPitch = "{}{}".format(unpitched.find("display-step").text,
-                                 unpitched.find("display-octave").text)
-        pitch = markup.new_tag("pitch")
-        step = markup.new_tag("step")
-        step.string = unpitched.find("display-step").text
-        octave = markup.new_tag("octave")
-        octave.string = unpitched.find("display-octave").text
+    for unpitched in list(note.iter("unpitched")):
         # TODO: map these squirrelly values into GM drum map values
-        pitch.append(step)
-        pitch.append(octave)
-        note.append(pitch)
+        parent = unpitched.getparent()
+        pitch = etree.SubElement(parent, "pitch")
+        step = etree.SubElement(pitch, "step")
+        step.text = _text(unpitched.find(".//display-step"))
+        octave = etree.SubElement(pitch, "octave")
+        octave.text = _text(unpitched.find(".//display-octave"))
 
     # Guitar Pro 7 has a number of bizarre nonstandard entities
     # in their XML export.
-    for note in markup("note"):
-        noteText = str(note)
-        if "GP7" in noteText:
-            m = re.search(r"<\?GP7([^\?]+)\?>", noteText, re.M)
-            if m:
-                gp7 = BeautifulSoup(m.group(1), "xml")
-                vibrato = gp7.find("vibrato")
-                if vibrato:
-                    notations = note.notations or markup.new_tag("notations")
-                    technicals = notations.technical or markup.new_tag("technical")
-                    if not technicals("other-technical.vibrato"):
-                        expr = markup.new_tag("other-technical", class_="vibrato")
-                        expr.append("vibrato")
-                    technicals.append(expr)
-                ring = gp7.find("letring")
-                if ring:
-                    notations = note.notations or markup.new_tag("notations")
-                    technicals = notations.technical or markup.new_tag("technical")
-                    if not technicals("other-technical.letring"):
-                        expr = markup.new_tag("other-technical", class_="letring")
-                        expr.append("letring")
-                    technicals.append(expr)
-
-        # Guitar Pro also support a variety of bends, with curve-based keystones,
-        # that simply doesn't map to MusicXML.
-        bends = note("bend")
-        if bends:
-            points = ["0"]
-            for bend in bends:
-                if bend.find("pre-bend"):
-                    points = [bend.find("bend-alter").text]
+    if "vibrato" in effects:
+        _addTechnical(_technical(note.find(".//notations")),
+                      "vibrato", "vibrato")
+    if "letring" in effects:
+        _addTechnical(_technical(note.find(".//notations")),
+                      "letring", "letring")
+
+    # Guitar Pro also support a variety of bends, with curve-based keystones,
+    # that simply doesn't map to MusicXML.
+    bends = list(note.iter("bend"))
+    if bends:
+        points = ["0"]
+        for bend in bends:
+            if bend.find(".//pre-bend") is not None:
+                points = [_text(bend.find(".//bend-alter"))]
+            else:
+                points.append(_text(bend.find(".//bend-alter")))
+        _addTechnical(_technical(note.find(".//notations")),
+                      "bend", "bend__{}".format(",".join(points)))
+
+def selectParts(partList, selectors=None):
+    """
+    The IDs of the parts in `partList` ((ID, name) pairs) that are named,
+    case insensitively, by any of `selectors`: by part name, by ID, or in
+    the partId-partName form PartStaff parts are written out as. Without
+    selectors, every part is selected.
+    """
+    if not selectors:
+        return [partId for partId, name in partList]
+
+    wanted = {selector.casefold() for selector in selectors}
+    return [partId for partId, name in partList
+            if {partId.casefold(), name.casefold(),
+                "{}-{}".format(partId, name).casefold()} & wanted]
+
+def hashParts(source):
+    """
+    The (ID, name, digest) of each part of a MusicXML file, in score order,
+    where the digest is the SHA-1 of the part's <score-part> and <part>
+    markup. Nothing else goes in, as the rest of the file (e.g. the export
+    date) doesn't change any part's MIDI.
+    """
+    import hashlib
+    from lxml import etree
+
+    scoreParts = {}
+    names = {}
+    digests = {}
+    events = etree.iterparse(source, events=("end",), tag=("score-part", "part"),
+                             **PARSER_OPTIONS)
+    for event, element in events:
+        partId = element.get("id")
+        if element.tag == "score-part":
+            partName = element.find("part-name")
+            names[partId] = _text(partName) if partName is not None else ""
+            scoreParts[partId] = etree.tostring(element, with_tail=False)
+        elif partId in scoreParts:
+            digests[partId] = hashlib.sha1(scoreParts[partId] +
+                                           etree.tostring(element, with_tail=False)).hexdigest()
+            element.clear()
+
+    _checkStructure(events.error_log)
+    return [(partId, names[partId], digests[partId]) for partId in scoreParts
+            if partId in digests]
+
+def selectionError(filename, selectors):
+    """
+    The error for a selection that left nothing of a file (`filename` may be
+    None, for a document that has none).
+    """
+    if selectors:
+        where = "of {} ".format(filename) if filename else ""
+        return ValueError("No part {}matches {}".format(where, ", ".join(selectors)))
+    return ValueError("{} has no parts".format(filename or "The document"))
+
+class PartSelection:
+    """
+    The parts standardizeExpressions keeps: those `selectors` select (see
+    selectParts), except for the IDs in `exclude`. Every part the score
+    lists is recorded in `partList`, kept or not.
+
+    With `tempos`, the parts that aren't kept but have metronome marks
+    still leave a tempo skeleton behind (see _tempoMeasure), as Guitar Pro
+    only writes the score's metronome marks in one of its parts.
+    """
+    def __init__(self, selectors=None, exclude=(), tempos=True):
+        self.selectors = selectors
+        self.exclude = set(exclude)
+        self.tempos = tempos
+        self.partList = []
+
+    def selected(self):
+        return selectParts(self.partList, self.selectors)
+
+    def keeps(self, partId):
+        return partId not in self.exclude and partId in self.selected()
+
+def isTempoPart(partId):
+    return partId.startswith(TEMPO_PART_PREFIX)
+
+def _tempoScorePart(scorePart):
+    """
+    The <score-part> of a dropped part's tempo skeleton (music21 ignores
+    a <part> the part list doesn't name).
+    """
+    from lxml import etree
+
+    stub = etree.Element("score-part", id=TEMPO_PART_PREFIX + scorePart.get("id"))
+    etree.SubElement(stub, "part-name")
+    return stub
+
+def _quarterLength(note, divisions):
+    """
+    A note's length in quarter notes, as music21 reads it: from its type,
+    dots and time modification when it has a type, or else its duration.
+    """
+    noteType = note.find("type")
+    if noteType is None:
+        duration = note.find("duration")
+        return Fraction(int(_text(duration).strip()), divisions) if duration is not None else 0
+
+    length = NOTE_TYPES[_text(noteType).strip()]
+    length *= 2 - Fraction(1, 2 ** len(note.findall("dot")))
+    modification = note.find("time-modification")
+    if modification is not None:
+        length *= Fraction(int(_text(modification.find("normal-notes")).strip()),
+                           int(_text(modification.find("actual-notes")).strip()))
+    return length
+
+def _tempoMeasure(measure, skeleton):
+    """
+    A dropped part's measure, reduced to what music21 needs to read its
+    metronome marks at the same offsets: its attributes and metronome
+    marks, moved to where they were with forwards and backups, and a rest
+    timed like the note that reaches furthest (music21 starts each measure
+    where the previous one's elements end). `skeleton` carries the part's
+    divisions from one measure to the next.
+    """
+    from copy import deepcopy
+    from lxml import etree
+
+    reduced = etree.Element("measure", dict(measure.attrib))
+    # In quarter notes: where music21 reads the measure at, and where the
+    # reduced measure is at
+    position = cursor = Fraction(0)
+    # The note that reaches furthest, and where it starts
+    last = None
+    reach = start = Fraction(0)
+
+    def moveTo(offset):
+        if offset != cursor:
+            move = etree.SubElement(reduced, "forward" if offset > cursor else "backup")
+            units = abs(offset - cursor) * skeleton["divisions"]
+            etree.SubElement(move, "duration").text = \
+                str(units.numerator) if units.denominator == 1 else str(float(units))
+        return offset
+
+    for child in measure:
+        if child.tag == "note":
+            if child.find("grace") is None and child.find("chord") is None:
+                length = _quarterLength(child, skeleton["divisions"])
+                if last is None or position + length > reach:
+                    last, reach, start = child, position + length, position
+                position += length
+        elif child.tag in ("backup", "forward"):
+            length = Fraction(int(_text(child.find("duration")).strip()), skeleton["divisions"])
+            position += length if child.tag == "forward" else -length
+        elif child.tag == "attributes" or \
+                (child.tag == "direction" and child.find("direction-type/metronome") is not None):
+            cursor = moveTo(position)
+            reduced.append(deepcopy(child))
+            divisions = child.find("divisions")
+            if divisions is not None:
+                skeleton["divisions"] = int(_text(divisions).strip())
+
+    if last is not None:
+        cursor = moveTo(start)
+        rest = etree.SubElement(reduced, "note")
+        etree.SubElement(rest, "rest")
+        rest.extend(deepcopy(timing) for timing in last if timing.tag in TEMPO_NOTE_TIMING)
+
+    return reduced
+
+def _placeNote(note, effects, position):
+    """
+    Note where a note starts in its measure, along with its GP7 effects:
+    a chord's notes share the start of its first note, and grace notes
+    take no time.
+    """
+    notes = position["notes"]
+    if note.find("chord") is not None and notes:
+        notes[-1][2].append(effects)
+        return
+
+    notes.append((position["cursor"], len(notes), [effects]))
+    if note.find("grace") is None:
+        position["cursor"] += _quarterLength(note, position["divisions"])
+
+def _recordMeasure(position, gp7Index):
+    """
+    Record the GP7 effects of a measure's notes, chords and rests, numbered
+    in the order music21 puts them in: by start, then in document order.
+    """
+    from util import gp7
+
+    for index, (start, order, effects) in enumerate(sorted(position["notes"],
+                                                           key=lambda note: note[:2])):
+        for found in effects:
+            gp7Index.record(gp7.NotePosition(position["part"], position["measure"], index),
+                            found)
+    position["notes"] = []
+
+def _standardizeElement(element, position, gp7Index):
+    from util import gp7
+
+    if element.tag == "note":
+        effects = gp7.noteEffects(element)
+        if gp7Index is not None and position["measure"] is not None:
+            _placeNote(element, effects, position)
+        _standardizeNote(element, effects)
+
+    # Barlines can have repeats (codas); Guitar Pro likes putting the
+    # "times" attribute in coda starts, but MusicXML technically does not.
+    elif element.tag == "repeat":
+        if element.get("direction") == "forward":
+            element.attrib.pop("times", None)
+
+    elif gp7Index is not None and position["measure"] is not None:
+        if element.tag in ("backup", "forward"):
+            length = Fraction(int(_text(element.find("duration")).strip()), position["divisions"])
+            position["cursor"] += length if element.tag == "forward" else -length
+        elif element.tag == "divisions":
+            position["divisions"] = int(_text(element).strip())
+        elif element.tag == "measure":
+            _recordMeasure(position, gp7Index)
+
+def standardizeExpressions(source, output, gp7Index=None, selection=None):
+    """
+    There are a number of permutations and traversals that we need to perform
+    on Guitar Pro-generated MusicXML, before translating it into MIDI.
+
+    This streams `source` (a filename or binary file object) through a single
+    lxml pass, rewriting each note as soon as it has been parsed, and writes
+    UTF-8 MusicXML to the binary file object `output`.
+
+    If a GP7Index is given, it is filled with the decoded GP7 effects of
+    every note, by position (see score.compactScores, which reads them
+    back).
+
+    With a PartSelection, the <score-part> and <part> elements of the parts
+    it doesn't keep are dropped as they are parsed, so music21 never sees
+    them (and they are never held in memory whole), but for the tempo
+    skeletons of those with metronome marks, if the selection asks for them.
+    """
+    from lxml import etree
+
+    # Each open, streamed element maps to its most recently written child
+    # (or None); that child's tail can only be written once its next
+    # sibling (or the parent's end tag) has been parsed.
+    opened = []
+    written = {}
+    started = False
+    # Where the notes of the current measure start, for the GP7 index
+    position = {"part": None, "measure": None, "divisions": 1, "cursor": 0, "notes": []}
+    # The <part> being dropped, if any, and its tempo skeleton: its start
+    # tag and measures, held back until a metronome mark shows up (None once
+    # one has), as the skeletons of parts without any are left out
+    skipping = None
+    skeleton = None
+    skeletonState = None
+    marked = False
+
+    def flush(container, chunks):
+        if container not in written:
+            chunks.append(_startTag(container))
+            chunks.append(_collapse(container.text))
+            written[container] = None
+        last = written[container]
+        if last is not None:
+            chunks.append(_collapse(last.tail))
+            container.remove(last)
+            written[container] = None
+
+    events = etree.iterparse(source, events=("start", "end", "comment", "pi"),
+                             **PARSER_OPTIONS)
+    for event, node in events:
+        parent = node.getparent()
+        chunks = []
+
+        if skipping is not None:
+            if node is skipping and event == "end":
+                skipping = None
+                if marked:
+                    chunks.append("</part>")
+                # Its tail is written along with the next sibling
+                written[parent] = node
+            elif event == "end" and parent is skipping:
+                if (skeleton is not None or marked) and node.tag == "measure":
+                    reduced = _tempoMeasure(node, skeletonState)
+                    if marked:
+                        _serialize(reduced, chunks)
+                    elif reduced.find("direction") is not None:
+                        marked = True
+                        chunks.append(skeleton.pop(0))
+                        for measure in skeleton + [reduced]:
+                            _serialize(measure, chunks)
+                        skeleton = None
+                    else:
+                        skeleton.append(reduced)
+                skipping.remove(node)
+            if chunks:
+                output.write("".join(chunks).encode("utf-8"))
+            continue
+
+        if not started:
+            # First thing seen, whether it is the root or a prolog comment
+            chunks.append(XML_DECLARATION)
+            chunks.append(_doctype(node.getroottree().docinfo))
+            started = True
+
+        if event == "start":
+            if parent is None:
+                opened.append(node)
+            elif opened and parent is opened[-1]:
+                flush(parent, chunks)
+                if node.tag == "part" and selection is not None and \
+                        not selection.keeps(node.get("id")):
+                    skipping = node
+                    marked = False
+                    skeleton = None
+                    if selection.tempos:
+                        skeletonState = {"divisions": MUSIC21_DIVISIONS}
+                        skeleton = ["<part id={}>".format(
+                            _quoteAttribute(TEMPO_PART_PREFIX + node.get("id")))]
+                elif len(opened) < STREAMED_DEPTH and node.tag not in WHOLE_ELEMENTS:
+                    opened.append(node)
+
+            if node.tag == "part":
+                position.update(part=node.get("id"), measure=None, divisions=1)
+            elif node.tag == "measure":
+                position.update(measure=node.get("number"), cursor=Fraction(0), notes=[])
+
+        elif event == "end":
+            try:
+                _standardizeElement(node, position, gp7Index)
+            except Exception:
+                # Most likely an element cut short: if the rest of the document
+                # shows it was, that is the error to report
+                for rest in events:
+                    pass
+                _checkStructure(events.error_log)
+                raise
+            if node.tag == "score-part" and selection is not None:
+                partName = node.find("part-name")
+                partId = node.get("id")
+                selection.partList.append((partId, _text(partName) if partName is not None else ""))
+                if not selection.keeps(partId):
+                    if selection.tempos:
+                        _serialize(_tempoScorePart(node), chunks)
+                        output.write("".join(chunks).encode("utf-8"))
+                    written[parent] = node
+                    continue
+
+            if opened and node is opened[-1]:
+                opened.pop()
+                if node not in written and not node.text and not len(node):
+                    chunks.append(_startTag(node, empty=True))
                 else:
-                    points.append(bend.find("bend-alter").text)
-            notations = note.notations or markup.new_tag("notations")
-            technicals = notations.technical or markup.new_tag("technical")
-            if not technicals("other-technical.bend"):
-                expr = markup.new_tag("other-technical", class_="bend")
-                expr.append("bend__{}".format(",".join(points)))
-            technicals.append(expr)
+                    flush(node, chunks)
+                    chunks.append(_endTag(node))
+                written.pop(node, None)
+                if parent is not None:
+                    written[parent] = node
+            elif opened and parent is opened[-1]:
+                _serialize(node, chunks)
+                written[parent] = node
+
+        elif parent is None:
+            # Comments and processing instructions outside of the root
+            _serialize(node, chunks)
+        elif opened and parent is opened[-1]:
+            flush(parent, chunks)
+            _serialize(node, chunks)
+            written[parent] = node
+
+        if chunks:
+            output.write("".join(chunks).encode("utf-8"))
+
+    _checkStructure(events.error_log)
+    return output
+
+def getTempoBoundaries(stream):
+    """
+    Given a Music21 stream object, return its tempo changes as a list of
+    (offset in quarter notes, quarter notes per minute) pairs, in order.
+
+    Metronome marks are read where they are, in a single walk of the
+    stream; nothing needs to be timed.
+    """
+    import music21
+
+    boundaries = []
+    for mark in stream.recurse().getElementsByClass(music21.tempo.MetronomeMark):
+        bpm = mark.numberSounding or mark.getQuarterBPM()
+        if bpm:
+            boundaries.append((float(mark.getOffsetInHierarchy(stream)), bpm))
+
+    # Parts repeat the same marks; the sort is stable, so marks at the
+    # same offset keep their relative order
+    boundaries.sort(key=lambda boundary: boundary[0])
+    return boundaries
 
 def getStreamTempo(stream, ticksPerQuarterNote, verbose=False):
     """
     Given a Music21 stream object, return a map of tempo regions
     """
-    tempos = {}
-    try:
-        assert stream.seconds # If this fails, there are no metronome marks to detect
-        for startTime, endTime, mark in stream.metronomeMarkBoundaries():
-            print(startTime, endTime, mark)
-            tempo = mark.numberSounding or mark.number
-            startTick = int(startTime * ticksPerQuarterNote)
-            if startTick not in tempos or tempos[startTick] != tempo:
-                tempos[startTick] = tempo
-    except music21.exceptions21.StreamException:
-        pass
-
-    return tempos
+    from util import tempo
+
+    tempoMap = tempo.TempoMap(getTempoBoundaries(stream), ticksPerQuarterNote)
+    return dict(zip(tempoMap.ticks, tempoMap.bpms))
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+import functools
+from lxml import etree
+import types
+
+"""
+Guitar Pro 7 stores a number of its note effects in nonstandard processing
+instructions inside each <note>, e.g. <?GP7 <root><vibrato/></root>?>.
+These helpers find and decode them, without ever serializing the note.
+"""
+
+TARGET = "GP7"
+
+# GP7 exports reuse the same handful of payloads over and over, so decoded
+# results are memoized; the parser itself is shared across all of them.
+DECODE_CACHE_SIZE = 1024
+PARSER = etree.XMLParser(recover=True, resolve_entities=False, no_network=True)
+
+NotePosition = namedtuple("NotePosition", ["part", "measure", "index"])
+
+NO_EFFECTS = types.MappingProxyType({})
+
+@functools.lru_cache(maxsize=DECODE_CACHE_SIZE)
+def decode(payload):
+    """
+    Given the payload of a GP7 processing instruction, return a read-only
+    map of effect names (vibrato, letring, ...) to their attributes.
+    """
+    wrapper = etree.fromstring("<gp7>{}</gp7>".format(payload), PARSER)
+    if wrapper is None:
+        return NO_EFFECTS
+
+    effects = {}
+    for element in wrapper.iter():
+        if element is wrapper or not isinstance(element.tag, str):
+            continue
+        # The payload is (almost) always wrapped in a <root>, which
+        # isn't an effect in itself.
+        if element.tag == "root" and element.getparent() is wrapper:
+            continue
+        if element.tag not in effects:
+            attributes = dict(element.attrib)
+            text = (element.text or "").strip()
+            if text:
+                attributes["text"] = text
+            effects[element.tag] = types.MappingProxyType(attributes)
+
+    return types.MappingProxyType(effects)
+
+def payload(instruction):
+    """
+    Return the payload of a GP7 processing instruction, or None if the
+    instruction is not one we can decode.
+    """
+    target = instruction.target
+    if not target.startswith(TARGET):
+        return None
+    text = "{} {}".format(target[len(TARGET):], instruction.text or "")
+    # Payloads containing a "?" have never been decodable
+    if "?" in text:
+        return None
+    return text
+
+def noteEffects(note):
+    """
+    Return the decoded effects for the first GP7 instruction within the
+    given lxml <note> element.
+    """
+    for instruction in note.iter(etree.ProcessingInstruction):
+        text = payload(instruction)
+        if text is not None:
+            return decode(text)
+    return NO_EFFECTS
+
+class GP7Index:
+    """
+    A lookup of decoded GP7 effects, keyed by NotePosition (part ID,
+    measure number, index of the note, chord or rest within the measure,
+    by start and then in document order, as music21 orders them). The
+    notes of a chord share a position, and their effects. Notes without any
+    GP7 effects are not recorded.
+    """
+    def __init__(self):
+        self.notes = {}
+
+    def record(self, position, effects):
+        if not effects:
+            return
+        known = self.notes.get(position)
+        if known:
+            merged = dict(effects)
+            merged.update(known)
+            effects = types.MappingProxyType(merged)
+        self.notes[position] = effects
+
+    def get(self, part, measure, index):
+        return self.notes.get(NotePosition(part, measure, index), NO_EFFECTS)
+
+    def withEffect(self, name):
+        """
+        Return the positions of all notes carrying the named effect.
+        """
+        return [position for position, effects in self.notes.items()
+                if name in effects]
+
+    def __contains__(self, position):
+        return position in self.notes
+
+    def __iter__(self):
+        return iter(self.notes.items())
+
+    def __len__(self):
+        return len(self.notes)
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+
+import os.path
+
+"""
+A small Standard MIDI File writer, encoding events straight into bytes.
+
+MidiEvent and DeltaTime mirror the parts of music21.midi's classes that
+the transformation and the postprocessors use (type, channel, pitch,
+velocity, setPitchBend...), but are plain slotted objects. encodeTrack
+serializes them as music21's MidiTrack.getBytes does, so files are
+byte-identical to the ones music21 wrote, unless running status is asked for,
+except where music21 wrote a track no player can read (see encodeTrack).
+decodeTrack reads tracks back.
+"""
+
+TICKS_PER_QUARTER_NOTE = 1024
+
+CHANNEL_VOICE_MESSAGES = {
+    "NOTE_OFF": 0x80,
+    "NOTE_ON": 0x90,
+    "POLYPHONIC_KEY_PRESSURE": 0xA0,
+    "CONTROLLER_CHANGE": 0xB0,
+    "PROGRAM_CHANGE": 0xC0,
+    "CHANNEL_KEY_PRESSURE": 0xD0,
+    "PITCH_BEND": 0xE0,
+}
+
+# Channel voice messages with a single data byte
+SINGLE_DATA_MESSAGES = ("PROGRAM_CHANGE", "CHANNEL_KEY_PRESSURE")
+
+META_EVENTS = {
+    "SEQUENCE_NUMBER": 0x00,
+    "TEXT_EVENT": 0x01,
+    "SEQUENCE_TRACK_NAME": 0x03,
+    "INSTRUMENT_NAME": 0x04,
+    "MIDI_CHANNEL_PREFIX": 0x20,
+    "END_OF_TRACK": 0x2F,
+    "SET_TEMPO": 0x51,
+    "TIME_SIGNATURE": 0x58,
+    "KEY_SIGNATURE": 0x59,
+}
+
+class MidiException(Exception):
+    pass
+
+class MidiEvent:
+    __slots__ = ("track", "type", "time", "channel", "_parameter1", "_parameter2",
+                 "data")
+
+    def __init__(self, track=None, type=None, time=None, channel=None):
+        self.track = track
+        self.type = type
+        self.time = time
+        self.channel = channel
+        self._parameter1 = None
+        self._parameter2 = None
+        self.data = None
+
+    @property
+    def pitch(self):
+        return self._parameter1
+
+    @pitch.setter
+    def pitch(self, value):
+        self._parameter1 = value
+
+    @property
+    def velocity(self):
+        return self._parameter2
+
+    @velocity.setter
+    def velocity(self, value):
+        self._parameter2 = value
+
+    def setPitchBend(self, cents, bendRange=2):
+        """
+        Set the event's parameters for a bend of `cents`, given a bend range
+        in semitones, the way music21 does: for values that fit in 7 bits,
+        that puts the value in the MSB.
+        """
+        centRange = bendRange * 100
+        center = 8192
+        if cents > 0:
+            shift = int(round(cents / float(centRange) * (16383 - center)))
+        elif cents < 0:
+            shift = int(round(cents / float(centRange) * center))
+        else:
+            shift = 0
+        target = center + shift
+
+        if target > 0x7F:
+            self._parameter1 = target & 0x7F
+            self._parameter2 = (target >> 7) & 0x7F
+        else:
+            self._parameter1 = 0
+            self._parameter2 = target
+
+    def __repr__(self):
+        return "<MidiEvent {}, t={}, channel={}, parameters={},{}>".format(
+            self.type, self.time, self.channel, self._parameter1, self._parameter2)
+
+class DeltaTime(MidiEvent):
+    __slots__ = ()
+
+    def __init__(self, track=None, time=None, channel=None):
+        self.track = track
+        self.type = "DeltaTime"
+        self.time = time
+        self.channel = channel
+        self._parameter1 = None
+        self._parameter2 = None
+        self.data = None
+
+    def __repr__(self):
+        return "<MidiEvent DeltaTime, t={}>".format(self.time)
+
+def putNumber(number, length):
+    """
+    A big-endian, fixed-length number.
+    """
+    return number.to_bytes(length, "big")
+
+def putVariableLengthNumber(number):
+    """
+    A MIDI variable-length quantity.
+    """
+    if number < 0:
+        raise MidiException("cannot encode a negative variable-length number: {}".format(number))
+
+    encoded = bytearray([number & 0x7F])
+    number >>= 7
+    while number:
+        encoded.append((number & 0x7F) | 0x80)
+        number >>= 7
+    encoded.reverse()
+    return bytes(encoded)
+
+def _status(event):
+    if event.channel is None:
+        raise MidiException("{} has no channel".format(event))
+    return CHANNEL_VOICE_MESSAGES[event.type] + event.channel - 1
+
+def _dataByte(value):
+    # music21 wrote anything that fits in a byte
+    if value is None or not 0 <= value <= 0xFF:
+        raise MidiException("cannot encode data byte {}".format(value))
+    return value
+
+def encodeEvent(event, output, lastStatus=None):
+    """
+    Append one event to the bytearray `output`. Channel voice messages omit
+    their status byte when it equals `lastStatus` (running status).
+    Returns the running status after the event.
+
+    An event that can't be represented raises MidiException before anything
+    is appended.
+    """
+    if event.type == "DeltaTime":
+        output += putVariableLengthNumber(event.time)
+        return lastStatus
+
+    if event.type in CHANNEL_VOICE_MESSAGES:
+        status = _status(event)
+        if event.type in SINGLE_DATA_MESSAGES:
+            data = bytes([_dataByte(event.data)])
+        else:
+            data = bytes([_dataByte(event._parameter1), _dataByte(event._parameter2)])
+        if status != lastStatus:
+            output.append(status)
+        output += data
+        return status
+
+    if event.type in META_EVENTS:
+        data = event.data or b""
+        output.append(0xFF)
+        output.append(META_EVENTS[event.type])
+        output += putVariableLengthNumber(len(data))
+        output += data
+        # Meta events cancel running status
+        return None
+
+    raise MidiException("unknown MIDI event type: {}".format(event.type))
+
+def encodeTrack(events, runningStatus=False, endOfTrack=False):
+    """
+    Serialize events into an MTrk chunk.
+
+    Like music21, events that can't be encoded are skipped. Delta times add
+    up until the next event that is encoded, which gets their sum, so that
+    a track always alternates delta times and events; a negative sum is
+    written as 0, and the rest carried over to the next event. (music21
+    wrote the delta time of a skipped event, and skipped negative delta
+    times, leaving the rest of the track unreadable.)
+
+    No end-of-track event is added unless asked for, or unless delta times
+    are left over at the end, which it then carries.
+    """
+    body = bytearray()
+    lastStatus = None
+    pending = 0
+    for event in events:
+        if event.type == "DeltaTime":
+            pending += event.time
+            continue
+
+        encoded = bytearray()
+        try:
+            status = encodeEvent(event, encoded, lastStatus)
+        except MidiException:
+            continue
+        body += putVariableLengthNumber(max(pending, 0))
+        pending = min(pending, 0)
+        body += encoded
+        if runningStatus:
+            lastStatus = status
+
+    if endOfTrack or pending > 0:
+        body += putVariableLengthNumber(max(pending, 0)) + b"\xFF\x2F\x00"
+
+    return b"MTrk" + putNumber(len(body), 4) + bytes(body)
+
+def getVariableLengthNumber(data, offset):
+    """
+    The MIDI variable-length quantity at `offset` in `data`, and the offset
+    just past it.
+    """
+    number = 0
+    while True:
+        if offset >= len(data):
+            raise MidiException("truncated variable-length number")
+        byte = data[offset]
+        offset += 1
+        number = (number << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            return number, offset
+
+def decodeTrack(chunk):
+    """
+    The events of an MTrk chunk as a player reads them, running status
+    included: (tick, type, channel, data1, data2) tuples, with absolute
+    ticks. The type is a CHANNEL_VOICE_MESSAGES status nibble, or 0xFF for
+    meta events, whose data1 is the meta event type and data2 its payload.
+
+    Raises MidiException for a chunk that isn't well-formed.
+    """
+    if chunk[:4] != b"MTrk":
+        raise MidiException("not an MTrk chunk")
+    end = 8 + int.from_bytes(chunk[4:8], "big")
+    if end > len(chunk):
+        raise MidiException("truncated MTrk chunk")
+
+    decoded = []
+    offset = 8
+    tick = 0
+    lastStatus = None
+    singleData = {CHANNEL_VOICE_MESSAGES[name] for name in SINGLE_DATA_MESSAGES}
+
+    while offset < end:
+        delta, offset = getVariableLengthNumber(chunk, offset)
+        tick += delta
+        if offset >= end:
+            raise MidiException("delta time without an event at tick {}".format(tick))
+
+        status = chunk[offset]
+        if status == 0xFF:
+            if offset + 2 > end:
+                raise MidiException("truncated meta event at tick {}".format(tick))
+            metaType = chunk[offset + 1]
+            length, offset = getVariableLengthNumber(chunk, offset + 2)
+            decoded.append((tick, 0xFF, None, metaType, bytes(chunk[offset:offset + length])))
+            offset += length
+            lastStatus = None
+            continue
+
+        if status & 0x80:
+            if status >= 0xF0:
+                raise MidiException("unsupported status {:#x} at tick {}".format(status, tick))
+            offset += 1
+        elif lastStatus is None:
+            raise MidiException("data byte without a status at tick {}".format(tick))
+        else:
+            status = lastStatus
+
+        code = status & 0xF0
+        size = 1 if code in singleData else 2
+        data = chunk[offset:offset + size]
+        if len(data) < size or any(byte & 0x80 for byte in data):
+            raise MidiException("bad data bytes at tick {}".format(tick))
+        offset += size
+        decoded.append((tick, code, (status & 0x0F) + 1, data[0],
+                        data[1] if size == 2 else None))
+        lastStatus = status
+
+    return decoded
+
+def namedTrack(chunk, name):
+    """
+    An MTrk chunk with a SEQUENCE_TRACK_NAME meta event for `name` put
+    ahead of its events.
+    """
+    data = name.encode("utf-8")
+    event = (b"\x00\xFF" + bytes([META_EVENTS["SEQUENCE_TRACK_NAME"]]) +
+             putVariableLengthNumber(len(data)) + data)
+    return b"MTrk" + putNumber(len(chunk) - 8 + len(event), 4) + event + chunk[8:]
+
+def header(trackCount, ticksPerQuarterNote=TICKS_PER_QUARTER_NOTE, format=1):
+    """
+    The MThd chunk of a MIDI file.
+    """
+    return (b"MThd" + putNumber(6, 4) + putNumber(format, 2) +
+            putNumber(trackCount, 2) + putNumber(ticksPerQuarterNote, 2))
+
+def fileBytes(tracks, ticksPerQuarterNote=TICKS_PER_QUARTER_NOTE):
+    """
+    A format 1 MIDI file, in memory, from already-encoded MTrk chunks.
+    """
+    return header(len(tracks), ticksPerQuarterNote) + b"".join(tracks)
+
+def writeFile(filename, tracks, ticksPerQuarterNote=TICKS_PER_QUARTER_NOTE):
+    """
+    Write a format 1 MIDI file. Each track is either an already-encoded MTrk
+    chunk, or a function that writes one to the (seekable) file as it goes.
+    A file that couldn't be written in full is removed.
+    """
+    try:
+        with open(filename, "wb") as midiFile:
+            midiFile.write(header(len(tracks), ticksPerQuarterNote))
+            for track in tracks:
+                if callable(track):
+                    track(midiFile)
+                else:
+                    midiFile.write(track)
+    except BaseException:
+        if os.path.exists(filename):
+            os.remove(filename)
+        raise
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os.path
+
+from util import cache
+
+"""
+Output manifests: a record of the MIDI files a conversion produced, so that
+rerunning the converter with an unchanged input and unchanged options can
+stop before doing (or importing) anything expensive.
+
+Manifests live in the conversion cache, keyed by the hash of the input file,
+and hold the output directory, the postprocessors and options that were used
+and the hash of every MIDI file written (along with the part names, when
+those files aren't named after the parts).
+"""
+
+VARIANT = "outputs"
+
+def postprocessorNames(postprocs):
+    return [processor.__name__ for processor in postprocs]
+
+def _outputPath(directory, partName):
+    return os.path.join(directory, "{}.mid".format(partName))
+
+def _readManifest(path):
+    with open(path, "r") as manifestFile:
+        return json.load(manifestFile)
+
+def _manifestKey(filename, conversionCache, key):
+    # `key`, the input file's cache key, saves hashing it again
+    return conversionCache.subkey(key or conversionCache.key(filename), VARIANT)
+
+def upToDate(filename, postprocs, conversionCache, options=(), key=None):
+    """
+    If the last conversion of `filename` used the same postprocessors and
+    options, and its MIDI files are still in place and unmodified, return
+    its part names; otherwise return None.
+    """
+    manifest = conversionCache.get(_manifestKey(filename, conversionCache, key), _readManifest)
+    if manifest is None:
+        return None
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    if manifest["directory"] != directory:
+        return None
+    if manifest["postprocessors"] != postprocessorNames(postprocs):
+        return None
+    if manifest.get("options", []) != list(options):
+        return None
+
+    for partName, digest in manifest["outputs"].items():
+        try:
+            if cache.hashFile(_outputPath(directory, partName)) != digest:
+                return None
+        except OSError:
+            return None
+
+    return manifest.get("parts", list(manifest["outputs"]))
+
+def record(filename, postprocs, partNames, conversionCache, options=(), outputNames=None,
+           key=None):
+    """
+    Write the manifest for a conversion of `filename` that just produced
+    the MIDI files for `partNames`, or, when given, `outputNames`.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    manifest = {
+        "directory": directory,
+        "postprocessors": postprocessorNames(postprocs),
+        "options": list(options),
+        "outputs": {name: cache.hashFile(_outputPath(directory, name))
+                    for name in outputNames or partNames},
+    }
+    if outputNames is not None:
+        manifest["parts"] = list(partNames)
+
+    def write(path):
+        with open(path, "w") as manifestFile:
+            json.dump(manifest, manifestFile)
+
+    conversionCache.put(_manifestKey(filename, conversionCache, key), write)
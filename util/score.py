@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+
+from array import array
+from bisect import bisect_right
+from collections import namedtuple
+import json
+import mmap
+import struct
+import sys
+
+"""
+A compact, array-backed intermediate form of a parsed score, holding only
+what the MIDI transformation needs: per-part note offsets, durations, the
+offsets of the measures they belong to, pitches, ties and
+articulation/expression annotations, and the score's tempo boundaries.
+
+It is stored as a single binary file (a JSON header followed by aligned,
+native-endian columns) that is memory-mapped on load, so a cached score is
+usable without rebuilding (or even importing) a music21 object graph.
+"""
+
+MAGIC = b"GPXMSCOR"
+FORMAT_VERSION = 3
+ALIGNMENT = 8
+
+# Note kinds
+REST = 0
+NOTE = 1
+CHORD = 2
+
+# Tie types, as used by music21
+TIES = {None: 0, "start": 1, "continue": 2, "stop": 3}
+TIE_NAMES = {value: name for name, value in TIES.items()}
+
+# Annotation prefixes: tremolo marks (expressions), string harmonics
+# and technical indications (articulations), and Guitar Pro 7 effects
+# (see util.gp7)
+TREMOLO = "T"
+HARMONIC = "H"
+TECHNICAL = "X"
+GP7 = "G"
+
+# Column name -> array typecode
+NOTE_COLUMNS = [
+    ("offset", "d"),
+    ("duration", "d"),
+    ("measure", "d"),
+    ("kind", "B"),
+    ("pitchStart", "I"),
+    ("pitchCount", "I"),
+    ("annotationStart", "I"),
+    ("annotationCount", "I"),
+]
+PITCH_COLUMNS = [
+    ("midi", "h"),
+    ("tie", "B"),
+]
+ANNOTATION_COLUMNS = [
+    ("annotation", "I"),
+]
+COLUMNS = NOTE_COLUMNS + PITCH_COLUMNS + ANNOTATION_COLUMNS
+
+class ScoreFormatException(Exception):
+    pass
+
+class Note(namedtuple("Note", ["offset", "duration", "kind", "pitches", "ties",
+                               "annotations", "measure"])):
+    __slots__ = ()
+
+    @property
+    def isRest(self):
+        return self.kind == REST
+
+    @property
+    def isChord(self):
+        return self.kind == CHORD
+
+class CompactPart:
+    """
+    One part: `name` is the output name (PartStaff parts are prefixed by
+    their part ID), `partName` the name as it appears in the score.
+    """
+    def __init__(self, name, partName, columns, strings):
+        self.name = name
+        self.partName = partName
+        self.columns = columns
+        self.strings = strings
+
+    def __len__(self):
+        return len(self.columns["offset"])
+
+    def notes(self):
+        """
+        Yield a Note for each note, chord and rest, in order.
+        """
+        c = self.columns
+        offsets, durations, measures = c["offset"], c["duration"], c["measure"]
+        kinds = c["kind"]
+        pitchStarts, pitchCounts = c["pitchStart"], c["pitchCount"]
+        annotationStarts, annotationCounts = c["annotationStart"], c["annotationCount"]
+        midis, ties, annotations = c["midi"], c["tie"], c["annotation"]
+        strings = self.strings
+
+        for index in range(len(offsets)):
+            pitchStart = pitchStarts[index]
+            pitchEnd = pitchStart + pitchCounts[index]
+            annotationStart = annotationStarts[index]
+            annotationEnd = annotationStart + annotationCounts[index]
+            yield Note(offsets[index], durations[index], kinds[index],
+                       tuple(midis[pitchStart:pitchEnd]),
+                       tuple(ties[pitchStart:pitchEnd]),
+                       tuple(strings[i] for i in annotations[annotationStart:annotationEnd]),
+                       measures[index])
+
+    def __getstate__(self):
+        # Memory-mapped columns can't travel to another process as-is
+        state = dict(self.__dict__)
+        state["columns"] = {name: array(typecode, self.columns[name])
+                            for name, typecode in COLUMNS}
+        return state
+
+class CompactScore:
+    def __init__(self, parts, tempos):
+        self.parts = parts
+        # (offset in quarter notes, bpm) boundaries, in score order
+        self.tempos = tempos
+
+    def tempoMap(self, ticksPerQuarterNote):
+        """
+        The score's tempo.TempoMap.
+        """
+        from util import tempo
+
+        return tempo.TempoMap(self.tempos, ticksPerQuarterNote)
+
+    def save(self, filename):
+        strings = []
+        stringIndex = {}
+        header = {"version": FORMAT_VERSION, "byteorder": sys.byteorder,
+                  "tempos": self.tempos, "strings": strings, "parts": []}
+        blobs = []
+        position = 0
+
+        for part in self.parts:
+            # Parts share a single string table
+            remap = array("I")
+            for string in part.strings:
+                if string not in stringIndex:
+                    stringIndex[string] = len(strings)
+                    strings.append(string)
+                remap.append(stringIndex[string])
+
+            columns = dict(part.columns)
+            columns["annotation"] = array("I", (remap[i] for i in part.columns["annotation"]))
+
+            # Column offsets are relative to the (aligned) end of the header
+            layout = {}
+            for name, typecode in COLUMNS:
+                blob = array(typecode, columns[name]).tobytes()
+                layout[name] = [position, len(columns[name])]
+                blobs.append((position, blob))
+                position = _align(position + len(blob))
+            header["parts"].append({"name": part.name, "partName": part.partName,
+                                    "columns": layout})
+
+        encodedHeader = json.dumps(header).encode("utf-8")
+        dataStart = _align(len(MAGIC) + 4 + len(encodedHeader))
+
+        with open(filename, "wb") as scoreFile:
+            scoreFile.write(MAGIC)
+            scoreFile.write(struct.pack("<I", len(encodedHeader)))
+            scoreFile.write(encodedHeader)
+            written = len(MAGIC) + 4 + len(encodedHeader)
+            for offset, blob in blobs:
+                scoreFile.write(b"\0" * (dataStart + offset - written))
+                scoreFile.write(blob)
+                written = dataStart + offset + len(blob)
+
+def _align(position):
+    return (position + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def load(filename):
+    """
+    Memory-map a saved CompactScore. Columns are zero-copy views of the file.
+    """
+    with open(filename, "rb") as scoreFile:
+        mapped = mmap.mmap(scoreFile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if mapped[:len(MAGIC)] != MAGIC:
+        raise ScoreFormatException("{} is not a compact score".format(filename))
+    headerLength, = struct.unpack_from("<I", mapped, len(MAGIC))
+    headerStart = len(MAGIC) + 4
+    header = json.loads(mapped[headerStart:headerStart + headerLength].decode("utf-8"))
+    if header["version"] != FORMAT_VERSION or header["byteorder"] != sys.byteorder:
+        raise ScoreFormatException("{} has an incompatible format".format(filename))
+
+    view = memoryview(mapped)
+    dataStart = _align(headerStart + headerLength)
+    strings = header["strings"]
+    parts = []
+    for part in header["parts"]:
+        columns = {}
+        for name, typecode in COLUMNS:
+            offset, count = part["columns"][name]
+            offset += dataStart
+            size = array(typecode).itemsize
+            columns[name] = view[offset:offset + count * size].cast(typecode)
+        parts.append(CompactPart(part["name"], part["partName"], columns, strings))
+
+    return CompactScore(parts, [tuple(tempo) for tempo in header["tempos"]])
+
+def _annotations(note):
+    """
+    Everything createMIDIEvents reads from a note's expressions and
+    articulations, in the order it reads them.
+    """
+    import music21
+
+    annotations = []
+    for expression in note.expressions:
+        if isinstance(expression, music21.expressions.Tremolo):
+            annotations.append(TREMOLO + str(expression.numberOfMarks))
+
+    for articulation in note.articulations:
+        if isinstance(articulation, music21.articulations.StringHarmonic):
+            annotations.append(HARMONIC + str(articulation.harmonicType))
+        if isinstance(articulation, music21.articulations.TechnicalIndication):
+            if articulation.displayText:
+                annotations.append(TECHNICAL + articulation.displayText)
+
+    return annotations
+
+def compactPart(part, name=None, gp7Effects=None):
+    """
+    Reduce a music21 part to a CompactPart. `gp7Effects` maps the id() of
+    its notes to their GP7 effects, if any (see _gp7Effects).
+    """
+    import music21
+
+    columns = {name: array(typecode) for name, typecode in COLUMNS}
+    strings = []
+    stringIndex = {}
+
+    # Notes are attributed to the last measure starting at or before them
+    measureStarts = sorted(float(measure.offset)
+                           for measure in part.getElementsByClass("Measure")) or [0.0]
+
+    for note in part.flat.notesAndRests:
+        if isinstance(note, music21.note.NotRest):
+            innerNotes = list(note) if note.isChord else [note]
+            kind = CHORD if note.isChord else NOTE
+        else:
+            innerNotes = []
+            kind = REST
+
+        offset = float(note.offset)
+        measureIndex = max(bisect_right(measureStarts, offset) - 1, 0)
+        columns["offset"].append(offset)
+        columns["duration"].append(float(note.duration.quarterLength))
+        columns["measure"].append(measureStarts[measureIndex])
+        columns["kind"].append(kind)
+
+        columns["pitchStart"].append(len(columns["midi"]))
+        columns["pitchCount"].append(len(innerNotes))
+        for innerNote in innerNotes:
+            columns["midi"].append(innerNote.pitch.midi)
+            tie = innerNote.tie
+            columns["tie"].append(TIES.get(tie.type, 0) if tie else 0)
+
+        annotations = _annotations(note)
+        if gp7Effects:
+            annotations.extend(GP7 + effect for effect in gp7Effects.get(id(note), ()))
+        columns["annotationStart"].append(len(columns["annotation"]))
+        columns["annotationCount"].append(len(annotations))
+        for annotation in annotations:
+            if annotation not in stringIndex:
+                stringIndex[annotation] = len(strings)
+                strings.append(annotation)
+            columns["annotation"].append(stringIndex[annotation])
+
+    return CompactPart(name or part.partName, part.partName, columns, strings)
+
+def _partId(part):
+    # The ID of the MusicXML <part> (PartStaff parts share theirs)
+    return part.getInstrument().partId or part.id
+
+def _gp7Effects(partId, parts, gp7Index):
+    """
+    The GP7 effects of the notes of a MusicXML part (all of its staves), by
+    the id() of the music21 note, from a GP7Index: a measure's notes, chords
+    and rests are numbered by offset, then in document order (staff by
+    staff, voice by voice), as extract.standardizeExpressions numbers them.
+    """
+    effects = {}
+    if not gp7Index:
+        return effects
+
+    measures = {}
+    for part in parts:
+        for measure in part.getElementsByClass("Measure"):
+            number = "{}{}".format(measure.number, measure.numberSuffix or "")
+            measures.setdefault(number, []).extend(
+                (note.offset, note) for note in measure.recurse().notesAndRests)
+
+    for number, notes in measures.items():
+        # A stable sort keeps document order at equal offsets
+        notes.sort(key=lambda entry: entry[0])
+        for index, (offset, note) in enumerate(notes):
+            found = gp7Index.get(partId, number, index)
+            if found:
+                effects[id(note)] = found
+    return effects
+
+def compactScores(score, profiler=None, gp7Index=None):
+    """
+    Reduce a music21 score to a CompactScore per MusicXML part (the staves
+    of a PartStaff part stay together), as (part ID, CompactScore) pairs in
+    score order, and the tempo boundaries of the whole score. The parts
+    hold no tempos of their own: Guitar Pro only writes metronome marks in
+    one part, which may not be among them (its tempo skeleton stands in for
+    it, see extract.PartSelection).
+
+    With a `profiler` (see util.stages), tempo extraction is timed as a
+    stage of its own. With the GP7Index normalization filled (see
+    extract.standardizeExpressions), notes are annotated with their GP7
+    effects.
+    """
+    import music21
+    from util import extract
+    from util import stages
+
+    profiler = profiler or stages.NULL_PROFILER
+
+    groups = {}
+    for part in score.parts:
+        partId = _partId(part)
+        if not extract.isTempoPart(partId):
+            groups.setdefault(partId, []).append(part)
+
+    scores = []
+    for partId, parts in groups.items():
+        gp7Effects = _gp7Effects(partId, parts, gp7Index)
+        compactParts = []
+        for part in parts:
+            name = part.partName
+            if isinstance(part, music21.stream.PartStaff):
+                name = "{}-{}".format(part.getInstrument().partId, name)
+            compactParts.append(compactPart(part, name, gp7Effects))
+        scores.append((partId, CompactScore(compactParts, [])))
+
+    with profiler.stage("tempos"):
+        tempos = extract.getTempoBoundaries(score)
+
+    return scores, tempos
+
+def merge(scores, tempos):
+    """
+    A single CompactScore with the parts of `scores`, in order, and the
+    given tempo boundaries.
+    """
+    parts = []
+    for compact in scores:
+        parts.extend(compact.parts)
+    return CompactScore(parts, list(tempos))
+
+def compactScore(score, gp7Index=None):
+    """
+    Reduce a music21 score to a CompactScore (see compactScores).
+    """
+    scores, tempos = compactScores(score, gp7Index=gp7Index)
+    return merge((compact for partId, compact in scores), tempos)
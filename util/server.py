@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+import base64
+from collections import deque
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import multiprocessing
+import os
+import socketserver
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+from postprocess import checkForPreprocessor, postprocessorChain
+from util import convert
+from util import outputs
+
+"""
+A local conversion server, for scripts (e.g. on the Reaper side) that would
+otherwise pay for a fresh interpreter and music21 import on every run.
+
+Conversions run in a pool of worker processes that are forked, and import
+music21, before the first request arrives. The queue of pending conversions
+is bounded: beyond it, requests are turned away (503) rather than left to
+pile up. Identical requests (same MusicXML, same options) that arrive while
+one is already being converted wait for that conversion instead of
+starting their own.
+
+    POST /convert?postprocessor=realeight&normalize=1&parts=Bass,Drums
+        The MusicXML document is the request body (a Content-Length is
+        required). Other options are optimize=1, running-status=1,
+        bend-resolution=<ticks> and thin-bends=1.
+        Answers {"parts": {partName: base64-encoded MIDI file}}.
+
+    GET /metrics
+        Queue depth, conversions in flight, request counts, and the median
+        and 99th percentile latency (in seconds) of recent requests.
+"""
+
+DEFAULT_PORT = 8765
+DEFAULT_QUEUE_SIZE = 32
+LATENCY_WINDOW = 1024
+
+class QueueFull(Exception):
+    pass
+
+class LengthRequired(Exception):
+    pass
+
+def _initWorker():
+    # Workers are forked up front, and warm up before their first request
+    import music21
+    import util.convert
+
+def _convert(data, postprocs, renderOptions, parts):
+    return convert.convertBytes(data, postprocs, renderOptions=renderOptions, parts=parts)
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def requestLength(headers):
+    """
+    The length of a request's body, from its Content-Length header.
+    """
+    length = headers.get("Content-Length")
+    if length is None:
+        raise LengthRequired("a Content-Length header is required")
+    if not length.strip().isdigit():
+        raise ValueError("bad Content-Length: '{}'".format(length))
+    return int(length)
+
+def requestOptions(query):
+    """
+    The postprocessors, render options and part selection of a request,
+    given its parsed query string.
+    """
+    def flag(name):
+        return query.get(name, ["0"])[-1].lower() in ("1", "true", "yes")
+
+    postproc = query.get("postprocessor", [None])[-1]
+    if postproc is not None and not checkForPreprocessor(postproc):
+        raise ValueError("'{}' is not a recognized postprocessor".format(postproc))
+    postprocs = postprocessorChain(postproc, flag("normalize"), flag("optimize"))
+
+    renderOptions = convert.DEFAULT_RENDER_OPTIONS._replace(
+        runningStatus=flag("running-status"), thinBends=flag("thin-bends"))
+    if "bend-resolution" in query:
+        resolution = int(query["bend-resolution"][-1])
+        if resolution <= 0:
+            raise ValueError("bend resolution must be a positive number of ticks")
+        renderOptions = renderOptions._replace(bendResolution=resolution)
+
+    parts = [name.strip() for value in query.get("parts", []) for name in value.split(",")
+             if name.strip()]
+    return postprocs, renderOptions, parts or None
+
+class ConversionPool:
+    def __init__(self, workers=None, queueSize=DEFAULT_QUEUE_SIZE):
+        self.workers = workers or os.cpu_count() or 1
+        self.queueSize = queueSize
+        self.pool = multiprocessing.Pool(self.workers, initializer=_initWorker)
+
+        self.lock = threading.Lock()
+        # Request key -> AsyncResult, for every conversion queued or running
+        self.inFlight = {}
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.counts = {"requests": 0, "coalesced": 0, "rejected": 0, "errors": 0}
+
+    def convert(self, data, postprocs=(), renderOptions=None, parts=None):
+        """
+        Convert MusicXML bytes in a worker (see convert.convertBytes), or
+        wait for an identical conversion already in flight. Raises QueueFull
+        when too many conversions are pending.
+        """
+        start = time.perf_counter()
+        renderOptions = renderOptions or convert.DEFAULT_RENDER_OPTIONS
+        key = hashlib.sha1(repr((outputs.postprocessorNames(postprocs), tuple(renderOptions),
+                                 parts)).encode("utf-8") + data).hexdigest()
+
+        with self.lock:
+            self.counts["requests"] += 1
+            result = self.inFlight.get(key)
+            if result is not None:
+                self.counts["coalesced"] += 1
+            elif len(self.inFlight) >= self.queueSize:
+                self.counts["rejected"] += 1
+                raise QueueFull("{} conversions are already pending".format(len(self.inFlight)))
+            else:
+                result = self.pool.apply_async(_convert, (data, postprocs, renderOptions, parts))
+                self.inFlight[key] = result
+
+        try:
+            return result.get()
+        except Exception:
+            with self.lock:
+                self.counts["errors"] += 1
+            raise
+        finally:
+            with self.lock:
+                if self.inFlight.get(key) is result:
+                    del self.inFlight[key]
+                self.latencies.append(time.perf_counter() - start)
+
+    def metrics(self):
+        with self.lock:
+            ordered = sorted(self.latencies)
+            inFlight = len(self.inFlight)
+            metrics = dict(self.counts)
+
+        metrics.update({
+            "workers": self.workers,
+            "inFlight": inFlight,
+            "queueDepth": max(0, inFlight - self.workers),
+            "queueSize": self.queueSize,
+            "p50": _percentile(ordered, 0.5),
+            "p99": _percentile(ordered, 0.99),
+        })
+        return metrics
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = "gpXmlMidi"
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/metrics":
+            self._reply(200, self.server.conversions.metrics())
+        else:
+            self._reply(404, {"error": "not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/convert":
+            self._reply(404, {"error": "not found"})
+            return
+
+        try:
+            data = self.rfile.read(requestLength(self.headers))
+            postprocs, renderOptions, parts = requestOptions(parse_qs(url.query))
+            midiFiles = self.server.conversions.convert(data, postprocs,
+                                                        renderOptions=renderOptions, parts=parts)
+        except LengthRequired as err:
+            self._reply(411, {"error": str(err)})
+        except QueueFull as err:
+            self._reply(503, {"error": str(err)})
+        except ValueError as err:
+            # A bad Content-Length or bad options, or parts that match nothing
+            self._reply(400, {"error": str(err)})
+        except Exception as err:
+            self._reply(500, {"error": "{}: {}".format(type(err).__name__, err)})
+        else:
+            self._reply(200, {"parts": {partName: base64.b64encode(midiBytes).decode("ascii")
+                                        for partName, midiBytes in midiFiles.items()}})
+
+    def _reply(self, status, body):
+        encoded = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "local"
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def createServer(conversions, port=DEFAULT_PORT, socketPath=None):
+    """
+    An HTTP server for a ConversionPool, on a Unix socket if a path is
+    given, and on localhost otherwise.
+    """
+    if socketPath:
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+        server = UnixHTTPServer(socketPath, Handler)
+    else:
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        server.daemon_threads = True
+    server.conversions = conversions
+    return server
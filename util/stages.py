@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+
+from contextlib import contextmanager, nullcontext
+import json
+import os
+import time
+import tracemalloc
+
+from util import events
+
+"""
+Stage profiling for a conversion (`converter --profile`): wall and CPU
+time and peak traced memory (see tracemalloc, counted from what was in
+use when the stage started) of every stage, from the cache lookup to writing each part, plus per-part counts of the events
+generated, by type.
+
+Stages nest, and entering the same stage again (under the same parent)
+adds to it. That is how the stages of a part, which all run interleaved
+in a single streaming pass (see postprocess.schedule), are told apart:
+event generation and each postprocessor are timed call by call, and
+whatever is left of the part's own time went into encoding and writing
+(and into the profiler's own bookkeeping). Those per-call stages are only
+timed; their memory is part of the part's.
+
+Optionally, each top-level stage also runs under cProfile, and the
+statistics of the slowest one are dumped for pstats or snakeviz.
+"""
+
+FORMATS = ("json", "chrome")
+
+class Stage:
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        # None for stages timed call by call
+        self.peakMemory = 0
+        # Seconds from the start of profiling to the first call
+        self.start = None
+        self.children = {}
+        self.cProfile = None
+
+    def ownWall(self):
+        return self.wall - sum(child.wall for child in self.children.values())
+
+    def report(self):
+        return {
+            "name": self.name,
+            "calls": self.calls,
+            "wall": self.wall,
+            "cpu": self.cpu,
+            "self": self.ownWall(),
+            "peakMemory": self.peakMemory,
+            "children": [child.report() for child in self.children.values()],
+        }
+
+class _Frame:
+    __slots__ = ("stage", "wall", "cpu", "memory", "peak")
+
+    def __init__(self, stage, wall, cpu, memory):
+        self.stage = stage
+        self.wall = wall
+        self.cpu = cpu
+        # Traced memory at entry, and the highest seen since
+        self.memory = memory
+        self.peak = memory
+
+class Profiler:
+    def __init__(self, cProfile=False):
+        self.root = Stage(None)
+        self.stack = []
+        self.parts = {}
+        self.useCProfile = cProfile
+        self.started = None
+        self.startedTracing = False
+        # Traced memory at start, and the highest seen since outside stages
+        self.memory = 0
+        self.peak = 0
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.startedTracing = True
+        self.memory = self.peak = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        self.started = time.perf_counter()
+        self.startCpu = time.process_time()
+
+    def stop(self):
+        self.root.wall = time.perf_counter() - self.started
+        self.root.cpu = time.process_time() - self.startCpu
+        self.root.peakMemory = max(self.peak, tracemalloc.get_traced_memory()[1]) - self.memory
+        if self.startedTracing:
+            tracemalloc.stop()
+
+    def _child(self, name):
+        stages = (self.stack[-1].stage if self.stack else self.root).children
+        stage = stages.get(name)
+        if stage is None:
+            stage = stages[name] = Stage(name)
+            stage.start = time.perf_counter() - self.started
+        return stage
+
+    def enter(self, name):
+        parent = self.stack[-1] if self.stack else None
+        current, peak = tracemalloc.get_traced_memory()
+        # The peak is about to be reset for this stage
+        if parent is not None:
+            parent.peak = max(parent.peak, peak)
+        else:
+            self.peak = max(self.peak, peak)
+        tracemalloc.reset_peak()
+
+        stage = self._child(name)
+
+        if self.useCProfile and parent is None:
+            import cProfile
+            if stage.cProfile is None:
+                stage.cProfile = cProfile.Profile()
+            stage.cProfile.enable()
+
+        self.stack.append(_Frame(stage, time.perf_counter(), time.process_time(), current))
+
+    def exit(self):
+        frame = self.stack.pop()
+        stage = frame.stage
+        stage.wall += time.perf_counter() - frame.wall
+        stage.cpu += time.process_time() - frame.cpu
+        stage.calls += 1
+
+        peak = max(frame.peak, tracemalloc.get_traced_memory()[1])
+        stage.peakMemory = max(stage.peakMemory, peak - frame.memory)
+        if self.stack:
+            self.stack[-1].peak = max(self.stack[-1].peak, peak)
+            return
+        self.peak = max(self.peak, peak)
+        if stage.cProfile is not None:
+            stage.cProfile.disable()
+
+    @contextmanager
+    def stage(self, name):
+        self.enter(name)
+        try:
+            yield
+        finally:
+            self.exit()
+
+    def timed(self, name, rows):
+        """
+        Yield from `rows`, timing the work of producing each one as the
+        stage `name`, under the current stage.
+        """
+        stage = self._child(name)
+        stage.peakMemory = None
+
+        def timedRows():
+            perfCounter, processTime = time.perf_counter, time.process_time
+            iterator = iter(rows)
+            while True:
+                wall, cpu = perfCounter(), processTime()
+                try:
+                    row = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    stage.wall += perfCounter() - wall
+                    stage.cpu += processTime() - cpu
+                    stage.calls += 1
+                yield row
+
+        return timedRows()
+
+    def counted(self, partName, rows):
+        """
+        Yield from `rows`, counting them by type for the part `partName`.
+        """
+        counts = self.parts.setdefault(partName, {}).setdefault("events", {})
+        for row in rows:
+            code = row[events.TYPE]
+            name = events.TYPE_NAMES.get(code) or events.META_NAMES.get(row[events.DATA1])
+            counts[name] = counts.get(name, 0) + 1
+            yield row
+
+    def recordBytes(self, partName, size):
+        self.parts.setdefault(partName, {})["bytes"] = size
+
+    def instrument(self, processor):
+        """
+        Time a postprocessor instance's work as a stage named after its
+        class, under the current stage, whichever of its methods
+        postprocess.schedule calls.
+        """
+        stage = self._child(type(processor).__name__)
+        stage.peakMemory = None
+        for method in ("map", "flush", "reduce", "finalize", "process", "run"):
+            if hasattr(processor, method):
+                setattr(processor, method, _timedMethod(stage, getattr(processor, method)))
+        return processor
+
+    def hottest(self):
+        """
+        The top-level stage that took the longest.
+        """
+        stages = list(self.root.children.values())
+        return max(stages, key=lambda stage: stage.wall) if stages else None
+
+    def dumpCProfile(self, filename):
+        """
+        Write the cProfile statistics of the hottest stage to `filename`.
+        Returns the stage's name.
+        """
+        stage = self.hottest()
+        if stage is None or stage.cProfile is None:
+            return None
+        stage.cProfile.dump_stats(filename)
+        return stage.name
+
+    def report(self, source=None):
+        hottest = self.hottest()
+        return {
+            "file": source,
+            "wall": self.root.wall,
+            "cpu": self.root.cpu,
+            "peakMemory": self.root.peakMemory,
+            "hottest": hottest.name if hottest else None,
+            "stages": [stage.report() for stage in self.root.children.values()],
+            "parts": self.parts,
+        }
+
+    def chromeTrace(self, source=None):
+        """
+        The stages in Chrome's trace event format (chrome://tracing or
+        Perfetto). Stages entered more than once are shown as one span per
+        stage, laid end to end from their parent's start.
+        """
+        pid = os.getpid()
+        traceEvents = [{"name": "process_name", "ph": "M", "pid": pid,
+                        "args": {"name": source or "converter"}}]
+
+        def add(stage, start):
+            args = {"calls": stage.calls, "cpu": stage.cpu, "peakMemory": stage.peakMemory}
+            if stage.name.startswith("part:"):
+                args.update(self.parts.get(stage.name[5:], {}))
+            traceEvents.append({"name": stage.name, "ph": "X", "pid": pid, "tid": 0,
+                                "ts": start * 1000000, "dur": stage.wall * 1000000,
+                                "args": args})
+
+            aggregated = start
+            for child in stage.children.values():
+                if child.calls == 1:
+                    add(child, child.start)
+                else:
+                    add(child, aggregated)
+                    aggregated += child.wall
+
+        for stage in self.root.children.values():
+            add(stage, stage.start)
+        return {"traceEvents": traceEvents, "displayTimeUnit": "ms"}
+
+    def write(self, filename, format="json", source=None):
+        report = self.chromeTrace(source) if format == "chrome" else self.report(source)
+        with open(filename, "w") as profileFile:
+            json.dump(report, profileFile, indent=2)
+
+def _timedMethod(stage, method):
+    perfCounter, processTime = time.perf_counter, time.process_time
+
+    def timedMethod(*args):
+        wall, cpu = perfCounter(), processTime()
+        try:
+            return method(*args)
+        finally:
+            stage.wall += perfCounter() - wall
+            stage.cpu += processTime() - cpu
+            stage.calls += 1
+    return timedMethod
+
+class NullProfiler:
+    """
+    Stands in for a Profiler when not profiling, at next to no cost.
+    """
+    def stage(self, name):
+        return nullcontext()
+
+    def timed(self, name, rows):
+        return rows
+
+    def counted(self, partName, rows):
+        return rows
+
+    def recordBytes(self, partName, size):
+        pass
+
+    def instrument(self, processor):
+        return processor
+
+NULL_PROFILER = NullProfiler()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+from bisect import bisect_right
+
+from util import midi
+
+"""
+Tempo maps: a score's tempo changes as a sorted index of ticks to
+microseconds per quarter note, built once from its tempo boundaries (see
+extract.getTempoBoundaries and score.CompactScore).
+
+Looking up the tempo or the elapsed time at a tick is a binary search, so
+scores with hundreds of tempo changes cost next to nothing.
+"""
+
+# The MIDI default, in effect until the first tempo change
+DEFAULT_MICROSECONDS_PER_QUARTER = 500000
+
+class TempoMap:
+    def __init__(self, boundaries, ticksPerQuarterNote=midi.TICKS_PER_QUARTER_NOTE):
+        """
+        `boundaries` are (offset in quarter notes, BPM) pairs, in score
+        order; of several changes on the same tick, the last one wins.
+        """
+        self.ticksPerQuarterNote = ticksPerQuarterNote
+
+        changes = {}
+        for startTime, bpm in boundaries:
+            changes[int(startTime * ticksPerQuarterNote)] = bpm
+        self.ticks = sorted(changes)
+        self.bpms = [changes[tick] for tick in self.ticks]
+        self.tempos = [int(round(60000000 / bpm)) for bpm in self.bpms]
+
+        # Elapsed microseconds at each change
+        self.starts = []
+        elapsed = 0
+        tick = 0
+        tempo = DEFAULT_MICROSECONDS_PER_QUARTER
+        for changeTick, changeTempo in zip(self.ticks, self.tempos):
+            elapsed += (changeTick - tick) * tempo / ticksPerQuarterNote
+            self.starts.append(elapsed)
+            tick = changeTick
+            tempo = changeTempo
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def tempoAt(self, tick):
+        """
+        The tempo in effect at `tick`, in microseconds per quarter note.
+        """
+        index = bisect_right(self.ticks, tick) - 1
+        return self.tempos[index] if index >= 0 else DEFAULT_MICROSECONDS_PER_QUARTER
+
+    def seconds(self, tick):
+        """
+        The time elapsed from the start of the score to `tick`, in seconds.
+        """
+        index = bisect_right(self.ticks, tick) - 1
+        if index < 0:
+            elapsed = tick * DEFAULT_MICROSECONDS_PER_QUARTER / self.ticksPerQuarterNote
+        else:
+            elapsed = (self.starts[index] +
+                       (tick - self.ticks[index]) * self.tempos[index] / self.ticksPerQuarterNote)
+        return elapsed / 1000000
+
+    def events(self):
+        """
+        The events of a tempo track. Each change is preceded by its own
+        zero delta time, as music21's tempoToMidiEvents produces them.
+        """
+        events = []
+        tempoOffset = 0
+        for tick, tempo in zip(self.ticks, self.tempos):
+            if tick > tempoOffset:
+                events.append(midi.DeltaTime(time=tick - tempoOffset))
+                tempoOffset = tick
+
+            events.append(midi.DeltaTime(time=0))
+            change = midi.MidiEvent(type="SET_TEMPO", channel=1)
+            change.data = midi.putNumber(tempo, 3)
+            events.append(change)
+
+        return events
+
+    def encode(self):
+        """
+        The tempo track, as an MTrk chunk.
+        """
+        return midi.encodeTrack(self.events())
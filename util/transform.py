@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
 
-import math
-import music21
+from collections import OrderedDict, namedtuple
+from itertools import groupby
+from operator import attrgetter
 import sys
 
+from util import bends
+from util import midi
+from util import score
+from util.events import META, eventFromRow, rowFromEvent
+
 """
 Transformation methods for creating MIDI events from various data formats.
 """
@@ -19,200 +25,220 @@ DYNAMICS_VELOCITY_MAP = {
     "fff": 127
 }
 
-BEND_INCREMENT_TICKS = 64
-
 TREMOLO_UNITS = {"1": 0.5, "2": 0.25, "3": 0.125}
 
+MEASURE_TEMPLATE_CACHE_SIZE = 128
+
 def _findTieSkips(note):
     skips = {}
-    innerNotes = note if note.isChord else [note]
 
-    for innerNote in innerNotes:
+    for pitch, tie in zip(note.pitches, note.ties):
         on = False
         off = False
 
-        currentTie = innerNote.tie
+        currentTie = score.TIE_NAMES[tie]
         if currentTie:
-            if currentTie.type == "start":
+            if currentTie == "start":
                 on = False
                 off = True
-            elif currentTie.type == "continue":
+            elif currentTie == "continue":
                 on = True
                 off = True
-            elif currentTie.type == "stop":
+            elif currentTie == "stop":
                 on = True
                 off = False
 
-        skips[innerNote.pitch.midi] = {"on": on, "off": off}
+        skips[pitch] = {"on": on, "off": off}
 
     return skips
 
-def _createBend(bendValues, duration, track):
+def _noteEvents(note):
     """
-    This function takes a list of bend function data points, in semitones,
-    and adds a series of CC MIDI events to the given MIDITrack, to match the
-    desired outcome.
-
-    Note that all bends are rendered with the same algorithm:
-    for each equal-length segment of the desired duration, the first half
-    of that segment will be curved via a cosine function, and the second
-    half will hold the target bend value.
+    The same events music21's noteToMidiEvents and chordToMidiEvents
+    create: a NOTE_ON per pitch, then a NOTE_OFF per pitch once the
+    note's duration has elapsed.
     """
     events = []
+    duration = int(round(note.duration * midi.TICKS_PER_QUARTER_NOTE))
 
-    valueCount = len(bendValues) - 1
-    segmentDuration = int(duration / valueCount)
-    timeTally = 0
-    lastValue = 0
-    index = 0
-
-    while index < valueCount:
-        start = float(bendValues[index])
-        end = float(bendValues[index + 1])
-        bendRange = end - start
-        halfSegmentDuration = round(segmentDuration / 2)
-        increment = int(halfSegmentDuration / BEND_INCREMENT_TICKS)
-        subTimeTally = 0
-        actual = 0
-        for step in range(0, increment):
-            factor = step / increment
-            if bendRange < 0:
-                factor = math.cos(1.5708 * factor)
-            else:
-                factor = 1 - math.cos(1.5708 * factor)
-            bendValue = factor * bendRange
-            actual = round(100 * (start + bendValue))
-
-            delta = music21.midi.DeltaTime(track)
-            delta.time = BEND_INCREMENT_TICKS
-            events.append(delta)
-
-            bend = music21.midi.MidiEvent(track, type="PITCH_BEND", channel=1)
-            bend.setPitchBend(actual)
-            events.append(bend)
-
-            subTimeTally += BEND_INCREMENT_TICKS
-            timeTally += BEND_INCREMENT_TICKS
-
-        remainder = segmentDuration - subTimeTally
-        delta = music21.midi.DeltaTime(track)
-        delta.time = remainder
+    for pitch in note.pitches:
+        delta = midi.DeltaTime(None)
+        delta.time = 0
         events.append(delta)
 
-        bend = music21.midi.MidiEvent(track, type="PITCH_BEND", channel=1)
-        bend.setPitchBend(actual)
-        events.append(bend)
+        on = midi.MidiEvent(None, type="NOTE_ON", channel=1)
+        on.time = None
+        on.pitch = pitch
+        on.velocity = 90
+        events.append(on)
 
-        timeTally += remainder
+    for index, pitch in enumerate(note.pitches):
+        delta = midi.DeltaTime(None)
+        delta.time = duration if index == 0 else 0
+        events.append(delta)
 
-        index += 1
+        off = midi.MidiEvent(None, type="NOTE_OFF", channel=1)
+        off.time = None
+        off.pitch = pitch
+        off.velocity = 0
+        events.append(off)
 
-    if timeTally < duration:
-        delta = music21.midi.DeltaTime(track)
-        delta.time = timeTally - duration
-        events.append(delta)
-    else:
-        delta = music21.midi.DeltaTime(track)
-        delta.time = 0
+    return events
+
+def _createBend(bendValues, duration, track, resolution=bends.DEFAULT_RESOLUTION,
+                thin=False):
+    """
+    This function takes a list of bend function data points, in semitones,
+    and returns the series of pitch bend MIDI events that match the desired
+    outcome (see util.bends for the algorithm).
+    """
+    events = []
+
+    for time, lsb, msb in bends.render(tuple(bendValues), duration, resolution, thin):
+        delta = midi.DeltaTime(track)
+        delta.time = time
         events.append(delta)
 
-    bend = music21.midi.MidiEvent(track, type="PITCH_BEND", channel=1)
-    bend.time = 0
-    bend.setPitchBend(0)
-    events.append(bend)
+        bend = midi.MidiEvent(track, type="PITCH_BEND", channel=1)
+        bend._parameter1 = lsb
+        bend._parameter2 = msb
+        events.append(bend)
 
     return events
 
-def createMIDIEvents(part, track, verbose=False):
-
-    # One special preprocess step: find any tremolo notes and
-    # split them into distinct notes.
-    notesAndRests = []
-    for note in part.flat.notesAndRests:
-        innerNotes = [note]
-
-        tremolos = [exp for exp in note.expressions if isinstance(exp, music21.expressions.Tremolo)]
-        if tremolos:
-            tremolo = str(tremolos[0].numberOfMarks)
-            unit = TREMOLO_UNITS.get(tremolo)
-            if unit:
-                innerNotes = []
-                originalLength = note.duration.quarterLength
-                count, remainder = divmod(originalLength, unit)
-                segments = [unit] * int(count)
-                if remainder:
-                    segments.append(remainder)
-
-                index = 0
-                while index < len(segments):
-                    note.quarterLength = segments[index]
-                    innerNotes.append(note)
-                    index += 1
-
-        notesAndRests.extend(innerNotes)
-
-    # With that last preprocessing out of the way, we know all of our notes
-    # and rests. We can proceed with true Music21 -> MIDI transformation.
-    partName = part.partName.casefold()
+MeasureTemplate = namedtuple("MeasureTemplate", ["rows", "slack", "velocity", "wasRinging"])
+
+class MeasureTemplates:
+    """
+    A part's compiled measures, by fingerprint, with hit and miss counts.
+    Only the `maxsize` most recently used are kept: riffs recur within a
+    few sections, and a long part that hardly repeats would otherwise keep
+    the rows of every measure it compiled.
+    """
+    def __init__(self, maxsize=MEASURE_TEMPLATE_CACHE_SIZE):
+        self.templates = OrderedDict()
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        The template for `key`, or None, counting a hit or a miss.
+        """
+        template = self.templates.get(key)
+        if template is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.templates.move_to_end(key)
+        return template
+
+    def put(self, key, template):
+        self.templates[key] = template
+        if len(self.templates) > self.maxsize:
+            self.templates.popitem(last=False)
+
+    def hitRate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def summary(self):
+        return "{} of {} measures from templates ({:.0%})".format(
+            self.hits, self.hits + self.misses, self.hitRate())
+
+def _splitTremolos(notes):
+    """
+    One special preprocess step: find any tremolo notes and split them
+    into distinct notes.
+    """
+    for note in notes:
+        tremolos = [annotation[1:] for annotation in note.annotations
+                    if annotation.startswith(score.TREMOLO)]
+        unit = TREMOLO_UNITS.get(tremolos[0]) if tremolos else None
+        if not unit:
+            yield note
+            continue
+
+        originalLength = note.duration
+        count, remainder = divmod(originalLength, unit)
+        segments = [unit] * int(count)
+        if remainder:
+            segments.append(remainder)
+
+        # Every segment gets the length of the last one
+        for segment in segments:
+            yield note._replace(duration=segments[-1])
+
+def _compileMeasure(notes, slack, velocity, wasRinging, partName, track,
+                    bendResolution, thinBends):
+    """
+    The rows for one measure's notes, given as (tick relative to the start of
+    the measure, note) pairs, and the state the next measure starts with.
+
+    Everything here only depends on the notes' relative timings and on
+    the state on entry: the velocity, whether a let ring is ongoing, and
+    the slack, which is how far the events written so far extend past
+    the start of the measure (in ticks, and negative when they fall short).
+    """
     eventsAndMeta = []
     meta = {}
 
-    offset = 0
+    offset = slack
     cumulativeDifference = 0
     skips = []
 
-    velocity = 80
-    wasRinging = False
-    for note in notesAndRests:
+    for tick, note in notes:
 
         meta = {"partName": partName}
 
         noteEvents = []
 
-        for expression in note.expressions:
-            if isinstance(expression, music21.expressions.Tremolo):
-                meta["tremolo"] = str(expression.numberOfMarks)
+        for annotation in note.annotations:
+            kind, value = annotation[:1], annotation[1:]
+
+            if kind == score.TREMOLO:
+                meta["tremolo"] = value
 
-        for articulation in note.articulations:
-            if isinstance(articulation, music21.articulations.StringHarmonic):
-                meta["harmonic"] = articulation.harmonicType
+            if kind == score.HARMONIC:
+                meta["harmonic"] = value
 
                 if note.isChord:
                     if len(note.pitches) > 1:
-                        nonHighest = note.pitches[0:-1]
-                        for pitch in nonHighest:
-                            note.remove(pitch)
-
-            if isinstance(articulation, music21.articulations.TechnicalIndication):
-                if articulation.displayText:
-                    if articulation.displayText == "palm-mute":
-                        meta["palmMute"] = True
-                    if articulation.displayText == "vibrato":
-                        meta["vibrato"] = True
-                    if articulation.displayText == "letring":
-                        meta["letring"] = True
-                    if articulation.displayText.startswith("dynamics__"):
-                        dynamics = articulation.displayText[10:]
-                        meta["dynamics"] = dynamics
-                        if dynamics in DYNAMICS_VELOCITY_MAP:
-                            velocity = DYNAMICS_VELOCITY_MAP[dynamics]
-                    if articulation.displayText.startswith("bend__"):
-                        bend = articulation.displayText[6:]
-                        meta["bend"] = bend
-
-        if isinstance(note, music21.note.NotRest) and note.noteheadParenthesis:
-            print("GHOST")
-
-        computedOffset = music21.midi.translate.offsetToMidi(note.offset) + cumulativeDifference
+                        # Only the highest pitch is played
+                        note = note._replace(pitches=note.pitches[-1:],
+                                             ties=note.ties[-1:])
+
+            # GP7 effects also reach notes without a <technical> to carry
+            # them as indications
+            if kind == score.GP7 and value in ("vibrato", "letring"):
+                meta[value] = True
+
+            if kind == score.TECHNICAL:
+                if value == "palm-mute":
+                    meta["palmMute"] = True
+                if value == "vibrato":
+                    meta["vibrato"] = True
+                if value == "letring":
+                    meta["letring"] = True
+                if value.startswith("dynamics__"):
+                    dynamics = value[10:]
+                    meta["dynamics"] = dynamics
+                    if dynamics in DYNAMICS_VELOCITY_MAP:
+                        velocity = DYNAMICS_VELOCITY_MAP[dynamics]
+                if value.startswith("bend__"):
+                    bend = value[6:]
+                    meta["bend"] = bend
+
+        computedOffset = tick + cumulativeDifference
 
         if computedOffset > offset:
             difference = computedOffset - offset
             cumulativeDifference += difference
 
-            delta = music21.midi.DeltaTime(track)
+            delta = midi.DeltaTime(track)
             delta.time = difference
 
-            off = music21.midi.MidiEvent(track)
+            off = midi.MidiEvent(track)
             off.type = "NOTE_OFF"
             off.time = difference
             off.pitch = 1
@@ -223,13 +249,9 @@ def createMIDIEvents(part, track, verbose=False):
             noteEvents.append(off)
             offset = computedOffset
 
-        if isinstance(note, music21.note.NotRest):
+        if not note.isRest:
             skips = _findTieSkips(note)
-
-            if note.isChord:
-                noteEvents.extend(music21.midi.translate.chordToMidiEvents(note))
-            else:
-                noteEvents.extend(music21.midi.translate.noteToMidiEvents(note))
+            noteEvents.extend(_noteEvents(note))
 
             index = 0
             eventLength = len(noteEvents)
@@ -239,7 +261,7 @@ def createMIDIEvents(part, track, verbose=False):
                 event = noteEvents[index]
                 event.channel = 1
 
-                if isinstance(event, music21.midi.DeltaTime):
+                if isinstance(event, midi.DeltaTime):
                     offset += event.time
 
                     if meta.get("bend"):
@@ -247,13 +269,15 @@ def createMIDIEvents(part, track, verbose=False):
                             nextEvent = noteEvents[index + 1]
                             if nextEvent.type == "NOTE_OFF":
                                 bendValues = meta.get("bend").split(",")
-                                bendEvents = _createBend(bendValues, event.time, track)
+                                bendEvents = _createBend(bendValues, event.time, track,
+                                                         resolution=bendResolution,
+                                                         thin=thinBends)
 
                                 for bend in bendEvents:
-                                    wrapped = music21.base.ElementWrapper(bend)
-                                    eventsAndMeta.append((wrapped, meta))
+                                    eventsAndMeta.append((bend, meta))
                             event.time = 0
 
+                # Guitar Pro for some reason shifts basslines down an octave
                 if "bass" in partName:
                     if event.type == "NOTE_ON" or event.type == "NOTE_OFF":
                         if event.pitch:
@@ -275,29 +299,24 @@ def createMIDIEvents(part, track, verbose=False):
                             if skips[event.pitch]["off"]:
                                 event.pitch = 0
 
-                # Guitar Pro for some reason shifts basslines down an octave
-                wrapped = music21.base.ElementWrapper(event)
-
                 # Mostly, this is where we finalize the event. Some effects will need
                 # to be inserted after this point.
                 eventsAndMeta.append((event, meta))
 
-                if isinstance(event, music21.midi.DeltaTime):
+                if isinstance(event, midi.DeltaTime):
                     if meta.get("letring"):
                         if not wasRinging:
                             if index < eventLength - 1:
                                 nextEvent = noteEvents[index + 1]
                                 if nextEvent.type == "NOTE_OFF":
-                                    ring = music21.midi.MidiEvent(track, type="CONTROLLER_CHANGE", channel=1)
+                                    ring = midi.MidiEvent(track, type="CONTROLLER_CHANGE", channel=1)
                                     ring.pitch = 64     # CC 64 = Hold Pedal
                                     ring.velocity = 64
-                                    wrapped = music21.base.ElementWrapper(ring)
+                                    eventsAndMeta.append((ring, meta))
 
-                                    eventsAndMeta.append((wrapped, meta))
-                                    delta = music21.midi.DeltaTime(track)
+                                    delta = midi.DeltaTime(track)
                                     delta.time = 0
-                                    wrapped = music21.base.ElementWrapper(delta)
-                                    eventsAndMeta.append((wrapped, meta))
+                                    eventsAndMeta.append((delta, meta))
 
                                     wasRinging = True
                     else:
@@ -305,19 +324,78 @@ def createMIDIEvents(part, track, verbose=False):
                             if index < eventLength - 1:
                                 nextEvent = noteEvents[index + 1]
                                 if nextEvent.type == "NOTE_OFF":
-                                    ring = music21.midi.MidiEvent(track, type="CONTROLLER_CHANGE", channel=1)
+                                    ring = midi.MidiEvent(track, type="CONTROLLER_CHANGE", channel=1)
                                     ring.pitch = 64     # CC 64 = Hold Pedal
                                     ring.velocity = 0
-                                    wrapped = music21.base.ElementWrapper(ring)
-                                    eventsAndMeta.append((wrapped, meta))
+                                    eventsAndMeta.append((ring, meta))
 
-                                    delta = music21.midi.DeltaTime(track)
+                                    delta = midi.DeltaTime(track)
                                     delta.time = 0
-                                    wrapped = music21.base.ElementWrapper(delta)
-                                    eventsAndMeta.append((wrapped, meta))
+                                    eventsAndMeta.append((delta, meta))
 
                                     wasRinging = False
 
                 index += 1
 
+    rows = tuple(rowFromEvent(event, meta) for event, meta in eventsAndMeta)
+    return MeasureTemplate(rows, offset - cumulativeDifference, velocity, wasRinging)
+
+def createRows(part, track, verbose=False, bendResolution=bends.DEFAULT_RESOLUTION,
+               thinBends=False, templates=None):
+    """
+    Yield MIDI events for a part, as util.events rows. The part is
+    normally a score.CompactPart; a music21 part is compacted first.
+
+    Bends are rendered in steps of `bendResolution` ticks and, with
+    `thinBends`, without steps that don't change the bend.
+
+    Riffs repeat, so each measure is compiled once per distinct content and
+    entry state, and the rows of that template reused for every other
+    occurrence. `templates` (a MeasureTemplates) collects them, along with
+    hit counts.
+    """
+    if not isinstance(part, score.CompactPart):
+        part = score.compactPart(part)
+    if templates is None:
+        templates = MeasureTemplates()
+
+    # With that preprocessing out of the way, we know all of our notes
+    # and rests. We can proceed with true Music21 -> MIDI transformation.
+    partName = part.partName.casefold()
+
+    # Where the events written so far end, in ticks
+    position = 0
+    velocity = 80
+    wasRinging = False
+
+    for measure, notes in groupby(_splitTremolos(part.notes()), key=attrgetter("measure")):
+        start = int(round(measure * midi.TICKS_PER_QUARTER_NOTE))
+        notes = tuple((int(round(note.offset * midi.TICKS_PER_QUARTER_NOTE)) - start,
+                       note._replace(offset=0.0, measure=0.0))
+                      for note in notes)
+
+        key = (notes, position - start, velocity, wasRinging)
+        template = templates.get(key)
+        if template is None:
+            template = _compileMeasure(notes, position - start, velocity, wasRinging,
+                                       partName, track, bendResolution, thinBends)
+            templates.put(key, template)
+
+        yield from template.rows
+
+        position = start + template.slack
+        velocity = template.velocity
+        wasRinging = template.wasRinging
+
+def createMIDIEvents(part, track, verbose=False, bendResolution=bends.DEFAULT_RESOLUTION,
+                     thinBends=False):
+    """
+    Create MIDI events for a part, as (event, meta) pairs (see createRows).
+    """
+    eventsAndMeta = []
+    for row in createRows(part, track, verbose=verbose, bendResolution=bendResolution,
+                          thinBends=thinBends):
+        event = eventFromRow(row)
+        event.track = track
+        eventsAndMeta.append((event, row[META]))
     return eventsAndMeta
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+import os
+import os.path
+import time
+
+from util import batch
+from util import convert
+from util import extract
+from util import outputs
+from util import score
+
+"""
+Watch mode: a long-running converter that keeps music21 imported, and
+reconverts MusicXML files as they are exported again.
+
+Files are polled by modification time and size, which works the same
+everywhere and needs nothing beyond the standard library. A change is only
+picked up once the file has stayed the same for a whole poll interval, so
+a half-written export is left alone.
+
+On each change, every <part> is hashed (see extract.hashParts), and only
+the parts whose markup changed are parsed and rendered again. The MIDI
+files of the other parts are left untouched, unless the tempo track they
+share changed too. With a single file for all parts, that file is rewritten
+from the kept tracks of the other parts.
+"""
+
+POLL_INTERVAL = 1.0
+
+def _stamp(filename):
+    info = os.stat(filename)
+    return (info.st_mtime_ns, info.st_size)
+
+class WatchedFile:
+    def __init__(self, filename):
+        self.filename = filename
+        # (modification time, size) when last converted, and when last seen
+        self.stamp = None
+        self.pending = None
+        # By part ID (digests of every part, selected or not)
+        self.digests = {}
+        self.compacts = {}
+        self.tempos = None
+        self.tempoBytes = None
+        # Rendered part tracks by part name, with a single file for all parts
+        self.tracks = {}
+
+class Watcher:
+    def __init__(self, targets, postprocs, conversionCache, manifest=None, jobs=1,
+                 renderOptions=None, parts=None, log=print):
+        self.targets = targets
+        self.manifest = manifest
+        self.postprocs = postprocs
+        self.conversionCache = conversionCache
+        self.jobs = jobs
+        self.renderOptions = renderOptions or convert.DEFAULT_RENDER_OPTIONS
+        self.parts = parts
+        self.log = log
+        self.files = {}
+
+    def poll(self):
+        """
+        The watched files that changed since they were last converted, and
+        then stayed the same since the previous poll.
+        """
+        ready = []
+        for filename in batch.collectFiles(self.targets, manifest=self.manifest):
+            watched = self.files.setdefault(filename, WatchedFile(filename))
+            try:
+                stamp = _stamp(filename)
+            except OSError:
+                continue
+
+            if stamp == watched.stamp:
+                watched.pending = None
+            elif stamp == watched.pending:
+                ready.append(watched)
+            else:
+                watched.pending = stamp
+
+        return ready
+
+    def update(self, watched):
+        """
+        Bring a file's MIDI files up to date, parsing and rendering only the
+        parts that changed. Returns the names of the parts written.
+        """
+        filename = watched.filename
+        stamp = _stamp(filename)
+        options = convert.outputOptions(self.renderOptions, self.parts)
+
+        partList = extract.hashParts(filename)
+        selected = extract.selectParts([(partId, name) for partId, name, digest in partList],
+                                       self.parts)
+        if not selected:
+            raise extract.selectionError(filename, self.parts)
+
+        digests = {partId: digest for partId, name, digest in partList}
+        changed = [partId for partId in selected
+                   if watched.digests.get(partId) != digests[partId]
+                   or partId not in watched.compacts]
+
+        compacts = dict(watched.compacts)
+        tempos = watched.tempos
+        key = self.conversionCache.key(filename)
+        if changed:
+            loaded, tempos = convert.loadParts(filename, self.conversionCache, parts=changed,
+                                               key=key)
+            compacts.update(loaded)
+        elif digests != watched.digests or tempos is None:
+            # Another part changed, and it may be the one with the metronome marks
+            tempos = convert.loadTempos(filename, self.conversionCache, list(digests), key=key)
+        compact = score.merge((compacts[partId] for partId in selected), tempos)
+        tempoBytes = compact.tempoMap(convert.TICKS_PER_QUARTER_NOTE).encode()
+        parts = convert.distinctParts(compact)
+
+        directory = os.path.dirname(filename)
+        upToDate = watched.stamp is None and \
+            outputs.upToDate(filename, self.postprocs, self.conversionCache,
+                             options=options, key=key) is not None
+
+        changedParts = {id(part) for partId in changed for part in compacts[partId].parts}
+
+        if self.renderOptions.singleFile:
+            written = [] if upToDate else self._writeScore(watched, parts, changedParts,
+                                                           tempoBytes)
+            outputNames = [os.path.splitext(os.path.basename(filename))[0]]
+        else:
+            if upToDate:
+                stale = []
+            elif tempoBytes != watched.tempoBytes:
+                stale = parts
+            else:
+                stale = [part for part in parts if id(part) in changedParts or
+                         not os.path.exists(os.path.join(directory, "{}.mid".format(part.name)))]
+
+            written = convert.writeParts(directory, stale, tempoBytes, self.postprocs,
+                                         jobs=self.jobs, renderOptions=self.renderOptions)
+            outputNames = None
+
+        if not upToDate:
+            outputs.record(filename, self.postprocs, [part.name for part in parts],
+                           self.conversionCache, options=options, outputNames=outputNames,
+                           key=key)
+
+        watched.stamp = stamp
+        watched.pending = None
+        watched.digests = digests
+        watched.compacts = {partId: compacts[partId] for partId in selected}
+        watched.tempos = tempos
+        watched.tempoBytes = tempoBytes
+        return written
+
+    def _writeScore(self, watched, parts, changedParts, tempoBytes):
+        """
+        Render the parts that changed (or that weren't rendered yet), and
+        rewrite the file of all parts from their tracks, if anything in it
+        changed. Returns the names of the parts written.
+        """
+        stale = [part for part in parts
+                 if id(part) in changedParts or part.name not in watched.tracks]
+        watched.tracks.update(convert.renderParts(stale, self.postprocs, jobs=self.jobs,
+                                                  renderOptions=self.renderOptions))
+        watched.tracks = {part.name: watched.tracks[part.name] for part in parts}
+
+        filename = convert.scoreFilename(watched.filename)
+        if not stale and tempoBytes == watched.tempoBytes and os.path.exists(filename):
+            return []
+        convert.writeScore(filename, list(watched.tracks.items()), tempoBytes)
+        return [part.name for part in stale] or list(watched.tracks)
+
+    def cycle(self, files):
+        """
+        Update each of `files`, logging what was written and how long it took.
+        """
+        for watched in files:
+            start = time.perf_counter()
+            try:
+                written = self.update(watched)
+            except Exception as err:
+                # Don't retry until the file changes again
+                try:
+                    watched.stamp = _stamp(watched.filename)
+                except OSError:
+                    pass
+                watched.pending = None
+                self.log("✘ {} ({:.2f}s): {}".format(watched.filename,
+                                                    time.perf_counter() - start, err))
+                continue
+
+            self.log("✔ {} ({:.2f}s): {}".format(watched.filename, time.perf_counter() - start,
+                                                 ", ".join(written) or "up to date"))
+
+    def run(self, interval=POLL_INTERVAL):
+        """
+        Convert everything that isn't up to date, then watch for changes
+        until interrupted.
+        """
+        # Keep music21 warm for the first change, too
+        import music21
+
+        self.cycle([self.files.setdefault(filename, WatchedFile(filename))
+                    for filename in batch.collectFiles(self.targets, manifest=self.manifest)])
+        self.log("Watching for changes (^C to stop)")
+
+        while True:
+            time.sleep(interval)
+            self.cycle(self.poll())